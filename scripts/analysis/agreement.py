@@ -0,0 +1,151 @@
+import argparse
+
+import numpy as np
+
+from .annotationutils import as_annotation_set, load_annotations
+
+
+# Krippendorff's alpha over units of (document, system), computed from the coincidence matrix of
+# the score values. Coincidences are first summed per cluster (document or annotator group), a
+# bootstrap replicate is then just a reweighting of the cluster sums.
+
+METRICS = ("nominal", "ordinal", "interval")
+CLUSTERS = ("document", "group")
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_unit_value_counts(annotations, score_name):
+    # Number of annotations with each value in every unit, units without any score are dropped
+    annotations = as_annotation_set(annotations)
+    scores = annotations.get_scores(score_name)
+    observed = ~np.isnan(scores)
+
+    values, categories = np.unique(scores[observed], return_inverse=True)
+    units = annotations.documents.astype(np.int64)[observed] * len(annotations.system_names) + annotations.systems[observed]
+    unit_ids, units = np.unique(units, return_inverse=True)
+
+    unit_counts = np.bincount(units * len(values) + categories, minlength=len(unit_ids) * len(values)).reshape(len(unit_ids), len(values))
+    return unit_counts, values, unit_ids, units, observed
+
+
+def get_unit_clusters(annotations, unit_ids, units, observed, cluster="document"):
+    # Cluster of every unit, units are attributed to the lowest annotator group that scored them
+    if cluster not in CLUSTERS:
+        raise ValueError(f"Unknown cluster {cluster}, expected one of {CLUSTERS}")
+
+    if cluster == "document":
+        unit_clusters = unit_ids // len(annotations.system_names)
+    else:
+        unit_clusters = np.full(len(unit_ids), np.iinfo(np.int64).max)
+        np.minimum.at(unit_clusters, units, annotations.group_ids[observed])
+
+    _, unit_clusters = np.unique(unit_clusters, return_inverse=True)
+    return unit_clusters
+
+
+def get_cluster_coincidences(unit_counts, unit_clusters, max_chunk_bytes=MAX_CHUNK_BYTES):
+    # Coincidence matrix of every cluster, flattened to (clusters, values * values)
+    num_values = unit_counts.shape[1]
+    num_clusters = unit_clusters.max() + 1
+    pairable = unit_counts.sum(axis=1)
+    scale = np.where(pairable > 1, 1 / np.maximum(pairable - 1, 1), 0.)
+
+    coincidences = np.zeros((num_clusters, num_values * num_values))
+    chunk_size = max(1, max_chunk_bytes // (8 * num_values * num_values))
+    for start in range(0, len(unit_counts), chunk_size):
+        counts = unit_counts[start:start + chunk_size].astype(float)
+        pairs = counts[:, :, None] * counts[:, None, :] - counts[:, :, None] * np.eye(num_values)
+        pairs *= scale[start:start + chunk_size, None, None]
+        np.add.at(coincidences, unit_clusters[start:start + chunk_size], pairs.reshape(len(counts), -1))
+
+    return coincidences
+
+
+def get_squared_distances(values, marginals, metric="ordinal"):
+    # metric differences between all pairs of values, marginals may hold a batch of value frequencies
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric}, expected one of {METRICS}")
+    marginals = np.asarray(marginals, dtype=float)
+
+    if metric == "nominal":
+        distances = 1. - np.eye(len(values))
+    elif metric == "interval":
+        distances = (values[:, None] - values[None, :]) ** 2.
+    else:
+        cumulative = np.cumsum(marginals, axis=-1)
+        # Sum of the frequencies from value c to value k minus half of theirs
+        spans = cumulative[..., None, :] - cumulative[..., :, None] + marginals[..., :, None]
+        spans = np.where(np.arange(len(values))[:, None] <= np.arange(len(values))[None, :], spans, np.swapaxes(spans, -1, -2))
+        distances = (spans - (marginals[..., :, None] + marginals[..., None, :]) / 2.) ** 2.
+
+    return np.broadcast_to(distances, marginals.shape[:-1] + (len(values), len(values)))
+
+
+def alpha_from_coincidences(coincidences, values, metric="ordinal"):
+    # coincidences has shape (..., values, values)
+    marginals = coincidences.sum(axis=-1)
+    total = marginals.sum(axis=-1)
+    distances = get_squared_distances(values, marginals, metric)
+
+    observed = (coincidences * distances).sum(axis=(-2, -1))
+    expected = (marginals[..., :, None] * marginals[..., None, :] * distances).sum(axis=(-2, -1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 1. - (total - 1.) * observed / expected
+
+
+def krippendorff_alpha(annotations, score_name="score", metric="ordinal"):
+    unit_counts, values, _, _, _ = get_unit_value_counts(annotations, score_name)
+    coincidences = get_cluster_coincidences(unit_counts, np.zeros(len(unit_counts), dtype=int))
+    return float(alpha_from_coincidences(coincidences.reshape(len(values), len(values)), values, metric))
+
+
+def bootstrap_alpha(annotations, score_name="score", metric="ordinal", cluster="document", num_replicates=1000, random_state=None, max_chunk_bytes=MAX_CHUNK_BYTES):
+    # Alpha of num_replicates resamples of the clusters with replacement
+    if random_state is None:
+        random_state = np.random
+
+    annotations = as_annotation_set(annotations)
+    unit_counts, values, unit_ids, units, observed = get_unit_value_counts(annotations, score_name)
+    unit_clusters = get_unit_clusters(annotations, unit_ids, units, observed, cluster)
+    coincidences = get_cluster_coincidences(unit_counts, unit_clusters, max_chunk_bytes)
+    num_clusters = len(coincidences)
+
+    alphas = []
+    chunk_size = max(1, max_chunk_bytes // (8 * max(num_clusters, coincidences.shape[1])))
+    for start in range(0, num_replicates, chunk_size):
+        size = min(chunk_size, num_replicates - start)
+        weights = random_state.multinomial(num_clusters, np.full(num_clusters, 1 / num_clusters), size=size)
+        replicate_coincidences = (weights @ coincidences).reshape(size, len(values), len(values))
+        alphas.append(alpha_from_coincidences(replicate_coincidences, values, metric))
+
+    return np.concatenate(alphas)
+
+
+def get_confidence_interval(replicates, confidence=0.95):
+    tail = (1 - confidence) / 2 * 100
+    return tuple(np.nanpercentile(replicates, [tail, 100 - tail]))
+
+
+def get_default_score_name(annotations):
+    return "rank" if "rank" in annotations.score_names else "score"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation_files", nargs="+")
+    parser.add_argument("-m", dest="metric", default="ordinal", choices=METRICS)
+    parser.add_argument("-c", dest="cluster", default="document", choices=CLUSTERS)
+    parser.add_argument("-n", dest="num_replicates", type=int, default=1000)
+    parser.add_argument("-s", dest="seed", type=int, default=None)
+
+    args = parser.parse_args()
+    random_state = np.random.default_rng(args.seed)
+
+    for annotation_file in args.annotation_files:
+        annotations = load_annotations(annotation_file)
+        score_name = get_default_score_name(annotations)
+
+        alpha = krippendorff_alpha(annotations, score_name, args.metric)
+        replicates = bootstrap_alpha(annotations, score_name, args.metric, args.cluster, args.num_replicates, random_state)
+        lower, upper = get_confidence_interval(replicates)
+        print(f"{annotation_file} {alpha:.4f} [{lower:.4f}, {upper:.4f}]")
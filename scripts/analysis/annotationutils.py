@@ -1,12 +1,339 @@
-from collections import Counter, defaultdict
-import itertools as it
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+INDEX_NAMES = ("annotator", "document", "system")
+
+# Columnar caches are stored in a directory next to the source file
+CACHE_SUFFIX = ".cache"
+CACHE_VERSION = 1
+
+
+def _mix_hash(values):
+    # splitmix64 finalizer, spreads document codes over all 64 bits
+    with np.errstate(over="ignore"):
+        z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def get_document_set_groups(annotator_codes, document_codes, num_annotators, num_documents):
+    # Group id of every annotator, annotators who saw the same set of documents share a group.
+    # Document sets are compared through an order independent hash of their documents, groups are
+    # numbered in the order of their first annotator.
+    pairs = np.sort(annotator_codes.astype(np.int64) * num_documents + document_codes)
+    pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+    pair_annotators = pairs // num_documents
+    documents = pairs % num_documents
+    starts = np.flatnonzero(np.diff(pair_annotators, prepend=-1))
+    sizes = np.diff(np.append(starts, len(pairs)))
+
+    with np.errstate(over="ignore"):
+        hashes = np.add.reduceat(_mix_hash(documents), starts)
+        hashes ^= _mix_hash(sizes + num_documents)
+
+    _, first_annotators, groups = np.unique(hashes, return_index=True, return_inverse=True)
+    groups = groups.ravel()
+    group_order = np.empty(len(first_annotators), dtype=int)
+    group_order[np.argsort(first_annotators)] = np.arange(len(first_annotators))
+    groups = group_order[groups]
+
+    if not _same_document_sets(documents, starts, sizes, first_annotators[np.argsort(group_order)][groups]):
+        # A hash collision, fall back to comparing the sorted document sets themselves
+        groups = pd.factorize(np.array([documents[start:start + size].tobytes() for start, size in zip(starts, sizes)], dtype=object))[0]
+
+    # Annotators without annotations get no group
+    annotator_groups = np.full(num_annotators, -1)
+    annotator_groups[pair_annotators[starts]] = groups
+    return annotator_groups
+
+
+def _same_document_sets(documents, starts, sizes, representatives):
+    # Whether every annotator saw exactly the (sorted) documents of its representative
+    if (sizes[representatives] != sizes).any():
+        return False
+    annotators = np.repeat(np.arange(len(starts)), sizes)
+    offsets = np.arange(len(documents)) - starts[annotators]
+    return bool((documents[starts[representatives][annotators] + offsets] == documents).all())
+
+
+def get_group_members(annotator_groups):
+    # Annotators of each group, one row per group padded with -1
+    num_groups = annotator_groups.max() + 1
+    members = np.flatnonzero(annotator_groups >= 0)
+    order = members[np.argsort(annotator_groups[members], kind="stable")]
+    group_sizes = np.bincount(annotator_groups[members], minlength=num_groups)
+    positions = np.arange(len(order)) - np.repeat(np.cumsum(group_sizes) - group_sizes, group_sizes)
+
+    group_members = np.full((num_groups, group_sizes.max()), -1)
+    group_members[annotator_groups[order], positions] = order
+    return group_members
+
+
+def sample_group_members(group_members, group_samples, random_state):
+    # One random annotator out of every sampled group
+    group_sizes = (group_members >= 0).sum(axis=1)
+    positions = (random_state.random(group_samples.shape) * group_sizes[group_samples]).astype(int)
+    return group_members[group_samples, positions]
+
+
+def _get_score_dtype(values):
+    # Smallest integer type holding all scores, floats for anything else
+    present = values[~np.isnan(values)]
+    if len(present) == 0 or not np.array_equal(present, np.round(present)):
+        return np.float64
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if present.min() >= info.min and present.max() <= info.max:
+            return dtype
+    return np.float64
+
+
+class AnnotationSet:
+    # Annotations in long format as int32 codes into the sorted annotator, document and system names
+    # and masked score columns of the smallest fitting type. Other columns (like the corpus) are kept
+    # as labels, codes into their categories. The annotator group index is built on first use and
+    # cached.
+    __slots__ = (
+        "annotators", "documents", "systems", "annotator_names", "document_names", "system_names",
+        "scores", "labels", "_annotator_groups", "_group_members"
+    )
+
+    def __init__(self, annotators, documents, systems, annotator_names, document_names, system_names, scores, labels=None):
+        self.annotators = np.asarray(annotators, dtype=np.int32)
+        self.documents = np.asarray(documents, dtype=np.int32)
+        self.systems = np.asarray(systems, dtype=np.int32)
+        self.annotator_names = pd.Index(annotator_names, name="annotator")
+        self.document_names = pd.Index(document_names, name="document")
+        self.system_names = pd.Index(system_names, name="system")
+        self.scores = dict(scores)
+        self.labels = dict(labels or {})
+        self._annotator_groups = None
+        self._group_members = None
+
+    @classmethod
+    def from_frame(cls, annotations):
+        if isinstance(annotations, cls):
+            return annotations
+
+        index = annotations.index
+        levels = [index.get_level_values(name if name in index.names else position) for position, name in enumerate(INDEX_NAMES)]
+        (annotators, annotator_names), (documents, document_names), (systems, system_names) = [pd.factorize(level, sort=True) for level in levels]
+
+        scores = {}
+        labels = {}
+        for name, column in annotations.items():
+            if not pd.api.types.is_numeric_dtype(column.dtype):
+                codes, categories = pd.factorize(column)
+                labels[name] = (codes.astype(np.int32), categories)
+                continue
+            values = column.to_numpy(dtype=float, na_value=np.nan)
+            missing = np.isnan(values)
+            scores[name] = np.ma.MaskedArray(np.where(missing, 0, values).astype(_get_score_dtype(values)), missing)
+
+        return cls(annotators, documents, systems, annotator_names, document_names, system_names, scores, labels)
+
+    @classmethod
+    def from_file(cls, path, cache=True):
+        return load_annotations(path, cache)
+
+    def __len__(self):
+        return len(self.annotators)
+
+    @property
+    def score_names(self):
+        return list(self.scores)
+
+    @property
+    def annotator_groups(self):
+        if self._annotator_groups is None:
+            self._annotator_groups = get_document_set_groups(self.annotators, self.documents, len(self.annotator_names), len(self.document_names))
+        return self._annotator_groups
+
+    @property
+    def group_ids(self):
+        return self.annotator_groups[self.annotators]
+
+    @property
+    def num_groups(self):
+        return self.annotator_groups.max() + 1
+
+    @property
+    def group_members(self):
+        if self._group_members is None:
+            self._group_members = get_group_members(self.annotator_groups)
+        return self._group_members
+
+    def get_annotator_groups(self):
+        members = self.group_members
+        return [tuple(self.annotator_names[row[row >= 0]]) for row in members]
+
+    def get_scores(self, score_name):
+        # Scores as floats with nan for missing cells
+        return self.scores[score_name].astype(float).filled(np.nan)
+
+    def take(self, rows):
+        # Subset of the annotations sharing the name indices, codes stay valid
+        return AnnotationSet(
+            self.annotators[rows], self.documents[rows], self.systems[rows],
+            self.annotator_names, self.document_names, self.system_names,
+            {name: scores[rows] for name, scores in self.scores.items()},
+            {name: (codes[rows], categories) for name, (codes, categories) in self.labels.items()}
+        )
+
+    def to_index(self):
+        return pd.MultiIndex(
+            levels=[self.annotator_names, self.document_names, self.system_names],
+            codes=[self.annotators, self.documents, self.systems],
+            names=INDEX_NAMES, verify_integrity=False
+        )
+
+    def to_frame(self):
+        # Integer scores become nullable integer columns backed by the stored arrays and masks
+        columns = {}
+        for name, (codes, categories) in self.labels.items():
+            columns[name] = pd.Categorical.from_codes(codes, categories)
+        for name, scores in self.scores.items():
+            data, mask = np.ma.getdata(scores), np.ma.getmaskarray(scores)
+            if np.issubdtype(data.dtype, np.integer):
+                columns[name] = pd.arrays.IntegerArray(data, mask)
+            else:
+                columns[name] = np.where(mask, np.nan, data)
+        return pd.DataFrame(columns, index=self.to_index())
+
+
+def as_annotation_set(annotations):
+    return AnnotationSet.from_frame(annotations)
+
 
 def get_annotator_groups(annotations):
-    all_groups = defaultdict(list)
-    for annotator, group in annotations.groupby("annotator").groups.items():
-        docs = tuple(sorted(set(group.to_frame()["document"])))
-        all_groups[docs].append(annotator)
+    return as_annotation_set(annotations).get_annotator_groups()
+
+
+def get_annotator_group_ids(annotators, documents):
+    # Group id of every annotation, annotators who saw the same set of documents share a group
+    annotator_codes, annotator_names = pd.factorize(np.asarray(annotators), sort=True)
+    document_codes, document_names = pd.factorize(np.asarray(documents))
+    annotator_groups = get_document_set_groups(annotator_codes, document_codes, len(annotator_names), len(document_names))
+    return annotator_groups[annotator_codes]
+
+
+def read_annotations(path, cache=False):
+    if cache:
+        return load_annotations(path).to_frame()
+
+    annotations = pd.read_csv(path, index_col=[0, 1, 2])
+    # Some exports carry trailing empty columns
+    return annotations.loc[:, ~annotations.columns.str.startswith("Unnamed")]
+
+
+def get_cache_dir(path):
+    path = Path(path)
+    return path.with_name(path.name + CACHE_SUFFIX)
+
+
+def _get_file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_cache_meta(cache_dir):
+    try:
+        with open(cache_dir / "meta.json") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == CACHE_VERSION else None
+
+
+def _write_cache_meta(cache_dir, meta):
+    with open(cache_dir / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+
+def write_annotation_cache(annotations, cache_dir, source):
+    # Written to a temporary directory first, so readers never see a partial cache
+    cache_dir = Path(cache_dir)
+    temp_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent, prefix=cache_dir.name + "."))
+
+    for name in ("annotators", "documents", "systems"):
+        np.save(temp_dir / f"{name}.npy", getattr(annotations, name))
+    for idx, scores in enumerate(annotations.scores.values()):
+        np.save(temp_dir / f"score_{idx}.npy", np.ma.getdata(scores))
+        np.save(temp_dir / f"score_{idx}_mask.npy", np.ma.getmaskarray(scores))
+    for idx, (codes, _) in enumerate(annotations.labels.values()):
+        np.save(temp_dir / f"label_{idx}.npy", codes)
+
+    _write_cache_meta(temp_dir, {
+        "version": CACHE_VERSION,
+        "source": source,
+        "annotator_names": annotations.annotator_names.tolist(),
+        "document_names": annotations.document_names.tolist(),
+        "system_names": annotations.system_names.tolist(),
+        "scores": list(annotations.scores),
+        "labels": {name: categories.tolist() for name, (_, categories) in annotations.labels.items()},
+    })
+
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+    os.replace(temp_dir, cache_dir)
+
+
+def read_annotation_cache(cache_dir, meta):
+    # Arrays are memory-mapped, nothing is read until it is used
+    def load(name):
+        return np.load(cache_dir / f"{name}.npy", mmap_mode="r")
+
+    scores = {
+        name: np.ma.MaskedArray(load(f"score_{idx}"), load(f"score_{idx}_mask"), copy=False)
+        for idx, name in enumerate(meta["scores"])
+    }
+    labels = {name: (load(f"label_{idx}"), pd.Index(categories)) for idx, (name, categories) in enumerate(meta["labels"].items())}
+
+    return AnnotationSet(
+        load("annotators"), load("documents"), load("systems"),
+        meta["annotator_names"], meta["document_names"], meta["system_names"], scores, labels
+    )
+
+
+def load_annotations(path, cache=True):
+    # AnnotationSet of an annotation file, through a columnar cache next to it. The cache is valid
+    # while the source keeps its modification time and size, or else its content hash.
+    if not cache:
+        return AnnotationSet.from_frame(read_annotations(path))
+
+    cache_dir = get_cache_dir(path)
+    stat = os.stat(path)
+    state = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+    meta = _read_cache_meta(cache_dir)
+    if meta is not None and all(meta["source"][key] == value for key, value in state.items()):
+        return read_annotation_cache(cache_dir, meta)
 
-    all_annotator_groups = list(map(tuple, all_groups.values()))
-    return all_annotator_groups
+    digest = _get_file_digest(path)
+    if meta is not None and meta["source"]["sha256"] == digest:
+        meta["source"].update(state)
+        try:
+            _write_cache_meta(cache_dir, meta)
+        except OSError:
+            pass
+        return read_annotation_cache(cache_dir, meta)
 
+    annotations = AnnotationSet.from_frame(read_annotations(path))
+    try:
+        write_annotation_cache(annotations, cache_dir, dict(state, sha256=digest))
+    except OSError:
+        # Read-only data directories just go without a cache
+        return annotations
+    return read_annotation_cache(cache_dir, _read_cache_meta(cache_dir))
@@ -1,23 +1,240 @@
-import random
 import numpy as np
+import scipy.stats
 
-def paired_approximate_randomization_test(x, y, n=1000):
-    assert x.shape == y.shape
-    x_sum = x.sum()
-    y_sum = y.sum()
-    original_difference = abs(x_sum - y_sum)
+# Upper bound on the memory used by one chunk of the permutation sign matrix
+MAX_CHUNK_BYTES = 64 * 2 ** 20
+
+# Exact tests enumerate 2 ** (sample_size - 1) sign flips, "auto" switches to sequential sampling above this
+MAX_EXACT_SAMPLE_SIZE = 32
+# Sign flips expanded into one sorted vector of partial sums, the remaining ones are walked in Gray code order
+EXACT_BLOCK_SIZE = 16
+
+METHODS = ("approximate", "exact", "sequential", "auto")
+STATISTICS = ("t", "mean")
+
+
+def get_chunk_size(row_width, max_chunk_bytes=MAX_CHUNK_BYTES):
+    return max(1, max_chunk_bytes // (8 * max(row_width, 1)))
+
+
+def generate_sign_chunks(num_permutations, sample_size, random_state=None, chunk_size=None):
+    if random_state is None:
+        random_state = np.random
+    if chunk_size is None:
+        chunk_size = get_chunk_size(sample_size)
 
-    num_successes = 0
-    for _ in range(n):
-        mask = np.random.choice(a=[True, False], size=x.shape)
-        x_sample_sum = x[~mask].sum()
-        y_sample_sum = y[mask].sum()
+    for start in range(0, num_permutations, chunk_size):
+        size = min(chunk_size, num_permutations - start)
+        # +1 keeps a pair as observed, -1 swaps the two values of the pair
+        yield np.where(random_state.random((size, sample_size)) < 0.5, 1.0, -1.0)
 
-        sample_a_sum = (x_sum - x_sample_sum) + (y_sum - y_sample_sum)
-        sample_b_sum = x_sample_sum + y_sample_sum
 
-        sample_difference = abs(sample_a_sum - sample_b_sum)
-        if sample_difference >= original_difference:
-            num_successes += 1
+def _count_exceedances(signs, differences, original_differences):
+    sample_differences = np.abs(signs @ differences.T)
+    return (sample_differences >= original_differences - _tolerance(differences)).sum(axis=0)
+
+
+def _tolerance(differences):
+    # Sums of integer scores are exact, but sums of group means may be off by a few ulps
+    return 1e-9 * np.abs(differences).sum(axis=1)
+
+
+def approximate_randomization_pvalues(differences, n=1000, random_state=None, max_chunk_bytes=MAX_CHUNK_BYTES):
+    original_differences = np.abs(differences.sum(axis=1))
+
+    num_successes = np.zeros(differences.shape[0], dtype=np.int64)
+    # Each chunk holds a block of the sign matrix and the matching block of permuted statistics
+    chunk_size = get_chunk_size(max(differences.shape), max_chunk_bytes)
+    for signs in generate_sign_chunks(n, differences.shape[1], random_state, chunk_size):
+        num_successes += _count_exceedances(signs, differences, original_differences)
 
     return (num_successes + 1) / (n + 1)
+
+
+def gray_code_sums(values):
+    # Signed sums of the last axis of values for every sign vector, visited in Gray code order
+    # starting from all signs positive. Step i flips the sign of element ctz(i), so each sum is
+    # the previous one plus a single +/-2 * value.
+    num_values = values.shape[-1]
+    steps = np.arange(1, 2 ** num_values, dtype=np.int64)
+    flipped = np.zeros(len(steps), dtype=np.int64)
+    while True:
+        unresolved = ((steps >> flipped) & 1) == 0
+        if not unresolved.any():
+            break
+        flipped[unresolved] += 1
+    gray = steps ^ (steps >> 1)
+    now_negative = ((gray >> flipped) & 1) == 1
+
+    deltas = 2 * values[..., flipped] * np.where(now_negative, -1.0, 1.0)
+    initial = values.sum(axis=-1, keepdims=True)
+    return np.concatenate((initial, initial + np.cumsum(deltas, axis=-1)), axis=-1)
+
+
+def _count_exact_exceedances(differences, original_differences, block_size):
+    # |sum(s * d)| is symmetric under s -> -s, so the sign of the first pair stays fixed
+    rest = differences[:, 1:]
+    block_sums = np.sort(gray_code_sums(rest[:, :block_size]), axis=1)
+    outer_sums = differences[:, :1] + gray_code_sums(rest[:, block_size:])
+
+    num_successes = np.zeros(len(differences), dtype=np.int64)
+    for idx in range(len(differences)):
+        threshold = original_differences[idx]
+        if threshold <= 0:
+            num_successes[idx] = block_sums.shape[1] * outer_sums.shape[1]
+            continue
+
+        sums = block_sums[idx]
+        offsets = outer_sums[idx]
+        num_above = len(sums) - np.searchsorted(sums, threshold - offsets, side="left")
+        num_below = np.searchsorted(sums, -threshold - offsets, side="right")
+        num_successes[idx] = (num_above + num_below).sum()
+
+    return num_successes
+
+
+def exact_randomization_pvalues(differences, max_chunk_bytes=MAX_CHUNK_BYTES):
+    num_tests, sample_size = differences.shape
+    if sample_size > MAX_EXACT_SAMPLE_SIZE:
+        raise ValueError(f"Exact randomization test needs 2 ** {sample_size - 1} sign flips, at most {MAX_EXACT_SAMPLE_SIZE} paired observations are supported")
+
+    original_differences = np.abs(differences.sum(axis=1)) - _tolerance(differences)
+
+    block_size = min(sample_size - 1, EXACT_BLOCK_SIZE)
+    num_outer = sample_size - 1 - block_size
+    # Each chunk of tests holds its sorted block sums and outer sums
+    chunk_size = get_chunk_size(2 ** block_size + 2 ** num_outer, max_chunk_bytes)
+    num_successes = np.concatenate([
+        _count_exact_exceedances(differences[start:start + chunk_size], original_differences[start:start + chunk_size], block_size)
+        for start in range(0, num_tests, chunk_size)
+    ] or [np.zeros(0, dtype=np.int64)])
+
+    return num_successes / 2 ** (sample_size - 1)
+
+
+def sequential_randomization_pvalues(differences, n=1000, random_state=None, alpha=0.05, h=10, confidence=0.999, batch_size=50):
+    # Besag & Clifford (1991): a test stops once it has seen h permuted statistics at least as
+    # extreme as the observed one, reporting h / l after l permutations. Tests whose Clopper-Pearson
+    # upper bound on the p-value drops below alpha stop early as well.
+    num_tests, sample_size = differences.shape
+    original_differences = np.abs(differences.sum(axis=1))
+    tolerance = _tolerance(differences)
+
+    num_successes = np.zeros(num_tests, dtype=np.int64)
+    num_draws = np.zeros(num_tests, dtype=np.int64)
+    p_values = np.full(num_tests, np.nan)
+    active = np.arange(num_tests)
+
+    for signs in generate_sign_chunks(n, sample_size, random_state, batch_size):
+        sample_differences = np.abs(signs @ differences[active].T)
+        exceeds = sample_differences >= (original_differences - tolerance)[active]
+        cumulative = num_successes[active] + np.cumsum(exceeds, axis=0)
+
+        reached_h = cumulative[-1] >= h
+        stop_at = np.argmax(cumulative >= h, axis=0) + 1
+        p_values[active[reached_h]] = h / (num_draws[active[reached_h]] + stop_at[reached_h])
+
+        num_successes[active] = cumulative[-1]
+        num_draws[active] += len(signs)
+
+        upper_bound = scipy.stats.beta.ppf(confidence, num_successes[active] + 1, np.maximum(num_draws[active] - num_successes[active], 1))
+        significant = ~reached_h & (upper_bound < alpha)
+        p_values[active[significant]] = (num_successes[active[significant]] + 1) / (num_draws[active[significant]] + 1)
+
+        active = active[~(reached_h | significant)]
+        if len(active) == 0:
+            break
+
+    p_values[active] = (num_successes[active] + 1) / (num_draws[active] + 1)
+    return p_values
+
+
+def paired_approximate_randomization_tests(x, y, n=1000, random_state=None, method="approximate", max_chunk_bytes=MAX_CHUNK_BYTES, **sequential_args):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    assert x.shape == y.shape
+
+    # The last axis holds the paired observations, all leading axes index independent tests
+    out_shape = x.shape[:-1]
+    differences = (x - y).reshape(-1, x.shape[-1])
+
+    if method == "auto":
+        method = "exact" if differences.shape[1] <= MAX_EXACT_SAMPLE_SIZE else "sequential"
+
+    if method == "approximate":
+        p_values = approximate_randomization_pvalues(differences, n, random_state, max_chunk_bytes)
+    elif method == "exact":
+        p_values = exact_randomization_pvalues(differences, max_chunk_bytes)
+    elif method == "sequential":
+        p_values = sequential_randomization_pvalues(differences, n, random_state, **sequential_args)
+    else:
+        raise ValueError(f"Unknown randomization test method {method}, expected one of {METHODS}")
+
+    return p_values.reshape(out_shape)
+
+
+def paired_approximate_randomization_test(x, y, n=1000, random_state=None, method="approximate", **kwargs):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    assert x.shape == y.shape
+
+    return paired_approximate_randomization_tests(x.reshape(1, -1), y.reshape(1, -1), n, random_state, method, **kwargs)[0]
+
+
+def _pair_statistics(scores, left, right, statistic):
+    # |paired t| or |mean difference| of every pair over the groups of (..., groups, systems) scores
+    differences = scores[..., left] - scores[..., right]
+    means = differences.mean(axis=-2)
+    if statistic == "mean":
+        return np.abs(means)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_values = means / (differences.std(axis=-2, ddof=1) / np.sqrt(differences.shape[-2]))
+    return np.abs(np.nan_to_num(t_values, nan=0.0, posinf=np.inf, neginf=np.inf))
+
+
+def max_t_pvalues(scores, n=1000, random_state=None, statistic="t", step_down=True, max_chunk_bytes=MAX_CHUNK_BYTES):
+    # Westfall & Young max-T p-values of all system pairs (np.triu_indices order) for
+    # (..., systems, groups) scores. Every permutation shuffles the system labels within each group,
+    # one shared set of permutations serves all pairs and tests, and the p-values control the
+    # familywise error over the pairs of each test.
+    if statistic not in STATISTICS:
+        raise ValueError(f"Unknown statistic {statistic}, expected one of {STATISTICS}")
+    if random_state is None:
+        random_state = np.random
+
+    scores = np.asarray(scores, dtype=float)
+    out_shape = scores.shape[:-2]
+    scores = np.swapaxes(scores.reshape((-1,) + scores.shape[-2:]), 1, 2)
+    num_tests, num_groups, num_systems = scores.shape
+    left, right = np.triu_indices(num_systems, k=1)
+
+    observed = _pair_statistics(scores, left, right, statistic)
+    thresholds = np.where(np.isinf(observed), observed, observed - 1e-9 * observed)
+    # Step-down compares the permuted statistics of a pair and all less significant pairs with
+    # the observed statistic of the pair
+    order = np.argsort(-observed, axis=1, kind="stable")
+    ordered_thresholds = np.take_along_axis(thresholds, order, axis=1)
+
+    num_successes = np.zeros(observed.shape, dtype=np.int64)
+    chunk_size = get_chunk_size(num_tests * num_groups * max(num_systems, len(left)), max_chunk_bytes)
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        permutations = np.argsort(random_state.random((size, 1, num_groups, num_systems)), axis=-1)
+        permuted = _pair_statistics(np.take_along_axis(scores[None], permutations, axis=-1), left, right, statistic)
+
+        if step_down:
+            permuted = np.take_along_axis(permuted, order[None], axis=2)
+            maxima = np.maximum.accumulate(permuted[:, :, ::-1], axis=2)[:, :, ::-1]
+            num_successes += (maxima >= ordered_thresholds).sum(axis=0)
+        else:
+            num_successes += (permuted.max(axis=2)[:, :, None] >= thresholds).sum(axis=0)
+
+    p_values = (num_successes + 1) / (n + 1)
+    if step_down:
+        # Adjusted p-values never decrease with the rank of the observed statistic
+        p_values = np.maximum.accumulate(p_values, axis=1)
+        unordered = np.empty_like(p_values)
+        np.put_along_axis(unordered, order, p_values, axis=1)
+        p_values = unordered
+
+    return p_values.reshape(out_shape + (len(left),))
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import ingest
+from . import ordinal
+from .annotationutils import get_annotator_groups
+from .art import paired_approximate_randomization_test
+from .design import blocked_design
+from .shr import compute_annotator_shr_raw
+from .timereliability import compute_grouped_subsample_variance
+
+
+# Benchmarks of the analysis and ingestion hot paths on synthetic data shaped like the
+# final_result files (20 blocks of 5 documents, each block annotated by 3 annotators, 4 systems),
+# with the number of blocks and so of annotators and documents multiplied by the scale. Wall time
+# is the best of several runs, the peak memory comes from a separate run under tracemalloc and
+# throughput counts annotations (documents for the randomization test) per second. Every run is
+# appended as one JSON line to a history file and compared against a stored baseline run.
+
+BASE_BLOCKS, BLOCK_SIZE, BLOCK_ANNOTATORS = 20, 5, 3
+SCALES = (1, 10, 100, 1000)
+MODEL_NAME = "likertD:multi_news"
+SCORE_NAME = "score"
+# Subsamples per sample size, the full default makes the larger scales take hours
+SUBSAMPLE_LIMIT = 100
+TIMESTAMP = "2021/04/26 6:27:11 PM GMT+8"
+
+# setup(scale, random_state, directory) returns the function to time and the number of items it
+# processes, scales above max_scale are skipped
+Benchmark = namedtuple("Benchmark", ["setup", "max_scale"])
+
+
+def get_design(scale):
+    return blocked_design(BASE_BLOCKS * scale, BLOCK_SIZE, BLOCK_ANNOTATORS)
+
+
+def get_synthetic_annotations(scale, random_state=None):
+    return ordinal.MODELS[MODEL_NAME].sample(get_design(scale), random_state)
+
+
+def write_synthetic_batches(directory, protocol, scale, random_state=None):
+    # Shuffle table and crowdsourcing sheets of BLOCK_SIZE documents and BLOCK_ANNOTATORS workers
+    # each, in the layout ingest reads. Returns the directory of the sheets and the table path.
+    if random_state is None:
+        random_state = np.random
+    batch_directory = Path(directory) / "batches"
+    batch_directory.mkdir()
+    protocol_name = protocol
+    protocol = ingest.PROTOCOLS[protocol]
+    num_documents = BASE_BLOCKS * BLOCK_SIZE * scale
+    num_systems = len(ingest.SYSTEMS)
+
+    orders = np.argsort(random_state.random((num_documents, num_systems)), axis=1) + 1
+    table_path = Path(directory) / "shuffle.csv"
+    pd.DataFrame(orders.T, index=[f"Summary {position}" for position in range(1, num_systems + 1)], columns=np.arange(1, num_documents + 1)).to_csv(table_path)
+
+    prefix = "BWS" if protocol_name == "bws" else "Likert"
+    num_answers = BLOCK_SIZE * protocol.answers_per_document
+    for first in range(1, num_documents + 1, BLOCK_SIZE):
+        if protocol_name == "bws":
+            # Distinct best and worst positions
+            positions = np.argsort(random_state.random((BLOCK_ANNOTATORS, BLOCK_SIZE, num_systems)), axis=2)[:, :, :2] + 1
+            answers = np.char.add("Summary ", positions.reshape(BLOCK_ANNOTATORS, -1).astype(str))
+        else:
+            answers = (random_state.random((BLOCK_ANNOTATORS, num_answers)) * protocol.scale).astype(int) + 1
+
+        sheet = pd.DataFrame(answers, columns=[f"Question {idx}" for idx in range(num_answers)])
+        sheet.insert(0, ingest.WORKER_COLUMN, [f"W{first}_{idx}" for idx in range(BLOCK_ANNOTATORS)])
+        sheet.insert(0, ingest.TIME_COLUMN, TIMESTAMP)
+        sheet.to_csv(batch_directory / f"{prefix} {first}-{first + BLOCK_SIZE - 1}.csv", index=False)
+    return batch_directory, table_path
+
+
+def _setup_sample(scale, random_state, directory):
+    model, design = ordinal.MODELS[MODEL_NAME], get_design(scale)
+    return lambda: model.sample(design, random_state), len(design[0]) * len(model.systems)
+
+
+def _setup_art(scale, random_state, directory):
+    # Per document scores of two systems
+    x, y = random_state.normal(size=(2, BASE_BLOCKS * BLOCK_SIZE * scale))
+    return lambda: paired_approximate_randomization_test(x, y, random_state=random_state), len(x)
+
+
+# The analysis functions get the annotation frame, their conversion to an AnnotationSet is timed too
+def _setup_shr(scale, random_state, directory):
+    annotations = get_synthetic_annotations(scale, random_state)
+    return lambda: compute_annotator_shr_raw(annotations, score_names=(SCORE_NAME,), random_state=random_state), len(annotations)
+
+
+def _setup_subsample_variance(scale, random_state, directory):
+    annotations = get_synthetic_annotations(scale, random_state)
+    return lambda: compute_grouped_subsample_variance(annotations, score_name=SCORE_NAME, limit=SUBSAMPLE_LIMIT, random_state=random_state), len(annotations)
+
+
+def _setup_annotator_groups(scale, random_state, directory):
+    annotations = get_synthetic_annotations(scale, random_state)
+    return lambda: get_annotator_groups(annotations), len(annotations)
+
+
+def _setup_ingest(protocol):
+    # Single process, parallel parsing is a multiple of it
+    def setup(scale, random_state, directory):
+        batch_directory, table_path = write_synthetic_batches(directory, protocol, scale, random_state)
+        num_annotations = BASE_BLOCKS * BLOCK_SIZE * BLOCK_ANNOTATORS * len(ingest.SYSTEMS) * scale
+        return lambda: ingest.ingest(protocol, batch_directory, table_path, "synthetic", num_workers=1), num_annotations
+    return setup
+
+
+BENCHMARKS = {
+    "ordinal_sample": Benchmark(_setup_sample, 1000),
+    "randomization_test": Benchmark(_setup_art, 1000),
+    "annotator_shr": Benchmark(_setup_shr, 1000),
+    "grouped_subsample_variance": Benchmark(_setup_subsample_variance, 10),
+    "annotator_groups": Benchmark(_setup_annotator_groups, 1000),
+    "ingest_likert": Benchmark(_setup_ingest("likert"), 100),
+    "ingest_bws": Benchmark(_setup_ingest("bws"), 100),
+}
+
+
+def measure(func, repeat=3):
+    # Best wall time of repeat runs and the peak traced memory of one more run
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def run_benchmarks(names=None, scales=SCALES, repeat=3, seed=None):
+    if names is None:
+        names = list(BENCHMARKS)
+
+    results = []
+    for name in names:
+        benchmark = BENCHMARKS[name]
+        for scale in scales:
+            if scale > benchmark.max_scale:
+                continue
+            random_state = np.random.default_rng(seed)
+            with tempfile.TemporaryDirectory() as directory:
+                func, num_items = benchmark.setup(scale, random_state, directory)
+                seconds, peak = measure(func, repeat)
+            results.append({
+                "benchmark": name, "scale": scale, "items": int(num_items),
+                "seconds": seconds, "peak_bytes": int(peak), "throughput": num_items / seconds,
+            })
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_record(results):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": get_commit(),
+        "machine": {
+            "node": platform.node(), "processor": platform.machine(), "cpus": os.cpu_count(),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+        },
+        "results": results,
+    }
+
+
+def append_history(record, path):
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def read_history(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    # Results that are more than tolerance slower or use more than tolerance more memory than the
+    # same benchmark and scale in the baseline record
+    baseline_results = {(result["benchmark"], result["scale"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline_results.get((result["benchmark"], result["scale"]))
+        if reference is None:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            ratio = result[metric] / reference[metric] if reference[metric] else 1.
+            if ratio > 1 + tolerance:
+                regressions.append({"benchmark": result["benchmark"], "scale": result["scale"], "metric": metric, "ratio": ratio})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("history_file")
+    parser.add_argument("-b", dest="benchmarks", nargs="+", default=None, choices=BENCHMARKS)
+    parser.add_argument("--scales", nargs="+", type=int, default=list(SCALES))
+    parser.add_argument("-r", dest="repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--save-baseline", action="store_true", default=False)
+    parser.add_argument("-t", dest="tolerance", type=float, default=0.2)
+    parser.add_argument("-s", dest="seed", type=int, default=None)
+
+    args = parser.parse_args()
+
+    record = make_record(run_benchmarks(args.benchmarks, args.scales, args.repeat, args.seed))
+    append_history(record, args.history_file)
+    print(pd.DataFrame.from_records(record["results"]).set_index(["benchmark", "scale"]))
+
+    if args.baseline is not None:
+        if args.save_baseline or not Path(args.baseline).exists():
+            with open(args.baseline, "w") as f:
+                json.dump(record, f, indent=2)
+        else:
+            with open(args.baseline) as f:
+                regressions = compare_results(record["results"], json.load(f), args.tolerance)
+            for regression in regressions:
+                print(f"regression: {regression['benchmark']} at {regression['scale']}x, {regression['metric']} x{regression['ratio']:.2f}")
+            if regressions:
+                raise SystemExit(1)
@@ -0,0 +1,168 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from . import execution
+from .agreement import get_default_score_name
+from .annotationutils import as_annotation_set, load_annotations
+
+
+# Bootstrap of the system means over annotator groups and documents, replicates only reweight
+# per-cell sums of the scores. When every document belongs to a single group (blocks of documents
+# with their own annotators, as in final_result) the bootstrap has two stages: groups are
+# resampled, then documents within every drawn copy of a group. Crossed groups and documents are
+# resampled independently and every (group, document) cell is weighted with the product of their
+# multiplicities.
+
+CLUSTERS = ("group", "document")
+REPLICATES_PER_TASK = 1000
+# Studies with fewer cells are resampled in-process unless a number of workers is given
+MIN_POOL_CELLS = 10000
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_cell_sums(annotations, score_name):
+    # Per (group, document) cell and system score sums and counts
+    annotations = as_annotation_set(annotations)
+    scores = annotations.get_scores(score_name)
+    observed = ~np.isnan(scores)
+    num_systems = len(annotations.system_names)
+
+    cell_keys = annotations.group_ids[observed].astype(np.int64) * len(annotations.document_names) + annotations.documents[observed]
+    cell_keys, cells = np.unique(cell_keys, return_inverse=True)
+    bins = cells * num_systems + annotations.systems[observed]
+
+    sums = np.bincount(bins, weights=scores[observed], minlength=len(cell_keys) * num_systems).reshape(len(cell_keys), num_systems)
+    counts = np.bincount(bins, minlength=len(cell_keys) * num_systems).reshape(len(cell_keys), num_systems)
+
+    _, cell_groups = np.unique(cell_keys // len(annotations.document_names), return_inverse=True)
+    _, cell_documents = np.unique(cell_keys % len(annotations.document_names), return_inverse=True)
+    return sums, counts, cell_groups, cell_documents
+
+
+def _cluster_weights(cell_clusters, num_replicates, random_state):
+    num_clusters = cell_clusters.max() + 1
+    weights = random_state.multinomial(num_clusters, np.full(num_clusters, 1 / num_clusters), size=num_replicates)
+    return weights[:, cell_clusters]
+
+
+def is_nested(cell_groups, cell_documents):
+    # Whether every document is annotated within a single group
+    document_groups = np.unique(np.stack((cell_documents, cell_groups), axis=1), axis=0)[:, 0]
+    return len(document_groups) == len(np.unique(cell_documents))
+
+
+def _nested_weights(cell_groups, cell_documents, num_replicates, random_state):
+    # Groups are resampled, then the documents of every drawn copy of a group. The copies of a
+    # group drawn k times together draw k times its number of documents from its documents.
+    num_documents = cell_documents.max() + 1
+    document_groups = np.zeros(num_documents, dtype=np.int64)
+    document_groups[cell_documents] = cell_groups
+    group_sizes = np.bincount(document_groups)
+    group_documents = np.argsort(document_groups, kind="stable")
+    group_starts = np.cumsum(group_sizes) - group_sizes
+
+    draws = (_cluster_weights(np.arange(len(group_sizes)), num_replicates, random_state) * group_sizes).ravel()
+    replicates = np.repeat(np.repeat(np.arange(num_replicates), len(group_sizes)), draws)
+    groups = np.repeat(np.tile(np.arange(len(group_sizes)), num_replicates), draws)
+    documents = group_documents[group_starts[groups] + (random_state.random(len(groups)) * group_sizes[groups]).astype(np.int64)]
+
+    weights = np.bincount(replicates * num_documents + documents, minlength=num_replicates * num_documents)
+    return weights.reshape(num_replicates, num_documents)[:, cell_documents]
+
+
+def _bootstrap_task(task, random_state):
+    sums, counts, cell_clusters, nested, num_replicates = task
+    means = []
+    chunk_size = max(1, MAX_CHUNK_BYTES // (8 * len(sums)))
+    for start in range(0, num_replicates, chunk_size):
+        size = min(chunk_size, num_replicates - start)
+        weights = np.ones((size, len(sums)))
+        if nested:
+            weights *= _nested_weights(*cell_clusters, size, random_state)
+        else:
+            for clusters in cell_clusters:
+                weights *= _cluster_weights(clusters, size, random_state)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means.append((weights @ sums) / (weights @ counts))
+    return np.concatenate(means)
+
+
+def bootstrap_system_means(annotations, score_name="score", clusters=CLUSTERS, num_replicates=1000, seed=None, num_workers=None):
+    # Returns the system names, the system means and the (replicates, systems) bootstrap means
+    for cluster in clusters:
+        if cluster not in CLUSTERS:
+            raise ValueError(f"Unknown cluster {cluster}, expected one of {CLUSTERS}")
+
+    annotations = as_annotation_set(annotations)
+    sums, counts, cell_groups, cell_documents = get_cell_sums(annotations, score_name)
+    cell_clusters = [{"group": cell_groups, "document": cell_documents}[cluster] for cluster in clusters]
+    nested = set(clusters) == set(CLUSTERS) and is_nested(cell_groups, cell_documents)
+    if nested:
+        cell_clusters = [cell_groups, cell_documents]
+
+    if num_workers is None and len(sums) < MIN_POOL_CELLS:
+        num_workers = 1
+
+    tasks = [(sums, counts, cell_clusters, nested, size) for size in execution.split_replicates(num_replicates, REPLICATES_PER_TASK)]
+    replicates = np.concatenate(execution.run_tasks(_bootstrap_task, tasks, seed, num_workers))
+
+    return list(annotations.system_names), sums.sum(axis=0) / counts.sum(axis=0), replicates
+
+
+def get_interval(replicates, confidence=0.95):
+    tail = (1 - confidence) / 2 * 100
+    return np.nanpercentile(replicates, [tail, 100 - tail], axis=0)
+
+
+def get_system_table(systems, means, replicates, confidence=0.95):
+    lower, upper = get_interval(replicates, confidence)
+    return pd.DataFrame({"mean": means, "lower": lower, "upper": upper}, index=pd.Index(systems, name="system"))
+
+
+def get_difference_table(systems, means, replicates, confidence=0.95):
+    left, right = np.triu_indices(len(systems), k=1)
+    differences = replicates[:, left] - replicates[:, right]
+    lower, upper = get_interval(differences, confidence)
+
+    index = pd.MultiIndex.from_arrays([np.asarray(systems)[left], np.asarray(systems)[right]], names=["system_a", "system_b"])
+    return pd.DataFrame({
+        "difference": means[left] - means[right],
+        "lower": lower,
+        "upper": upper,
+        "p_greater": (differences > 0).mean(axis=0),
+    }, index=index)
+
+
+def get_rank_probabilities(systems, replicates, higher_is_better=True):
+    # Probability of every system to end up at every rank, rank 1 is the best
+    order = np.argsort(-replicates if higher_is_better else replicates, axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(len(systems))[None], axis=1)
+
+    probabilities = np.zeros((len(systems), len(systems)))
+    np.add.at(probabilities, (np.broadcast_to(np.arange(len(systems)), ranks.shape), ranks), 1)
+    probabilities /= len(replicates)
+
+    return pd.DataFrame(probabilities, index=pd.Index(systems, name="system"), columns=pd.Index(np.arange(1, len(systems) + 1), name="rank"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation_file")
+    parser.add_argument("-c", dest="clusters", nargs="+", default=list(CLUSTERS), choices=CLUSTERS)
+    parser.add_argument("-n", dest="num_replicates", type=int, default=1000)
+    parser.add_argument("-s", dest="seed", type=int, default=None)
+    parser.add_argument("-j", dest="num_workers", type=int, default=None)
+
+    args = parser.parse_args()
+
+    annotations = load_annotations(args.annotation_file)
+    score_name = get_default_score_name(annotations)
+    systems, means, replicates = bootstrap_system_means(annotations, score_name, args.clusters, args.num_replicates, args.seed, args.num_workers)
+
+    print(get_system_table(systems, means, replicates))
+    print(get_difference_table(systems, means, replicates))
+    # Best-worst ranks are 4 for the best and 1 for the worst summary, higher is better for both protocols
+    print(get_rank_probabilities(systems, replicates))
@@ -0,0 +1,263 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.special
+
+from .annotationutils import AnnotationSet, as_annotation_set, load_annotations
+from .ingest import BWSProtocol
+
+
+# Best-worst scaling on the tuples of the final_result files, where every (annotator, document)
+# shows the summaries of all systems with ranks 4 for the best, 1 for the worst and 2 otherwise.
+# Counting scores are best minus worst over times shown; the MaxDiff model picks the (best, worst)
+# pair of a tuple with probability proportional to exp(u_best - u_worst), which reduces to
+# Bradley-Terry for pairs. Worker effects are per worker and system deviations of the utilities
+# with a normal prior.
+
+BWSTuples = namedtuple("BWSTuples", ["items", "best", "worst", "workers", "documents"])
+# log_likelihood is that of the data, penalty the log prior of the worker effects left out of it
+MaxDiffFit = namedtuple("MaxDiffFit", ["systems", "utilities", "covariance", "worker_effects", "log_likelihood", "penalty"])
+
+
+def get_counting_scores(annotations, rank_name="rank"):
+    # +1 for the best, -1 for the worst and 0 for every other summary shown
+    ranks = as_annotation_set(annotations).get_scores(rank_name)
+    return np.where(np.isnan(ranks), np.nan, (ranks == BWSProtocol.BEST).astype(float) - (ranks == BWSProtocol.WORST))
+
+
+def add_counting_scores(annotations, rank_name="rank", score_name="bws"):
+    # Copy of the annotations with the counting scores as an additional score, ready for the
+    # bootstrap and power code
+    annotations = as_annotation_set(annotations)
+    scores = get_counting_scores(annotations, rank_name)
+    missing = np.isnan(scores)
+    return AnnotationSet(
+        annotations.annotators, annotations.documents, annotations.systems,
+        annotations.annotator_names, annotations.document_names, annotations.system_names,
+        dict(annotations.scores, **{score_name: np.ma.MaskedArray(np.where(missing, 0, scores).astype(np.int8), missing)}),
+        annotations.labels
+    )
+
+
+def get_counting_table(annotations, rank_name="rank"):
+    annotations = as_annotation_set(annotations)
+    scores = get_counting_scores(annotations, rank_name)
+    observed = ~np.isnan(scores)
+    num_systems = len(annotations.system_names)
+
+    systems = annotations.systems[observed]
+    table = pd.DataFrame({
+        "best": np.bincount(systems, weights=scores[observed] > 0, minlength=num_systems),
+        "worst": np.bincount(systems, weights=scores[observed] < 0, minlength=num_systems),
+        "shown": np.bincount(systems, minlength=num_systems),
+    }, index=annotations.system_names)
+    table["score"] = (table["best"] - table["worst"]) / table["shown"]
+    return table
+
+
+def get_document_counting_scores(annotations, rank_name="rank"):
+    # Counting scores of every (document, system)
+    annotations = as_annotation_set(annotations)
+    scores = get_counting_scores(annotations, rank_name)
+    observed = ~np.isnan(scores)
+    num_cells = len(annotations.document_names) * len(annotations.system_names)
+
+    cells = annotations.documents[observed].astype(np.int64) * len(annotations.system_names) + annotations.systems[observed]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.bincount(cells, weights=scores[observed], minlength=num_cells) / np.bincount(cells, minlength=num_cells)
+    return pd.DataFrame(means.reshape(len(annotations.document_names), -1), index=annotations.document_names, columns=annotations.system_names)
+
+
+def get_tuples(annotations, rank_name="rank"):
+    # One row of system codes per (annotator, document), padded with -1, and the positions of the
+    # best and worst summary. Tuples without a distinct best and worst are dropped.
+    annotations = as_annotation_set(annotations)
+    ranks = annotations.get_scores(rank_name)
+    observed = np.flatnonzero(~np.isnan(ranks))
+
+    keys = annotations.annotators[observed].astype(np.int64) * len(annotations.document_names) + annotations.documents[observed]
+    order = np.argsort(keys, kind="stable")
+    rows, keys = observed[order], keys[order]
+    starts = np.flatnonzero(np.diff(keys, prepend=-1))
+    sizes = np.diff(np.append(starts, len(keys)))
+    tuple_index = np.repeat(np.arange(len(starts)), sizes)
+    positions = np.arange(len(keys)) - starts[tuple_index]
+
+    items = np.full((len(starts), sizes.max()), -1)
+    items[tuple_index, positions] = annotations.systems[rows]
+    best = np.full(len(starts), -1)
+    worst = np.full(len(starts), -1)
+    is_best = ranks[rows] == BWSProtocol.BEST
+    is_worst = ranks[rows] == BWSProtocol.WORST
+    best[tuple_index[is_best]] = positions[is_best]
+    worst[tuple_index[is_worst]] = positions[is_worst]
+
+    valid = (best >= 0) & (worst >= 0) & (best != worst)
+    return BWSTuples(
+        items[valid], best[valid], worst[valid],
+        annotations.annotators[rows[starts[valid]]], annotations.documents[rows[starts[valid]]]
+    )
+
+
+def _partition(tuple_utilities, present, sizes):
+    # The sum of exp(u_k - u_l) over the ordered pairs of a tuple factorizes into
+    # sum(exp(u)) * sum(exp(-u)) - n. Returns the exponentials, their sums, the log partition
+    # function and its gradient with respect to the utilities. Row sums are products with a
+    # vector of ones, which is much faster than summing the short rows.
+    ones = np.ones(present.shape[1])
+    exponentials = np.exp(tuple_utilities - ((tuple_utilities * present) @ ones / sizes)[:, None])
+    positive = exponentials * present
+    negative = present / exponentials
+    positive_sums = (positive @ ones)[:, None]
+    negative_sums = (negative @ ones)[:, None]
+    partition = positive_sums * negative_sums - sizes[:, None]
+    gradient = (positive * negative_sums - positive_sums * negative) / partition
+    return positive, negative, positive_sums, negative_sums, partition, np.log(partition[:, 0]), gradient
+
+
+def _count_tuples(tuples, workers=False):
+    # Identical tuples (the same systems and choices, and the same worker with worker effects)
+    # become one row weighted by their count, the likelihood only depends on these
+    padded = np.where(tuples.items >= 0, tuples.items, np.iinfo(np.int64).max)
+    items = np.take_along_axis(tuples.items, np.argsort(padded, axis=1, kind="stable"), axis=1)
+    rows = np.arange(len(items))
+    keys = [items, tuples.items[rows, tuples.best][:, None], tuples.items[rows, tuples.worst][:, None]]
+    if workers:
+        keys.append(tuples.workers[:, None])
+
+    keys = np.hstack(keys)
+    keys = keys[np.lexsort(keys.T[::-1])]
+    starts = np.flatnonzero(np.append(True, (keys[1:] != keys[:-1]).any(axis=1)))
+    keys, counts = keys[starts], np.diff(np.append(starts, len(keys)))
+    num_items = items.shape[1]
+    items = keys[:, :num_items]
+    best = np.argmax(items == keys[:, num_items, None], axis=1)
+    worst = np.argmax(items == keys[:, num_items + 1, None], axis=1)
+    tuple_workers = keys[:, num_items + 2] if workers else np.zeros(len(keys), dtype=np.int64)
+    return items, best, worst, tuple_workers, counts
+
+
+class _MaxDiffObjective:
+    # Negative penalized log-likelihood over the utilities of systems 1.. (system 0 is the
+    # reference) followed by the worker effects
+    def __init__(self, tuples, num_systems, num_workers=0, worker_variance=1.):
+        self.num_systems = num_systems
+        self.num_workers = num_workers
+        self.worker_variance = worker_variance
+        items, self.best, self.worst, workers, self.counts = _count_tuples(tuples, num_workers > 0)
+        self.present = items >= 0
+        self.sizes = self.present.sum(axis=1)
+        self.items = np.where(self.present, items, 0)
+        self.rows = np.arange(len(self.items))
+        if num_workers:
+            self.worker_items = workers[:, None] * num_systems + self.items
+
+    def unpack(self, params):
+        utilities = np.concatenate([[0.], params[:self.num_systems - 1]])
+        worker_effects = params[self.num_systems - 1:].reshape(self.num_workers, self.num_systems)
+        return utilities, worker_effects
+
+    def tuple_utilities(self, params):
+        utilities, worker_effects = self.unpack(params)
+        tuple_utilities = utilities[self.items]
+        if self.num_workers:
+            tuple_utilities = tuple_utilities + worker_effects.ravel()[self.worker_items]
+        return tuple_utilities
+
+    def log_likelihood(self, params):
+        # Log-likelihood of the tuples and its gradient, without the prior of the worker effects
+        tuple_utilities = self.tuple_utilities(params)
+        *_, log_partition, gradient = _partition(tuple_utilities, self.present, self.sizes)
+        chosen = tuple_utilities[self.rows, self.best] - tuple_utilities[self.rows, self.worst]
+
+        gradient = -gradient
+        gradient[self.rows, self.best] += 1
+        gradient[self.rows, self.worst] -= 1
+        gradient *= self.counts[:, None]
+
+        system_gradient = np.bincount(self.items.ravel(), weights=gradient.ravel(), minlength=self.num_systems)
+        worker_gradient = np.zeros(0)
+        if self.num_workers:
+            worker_gradient = np.bincount(self.worker_items.ravel(), weights=gradient.ravel(), minlength=self.num_workers * self.num_systems)
+        return (self.counts * (chosen - log_partition)).sum(), np.concatenate([system_gradient[1:], worker_gradient])
+
+    def penalty(self, params):
+        # Ridge penalty of the normal prior on the worker effects and its gradient
+        _, worker_effects = self.unpack(params)
+        gradient = np.concatenate([np.zeros(self.num_systems - 1), worker_effects.ravel() / self.worker_variance])
+        return (worker_effects ** 2).sum() / (2 * self.worker_variance), gradient
+
+    def __call__(self, params):
+        log_likelihood, log_likelihood_gradient = self.log_likelihood(params)
+        penalty, penalty_gradient = self.penalty(params)
+        return penalty - log_likelihood, penalty_gradient - log_likelihood_gradient
+
+    def system_information(self, params):
+        # Expected information of the system utilities, the per tuple Hessian of the log partition
+        # function mapped onto the systems
+        positive, negative, positive_sums, negative_sums, partition, _, gradient = _partition(self.tuple_utilities(params), self.present, self.sizes)
+        curvature = (
+            np.einsum("tk,kl->tkl", positive * negative_sums + positive_sums * negative, np.eye(positive.shape[1]))
+            - positive[:, :, None] * negative[:, None, :] - negative[:, :, None] * positive[:, None, :]
+        )
+        tuple_information = curvature / partition[:, :, None] - gradient[:, :, None] * gradient[:, None, :]
+        tuple_information *= self.counts[:, None, None]
+
+        information = np.zeros((self.num_systems, self.num_systems))
+        np.add.at(information, (self.items[:, :, None], self.items[:, None, :]), tuple_information)
+        return information
+
+
+def fit_maxdiff(annotations, rank_name="rank", worker_effects=False, worker_variance=1.):
+    # Utilities are centered over the systems, the covariance is that of the centered utilities
+    # (without worker effects only)
+    annotations = as_annotation_set(annotations)
+    tuples = get_tuples(annotations, rank_name)
+    num_systems = len(annotations.system_names)
+    num_workers = len(annotations.annotator_names) if worker_effects else 0
+
+    objective = _MaxDiffObjective(tuples, num_systems, num_workers, worker_variance)
+    result = scipy.optimize.minimize(objective, np.zeros(num_systems - 1 + num_workers * num_systems), jac=True, method="L-BFGS-B")
+    utilities, effects = objective.unpack(result.x)
+
+    centering = np.eye(num_systems) - 1 / num_systems
+    covariance = None
+    if not worker_effects:
+        reference_covariance = np.zeros((num_systems, num_systems))
+        reference_covariance[1:, 1:] = np.linalg.inv(objective.system_information(result.x)[1:, 1:])
+        covariance = centering @ reference_covariance @ centering
+
+    return MaxDiffFit(
+        list(annotations.system_names), centering @ utilities, covariance,
+        pd.DataFrame(effects, index=annotations.annotator_names, columns=annotations.system_names) if worker_effects else None,
+        objective.log_likelihood(result.x)[0], objective.penalty(result.x)[0]
+    )
+
+
+def get_utility_table(fit):
+    table = pd.DataFrame({"utility": fit.utilities}, index=pd.Index(fit.systems, name="system"))
+    if fit.covariance is not None:
+        table["std_error"] = np.sqrt(np.diag(fit.covariance))
+    # Share of preference, the probability of being picked as best out of all systems
+    table["share"] = scipy.special.softmax(fit.utilities)
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation_file")
+    parser.add_argument("-w", dest="worker_effects", action="store_true", default=False)
+    parser.add_argument("--worker-variance", type=float, default=1.)
+
+    args = parser.parse_args()
+
+    annotations = load_annotations(args.annotation_file)
+    print(get_counting_table(annotations))
+    fit = fit_maxdiff(annotations, worker_effects=args.worker_effects, worker_variance=args.worker_variance)
+    print(get_utility_table(fit))
+    print(f"log-likelihood {fit.log_likelihood:.2f}")
+    if args.worker_effects:
+        print(f"worker effect penalty {fit.penalty:.2f}")
@@ -0,0 +1,221 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.special
+
+from .annotationutils import as_annotation_set, read_annotations
+from .ordinal import OrdinalModel, compute_covariance_factor, slope_matrix
+
+
+# Cumulative link mixed model score ~ system + (system|annotator) [+ (system|document)], the
+# model analyse-ordinal.r fits with clmm. The random effects are integrated out with a Laplace
+# approximation: the joint mode of fixed and (whitened) random effects is found with L-BFGS for
+# fixed covariance matrices, which are then updated from the modes and the per-group curvature
+# until they converge (Laplace-EM).
+
+
+_Data = namedtuple("_Data", [
+    "categories", "systems", "annotators", "documents",
+    "num_categories", "num_systems", "num_annotators", "num_documents"
+])
+
+
+def _encode(annotations, score_name):
+    annotations = as_annotation_set(annotations)
+    scores = annotations.get_scores(score_name)
+    observed = ~np.isnan(scores)
+
+    if score_name == "rank":
+        scores = -scores
+
+    score_levels, categories = np.unique(scores[observed], return_inverse=True)
+    # Codes index sorted names, like R factor levels, so the first system is the reference
+    system_codes = annotations.systems[observed].astype(int)
+    annotator_codes, _ = pd.factorize(annotations.annotators[observed])
+    document_codes, _ = pd.factorize(annotations.documents[observed])
+
+    data = _Data(
+        categories, system_codes, annotator_codes, document_codes,
+        len(score_levels), len(annotations.system_names), annotator_codes.max() + 1, document_codes.max() + 1
+    )
+    return data, list(annotations.system_names)
+
+
+def _group_sums(values, groups, systems, num_groups, num_systems):
+    return np.bincount(groups * num_systems + systems, weights=values, minlength=num_groups * num_systems).reshape(num_groups, num_systems)
+
+
+class _Objective:
+    def __init__(self, data, crossed):
+        self.data = data
+        self.crossed = crossed
+        self.loadings = {}
+
+        num_thresholds = data.num_categories - 1
+        self.slices = {
+            "thresholds": slice(0, num_thresholds),
+            "coefficients": slice(num_thresholds, num_thresholds + data.num_systems - 1),
+        }
+        offset = num_thresholds + data.num_systems - 1
+        self.slices["annotator"] = slice(offset, offset + data.num_annotators * data.num_systems)
+        offset += data.num_annotators * data.num_systems
+        if crossed:
+            self.slices["document"] = slice(offset, offset + data.num_documents * data.num_systems)
+            offset += data.num_documents * data.num_systems
+        self.num_params = offset
+
+    def groups(self):
+        groups = {"annotator": (self.data.annotators, self.data.num_annotators)}
+        if self.crossed:
+            groups["document"] = (self.data.documents, self.data.num_documents)
+        return groups
+
+    def thresholds(self, params):
+        raw = params[self.slices["thresholds"]]
+        # First threshold is free, the others are spaced by positive increments
+        return raw[0] + np.concatenate(([0.], np.cumsum(np.exp(raw[1:]))))
+
+    def coefficients(self, params):
+        return np.concatenate(([0.], params[self.slices["coefficients"]]))
+
+    def whitened_effects(self, params, name):
+        return params[self.slices[name]].reshape(-1, self.data.num_systems)
+
+    def linear_predictor(self, params):
+        data = self.data
+        eta = self.coefficients(params)[data.systems]
+        for name, (groups, _) in self.groups().items():
+            effects = self.whitened_effects(params, name) @ self.loadings[name]
+            eta = eta + effects[groups, data.systems]
+        return eta
+
+    def _link_terms(self, params):
+        data = self.data
+        thresholds = np.concatenate(([-np.inf], self.thresholds(params), [np.inf]))
+        eta = self.linear_predictor(params)
+
+        upper = thresholds[data.categories + 1] - eta
+        lower = thresholds[data.categories] - eta
+        cdf_upper = scipy.special.expit(upper)
+        cdf_lower = scipy.special.expit(lower)
+        pdf_upper = cdf_upper * (1 - cdf_upper)
+        pdf_lower = cdf_lower * (1 - cdf_lower)
+        probabilities = np.maximum(cdf_upper - cdf_lower, 1e-300)
+
+        return cdf_upper, cdf_lower, pdf_upper, pdf_lower, probabilities
+
+    def __call__(self, params):
+        data = self.data
+        cdf_upper, cdf_lower, pdf_upper, pdf_lower, probabilities = self._link_terms(params)
+
+        log_likelihood = np.log(probabilities).sum()
+        grad = np.zeros_like(params)
+
+        # Derivatives of the log likelihood with respect to thresholds and the linear predictor
+        threshold_grad = (
+            np.bincount(data.categories, weights=pdf_upper / probabilities, minlength=data.num_categories)[:-1]
+            - np.bincount(data.categories, weights=pdf_lower / probabilities, minlength=data.num_categories)[1:]
+        )
+        eta_grad = -(pdf_upper - pdf_lower) / probabilities
+
+        raw_thresholds = params[self.slices["thresholds"]]
+        raw_grad = np.cumsum(threshold_grad[::-1])[::-1]
+        raw_grad[1:] *= np.exp(raw_thresholds[1:])
+        grad[self.slices["thresholds"]] = raw_grad
+
+        system_grad = np.bincount(data.systems, weights=eta_grad, minlength=data.num_systems)
+        grad[self.slices["coefficients"]] = system_grad[1:]
+
+        penalty = 0.
+        for name, (groups, num_groups) in self.groups().items():
+            effects = self.whitened_effects(params, name)
+            group_grad = _group_sums(eta_grad, groups, data.systems, num_groups, data.num_systems) @ self.loadings[name].T
+            grad[self.slices[name]] = (group_grad - effects).ravel()
+            penalty += 0.5 * (effects ** 2).sum()
+
+        return penalty - log_likelihood, -grad
+
+    def curvature(self, params):
+        # Observed information of each observation with respect to its linear predictor
+        cdf_upper, cdf_lower, pdf_upper, pdf_lower, probabilities = self._link_terms(params)
+        pdf_diff_upper = pdf_upper * (1 - 2 * cdf_upper)
+        pdf_diff_lower = pdf_lower * (1 - 2 * cdf_lower)
+        return ((pdf_upper - pdf_lower) / probabilities) ** 2 - (pdf_diff_upper - pdf_diff_lower) / probabilities
+
+
+def _initial_params(objective):
+    data = objective.data
+    params = np.zeros(objective.num_params)
+
+    cumulative_proportions = np.cumsum(np.bincount(data.categories, minlength=data.num_categories))[:-1] / len(data.categories)
+    cumulative_proportions = np.clip(cumulative_proportions, 1e-3, 1 - 1e-3)
+    thresholds = np.maximum.accumulate(scipy.special.logit(cumulative_proportions))
+    increments = np.maximum(np.diff(thresholds), 1e-2)
+    params[objective.slices["thresholds"]] = np.concatenate(([thresholds[0]], np.log(increments)))
+
+    return params
+
+
+def fit_clmm(annotations, score_name="score", crossed=True, max_iter=200, tol=1e-4, initial_variance=0.5):
+    data, system_names = _encode(annotations, score_name)
+    objective = _Objective(data, crossed)
+    slopes = slope_matrix(data.num_systems)
+
+    covariances = {name: np.eye(data.num_systems) * initial_variance for name in objective.groups()}
+    factors = {name: compute_covariance_factor(cov) for name, cov in covariances.items()}
+    params = _initial_params(objective)
+
+    for _ in range(max_iter):
+        objective.loadings = {name: factor @ slopes for name, factor in factors.items()}
+        params = scipy.optimize.minimize(objective, params, jac=True, method="L-BFGS-B").x
+
+        curvature = objective.curvature(params)
+        new_covariances = {}
+        for name, (groups, num_groups) in objective.groups().items():
+            factor = factors[name]
+            loadings = objective.loadings[name]
+            effects = objective.whitened_effects(params, name) @ factor
+
+            # Posterior covariance of the whitened effects of each group under the Laplace approximation
+            weights = _group_sums(curvature, groups, data.systems, num_groups, data.num_systems)
+            precisions = np.einsum("es,gs,fs->gef", loadings, weights, loadings) + np.eye(data.num_systems)
+            posterior_covariances = factor.T @ np.linalg.inv(precisions) @ factor
+
+            new_covariances[name] = (effects.T @ effects + posterior_covariances.sum(axis=0)) / num_groups
+
+        change = max(np.abs(new_covariances[name] - covariances[name]).max() for name in covariances)
+
+        # Re-express the current modes in the whitened coordinates of the updated covariances
+        for name in covariances:
+            new_factor = compute_covariance_factor(new_covariances[name] + np.eye(data.num_systems) * 1e-8)
+            effects = objective.whitened_effects(params, name) @ factors[name]
+            params[objective.slices[name]] = np.linalg.lstsq(new_factor.T, effects.T, rcond=None)[0].T.ravel()
+            factors[name] = new_factor
+
+        covariances = new_covariances
+        if change < tol:
+            break
+
+    return OrdinalModel(
+        system_names,
+        objective.coefficients(params),
+        objective.thresholds(params),
+        covariances["annotator"],
+        covariances.get("document")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation_file")
+    parser.add_argument("out_file")
+    parser.add_argument("-s", dest="score_name", default="score")
+    parser.add_argument("-n", dest="nested", action="store_true", default=False)
+
+    args = parser.parse_args()
+
+    model = fit_clmm(read_annotations(args.annotation_file), args.score_name, crossed=not args.nested)
+    model.to_file(args.out_file)
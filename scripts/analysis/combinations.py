@@ -0,0 +1,109 @@
+import functools
+import math
+
+import numpy as np
+
+
+# Combinations unranked per batch, bounds the memory of exhaustive enumeration
+BATCH_SIZE = 10000
+MODES = ("exhaustive", "capped", "random")
+
+MAX_INT64_RANK = np.iinfo(np.int64).max
+
+
+@functools.lru_cache(maxsize=32)
+def binomial_table(n, k):
+    # table[m, j] = C(m, j) for m < n and j <= k, as Python integers once they overflow int64.
+    # Built once per (n, k) and shared by all unranking batches, so it is read-only.
+    dtype = np.int64 if math.comb(n, min(k, n // 2)) <= MAX_INT64_RANK else object
+    table = np.zeros((n + 1, k + 1), dtype=dtype)
+    for m in range(n + 1):
+        for j in range(min(m, k) + 1):
+            table[m, j] = math.comb(m, j)
+    table.setflags(write=False)
+    return table
+
+
+def unrank_combinations(ranks, n, k):
+    # k-subsets of range(n) at the given positions of the lexicographic order of it.combinations
+    table = binomial_table(n, k)
+    ranks = np.asarray(ranks, dtype=table.dtype).copy()
+    combinations = np.zeros((len(ranks), k), dtype=int)
+    num_chosen = np.zeros(len(ranks), dtype=int)
+
+    for element in range(n):
+        remaining = k - num_chosen
+        active = remaining > 0
+        # Number of combinations that take element next
+        count = table[n - element - 1, np.maximum(remaining - 1, 0)]
+        take = active & (ranks < count)
+
+        combinations[take, num_chosen[take]] = element
+        ranks = np.where(active & ~take, ranks - count, ranks)
+        num_chosen += take
+
+    return combinations
+
+
+def random_ranks(total, size, random_state):
+    if total <= MAX_INT64_RANK:
+        if hasattr(random_state, "integers"):
+            return random_state.integers(total, size=size)
+        return random_state.randint(total, size=size)
+
+    # Rejection sampling of Python integers from random bits, accepts at least half of the draws
+    num_bits = total.bit_length()
+    num_bytes = (num_bits + 7) // 8
+    ranks = []
+    while len(ranks) < size:
+        rank = int.from_bytes(random_state.bytes(num_bytes), "little") >> (8 * num_bytes - num_bits)
+        if rank < total:
+            ranks.append(rank)
+    return np.array(ranks, dtype=object)
+
+
+def distinct_random_ranks(total, size, random_state):
+    if 2 * size >= total:
+        return random_state.permutation(total)[:size]
+
+    ranks = {}
+    while len(ranks) < size:
+        ranks.update(dict.fromkeys(random_ranks(total, size - len(ranks), random_state).tolist()))
+    return np.array(list(ranks), dtype=np.int64 if total <= MAX_INT64_RANK else object)
+
+
+def iter_combinations(n, k, mode="capped", limit=None, random_state=None, batch_size=BATCH_SIZE):
+    # Yields (batch, k) arrays of indices into range(n).
+    # exhaustive: all combinations (the first limit ones if given) in it.combinations order
+    # capped: min(limit, C(n, k)) distinct combinations in random order
+    # random: limit independent uniform draws
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {MODES}")
+    if random_state is None:
+        random_state = np.random
+
+    total = math.comb(n, k)
+
+    if mode == "exhaustive":
+        stop = total if limit is None else min(limit, total)
+        for start in range(0, stop, batch_size):
+            yield unrank_combinations(range(start, min(start + batch_size, stop)), n, k)
+        return
+
+    if limit is None:
+        raise ValueError(f"{mode} sampling needs a limit")
+
+    if mode == "capped":
+        ranks = distinct_random_ranks(total, min(limit, total), random_state)
+    else:
+        ranks = random_ranks(total, limit, random_state)
+
+    for start in range(0, len(ranks), batch_size):
+        yield unrank_combinations(ranks[start:start + batch_size], n, k)
+
+
+def sample_combinations(n, k, mode="capped", limit=None, random_state=None):
+    batches = list(iter_combinations(n, k, mode, limit, random_state))
+    if len(batches) == 0:
+        return np.zeros((0, k), dtype=int)
+    return np.concatenate(batches)
@@ -0,0 +1,360 @@
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse
+import scipy.special
+import scipy.stats
+
+
+# Fixed-effects cumulative logit model P(score <= k) = F(threshold_k - coefficient_system), fitted
+# for many replicates at once. The linear predictor only depends on the system, so the likelihood
+# of a replicate is a function of its (system, category) counts and Newton steps for all replicates
+# are a handful of batched einsum/solve calls. Standard errors are cluster-robust over annotators
+# and documents (two-way clustering).
+
+ALPHA = 0.05
+ADJUSTMENTS = ("none", "holm", "bonferroni", "tukey", "fdr")
+
+# Contrasts of all system pairs as arrays: left and right index the systems, estimates and p-values
+# hold one row per replicate and one column per pair, positive estimates favour the left system.
+# Backends that only report significant directions have estimates of +1, -1 or 0.
+PairwiseResults = namedtuple("PairwiseResults", ["systems", "left", "right", "estimates", "p_values"])
+
+# Upper bound on the memory used for per-observation scores when computing robust covariances
+MAX_CHUNK_BYTES = 64 * 2 ** 20
+# Robust variances below this fraction of the model-based variance count as 0
+VARIANCE_TOLERANCE = 1e-8
+
+
+def holm_adjust(p_values):
+    p_values = np.asarray(p_values)
+    num_tests = p_values.shape[-1]
+
+    order = np.argsort(p_values, axis=-1)
+    scaled = np.take_along_axis(p_values, order, axis=-1) * (num_tests - np.arange(num_tests))
+    adjusted = np.empty_like(p_values)
+    np.put_along_axis(adjusted, order, np.minimum(np.maximum.accumulate(scaled, axis=-1), 1.), axis=-1)
+    return adjusted
+
+
+def fdr_adjust(p_values):
+    # Benjamini-Hochberg step-up adjustment, controls the false discovery rate
+    p_values = np.asarray(p_values)
+    num_tests = p_values.shape[-1]
+
+    order = np.argsort(p_values, axis=-1)
+    scaled = np.take_along_axis(p_values, order, axis=-1) * num_tests / np.arange(1, num_tests + 1)
+    adjusted = np.empty_like(p_values)
+    np.put_along_axis(adjusted, order, np.minimum(np.minimum.accumulate(scaled[..., ::-1], axis=-1)[..., ::-1], 1.), axis=-1)
+    return adjusted
+
+
+def adjust_p_values(z_values, num_systems, adjust="tukey"):
+    p_values = 2 * scipy.stats.norm.sf(np.abs(z_values))
+
+    if adjust == "none":
+        return p_values
+    elif adjust == "holm":
+        return holm_adjust(p_values)
+    elif adjust == "bonferroni":
+        return np.minimum(p_values * p_values.shape[-1], 1.)
+    elif adjust == "tukey":
+        return scipy.stats.studentized_range.sf(np.abs(z_values) * np.sqrt(2), num_systems, np.inf)
+    elif adjust == "fdr":
+        return fdr_adjust(p_values)
+    else:
+        raise ValueError(f"Unknown p-value adjustment {adjust}, expected one of {ADJUSTMENTS}")
+
+
+def encode_categories(scores):
+    # Categories are renumbered per replicate so that every remaining category is observed
+    levels, codes = np.unique(scores, return_inverse=True)
+    codes = codes.reshape(scores.shape)
+
+    observed = np.zeros((scores.shape[0], len(levels)), dtype=bool)
+    observed[np.arange(scores.shape[0])[:, None], codes] = True
+    codes = np.take_along_axis(np.cumsum(observed, axis=1) - 1, codes, axis=1)
+
+    return codes, observed.sum(axis=1), len(levels)
+
+
+def _jacobians(num_systems, num_categories):
+    # Derivatives of the upper and lower link arguments of each (system, category) cell with respect
+    # to the parameters [threshold_0 ... threshold_{K-2}, coefficient_1 ... coefficient_{S-1}]
+    num_params = num_categories - 1 + num_systems - 1
+    upper = np.zeros((num_systems, num_categories, num_params))
+    lower = np.zeros((num_systems, num_categories, num_params))
+
+    categories = np.arange(num_categories - 1)
+    upper[:, categories, categories] = 1.
+    lower[:, categories + 1, categories] = 1.
+
+    systems = np.arange(1, num_systems)
+    upper[systems, :, num_categories - 2 + systems] = -1.
+    lower[systems, :, num_categories - 2 + systems] = -1.
+
+    return upper, lower
+
+
+class _CellTerms:
+    def __init__(self, params, counts, active):
+        num_replicates, num_systems, num_categories = counts.shape
+
+        thresholds = np.where(active[:, :num_categories - 1], params[:, :num_categories - 1], np.inf)
+        infinities = np.full((num_replicates, 1), np.inf)
+        thresholds = np.concatenate((-infinities, thresholds, infinities), axis=1)
+        coefficients = np.concatenate((np.zeros((num_replicates, 1)), params[:, num_categories - 1:]), axis=1)
+
+        upper = thresholds[:, None, 1:] - coefficients[:, :, None]
+        lower = thresholds[:, None, :-1] - coefficients[:, :, None]
+
+        cdf_upper = scipy.special.expit(upper)
+        cdf_lower = scipy.special.expit(lower)
+        pdf_upper = cdf_upper * (1 - cdf_upper)
+        pdf_lower = cdf_lower * (1 - cdf_lower)
+
+        probabilities = cdf_upper - cdf_lower
+        valid = probabilities > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.log_likelihood = (counts * np.log(np.where(valid, probabilities, 1.))).sum(axis=(1, 2))
+        self.log_likelihood[((counts > 0) & ~valid).any(axis=(1, 2))] = -np.inf
+
+        ratio_upper = np.divide(pdf_upper, probabilities, out=np.zeros_like(pdf_upper), where=valid)
+        ratio_lower = np.divide(pdf_lower, probabilities, out=np.zeros_like(pdf_lower), where=valid)
+        slope_upper = np.divide(pdf_upper * (1 - 2 * cdf_upper), probabilities, out=np.zeros_like(pdf_upper), where=valid)
+        slope_lower = np.divide(pdf_lower * (1 - 2 * cdf_lower), probabilities, out=np.zeros_like(pdf_lower), where=valid)
+
+        # Per-observation first and second derivatives with respect to the link arguments
+        self.ratio_upper = ratio_upper
+        self.ratio_lower = ratio_lower
+        self.curvature_upper = slope_upper - ratio_upper ** 2
+        self.curvature_lower = -slope_lower - ratio_lower ** 2
+        self.curvature_cross = ratio_upper * ratio_lower
+
+    def cell_scores(self, jacobian_upper, jacobian_lower):
+        return (
+            np.einsum("rsk,skp->rskp", self.ratio_upper, jacobian_upper)
+            - np.einsum("rsk,skp->rskp", self.ratio_lower, jacobian_lower)
+        )
+
+    def hessian(self, counts, jacobian_upper, jacobian_lower):
+        cross = np.einsum("rsk,skp,skq->rpq", counts * self.curvature_cross, jacobian_upper, jacobian_lower)
+        return (
+            np.einsum("rsk,skp,skq->rpq", counts * self.curvature_upper, jacobian_upper, jacobian_upper)
+            + np.einsum("rsk,skp,skq->rpq", counts * self.curvature_lower, jacobian_lower, jacobian_lower)
+            + cross + cross.transpose(0, 2, 1)
+        )
+
+
+def _initial_params(counts, num_systems):
+    num_categories = counts.shape[2]
+    proportions = counts.sum(axis=1) / counts.sum(axis=(1, 2))[:, None]
+    cumulative = np.clip(np.cumsum(proportions, axis=1)[:, :-1], 1e-3, 1 - 1e-3)
+    thresholds = np.maximum.accumulate(scipy.special.logit(cumulative), axis=1)
+    thresholds += np.arange(num_categories - 1) * 1e-3
+
+    return np.concatenate((thresholds, np.zeros((counts.shape[0], num_systems - 1))), axis=1)
+
+
+def fit_cumulative_logit(counts, num_observed, max_iter=50, tol=1e-8, ridge=1e-6):
+    num_replicates, num_systems, num_categories = counts.shape
+    num_params = num_categories - 1 + num_systems - 1
+    jacobian_upper, jacobian_lower = _jacobians(num_systems, num_categories)
+
+    # Thresholds above the last observed category of a replicate are fixed at infinity
+    active = np.ones((num_replicates, num_params), dtype=bool)
+    active[:, :num_categories - 1] = np.arange(num_categories - 1) < (num_observed - 1)[:, None]
+    inactive_identity = np.einsum("rp,pq->rpq", ~active, np.eye(num_params))
+
+    params = _initial_params(counts, num_systems)
+    terms = _CellTerms(params, counts, active)
+
+    for _ in range(max_iter):
+        grad = np.einsum("rsk,rskp->rp", counts, terms.cell_scores(jacobian_upper, jacobian_lower)) * active
+        information = -terms.hessian(counts, jacobian_upper, jacobian_lower) * active[:, :, None] * active[:, None, :]
+        information += inactive_identity + ridge * np.eye(num_params)
+        step = np.linalg.solve(information, grad[:, :, None])[:, :, 0]
+
+        # Halve steps that do not improve the likelihood, replicate by replicate
+        step_size = np.ones(num_replicates)
+        for _ in range(30):
+            new_terms = _CellTerms(params + step_size[:, None] * step, counts, active)
+            worse = ~(new_terms.log_likelihood >= terms.log_likelihood - 1e-12)
+            if not worse.any():
+                break
+            step_size[worse] /= 2
+
+        params = params + step_size[:, None] * step
+        terms = _CellTerms(params, counts, active)
+
+        if np.abs(step_size[:, None] * step).max() < tol:
+            break
+
+    information = -terms.hessian(counts, jacobian_upper, jacobian_lower) * active[:, :, None] * active[:, None, :]
+    information += inactive_identity + ridge * np.eye(num_params)
+
+    return params, information, terms.cell_scores(jacobian_upper, jacobian_lower)
+
+
+def _cluster_meat(cell_scores, codes, systems, clusters):
+    num_replicates, num_observations = codes.shape
+    num_params = cell_scores.shape[-1]
+    cluster_codes, cluster_index = np.unique(clusters, return_inverse=True)
+    num_clusters = len(cluster_codes)
+    membership = scipy.sparse.csr_matrix(
+        (np.ones(num_observations), (cluster_index, np.arange(num_observations))),
+        shape=(num_clusters, num_observations)
+    )
+
+    meat = np.empty((num_replicates, num_params, num_params))
+    chunk_size = max(1, MAX_CHUNK_BYTES // (8 * num_observations * num_params))
+    for start in range(0, num_replicates, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        replicates = np.arange(num_replicates)[chunk]
+        observation_scores = cell_scores[replicates[:, None], systems[None, :], codes[chunk]]
+        chunk_replicates = len(replicates)
+
+        cluster_scores = membership @ observation_scores.transpose(1, 0, 2).reshape(num_observations, -1)
+        cluster_scores = cluster_scores.reshape(num_clusters, chunk_replicates, num_params)
+        meat[chunk] = np.einsum("grp,grq->rpq", cluster_scores, cluster_scores)
+
+    return meat * num_clusters / max(num_clusters - 1, 1)
+
+
+def robust_covariance(information, cell_scores, codes, systems, clusterings):
+    bread = np.linalg.inv(information)
+
+    meat = np.zeros_like(information)
+    for sign, clusters in clusterings:
+        meat += sign * _cluster_meat(cell_scores, codes, systems, clusters)
+    covariance = bread @ meat @ bread
+    if any(sign < 0 for sign, _ in clusterings):
+        # Two-way clustering subtracts the intersection and can leave a covariance that is not
+        # positive semi-definite, its negative eigenvalues are set to 0 (Cameron, Gelbach & Miller 2011)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        covariance = (eigenvectors * np.maximum(eigenvalues, 0.)[..., None, :]) @ np.swapaxes(eigenvectors, -1, -2)
+    return covariance
+
+
+def get_pairs(num_systems):
+    # Upper triangle of the system matrix, the pairs in it.combinations order
+    return np.triu_indices(num_systems, k=1)
+
+
+def pair_matrix(values, left, right, num_systems, antisymmetric=False, fill=0):
+    # (..., pairs) values as (..., systems, systems) matrices, mirrored with a flipped sign for
+    # antisymmetric values such as differences
+    values = np.asarray(values)
+    matrix = np.full(values.shape[:-1] + (num_systems, num_systems), fill, dtype=values.dtype)
+    matrix[..., left, right] = values
+    matrix[..., right, left] = -values if antisymmetric else values
+    return matrix
+
+
+def significance_matrix(results, alpha=ALPHA):
+    # (replicates, systems, systems) matrix, true where the row system is significantly better
+    significant = np.where(results.p_values < alpha, np.sign(results.estimates), 0).astype(np.int8)
+    return pair_matrix(significant, results.left, results.right, len(results.systems), antisymmetric=True) > 0
+
+
+def concat_results(results):
+    # Replicates of several PairwiseResults over the same pairs
+    first = results[0]
+    return first._replace(
+        estimates=np.concatenate([result.estimates for result in results]),
+        p_values=np.concatenate([result.p_values for result in results])
+    )
+
+
+def results_to_sets(results, alpha=ALPHA):
+    # Per replicate set of significant (better, worse) pairs and p-values keyed better-first when
+    # significant, in pair order otherwise
+    systems = np.asarray(results.systems, dtype=object)
+    significant = results.p_values < alpha
+    swap = significant & (results.estimates < 0)
+    firsts = np.where(swap, systems[results.right], systems[results.left])
+    seconds = np.where(swap, systems[results.left], systems[results.right])
+
+    converted = []
+    for replicate_significant, replicate_firsts, replicate_seconds, replicate_p_values in zip(significant, firsts, seconds, results.p_values.tolist()):
+        keys = list(zip(replicate_firsts, replicate_seconds))
+        differences = {key for key, is_significant in zip(keys, replicate_significant) if is_significant}
+        converted.append((differences, dict(zip(keys, replicate_p_values))))
+    return converted
+
+
+def sets_to_results(results, systems):
+    # Inverse of results_to_sets for backends reporting sets, replicates without results (failed
+    # fits) have p-values of 1
+    left, right = get_pairs(len(systems))
+    codes = {system: idx for idx, system in enumerate(systems)}
+    num_systems = len(systems)
+    directions = np.zeros((len(results), num_systems, num_systems))
+    p_values = np.ones((len(results), num_systems, num_systems))
+
+    for replicate, (differences, replicate_p_values) in enumerate(results):
+        if replicate_p_values is None:
+            continue
+        for (sys_a, sys_b), p_value in replicate_p_values.items():
+            p_values[replicate, codes[sys_a], codes[sys_b]] = p_values[replicate, codes[sys_b], codes[sys_a]] = p_value
+        for better, worse in differences:
+            directions[replicate, codes[better], codes[worse]] = 1
+            directions[replicate, codes[worse], codes[better]] = -1
+
+    return PairwiseResults(list(systems), left, right, directions[:, left, right], p_values[:, left, right])
+
+
+def _pair_variances(covariance, left, right, num_thresholds):
+    # Variances of the coefficient differences, the coefficient of the first system is fixed at 0
+    num_systems = covariance.shape[-1] - num_thresholds + 1
+    coefficient_covariance = np.zeros(covariance.shape[:-2] + (num_systems, num_systems))
+    coefficient_covariance[..., 1:, 1:] = covariance[..., num_thresholds:, num_thresholds:]
+    return coefficient_covariance[..., left, left] + coefficient_covariance[..., right, right] - 2 * coefficient_covariance[..., left, right]
+
+
+def pairwise_contrast_arrays(scores, systems, annotators, documents, system_names, adjust="tukey", nested=False):
+    # scores holds one row of observations per replicate, all replicates sharing the same
+    # system, annotator and document of each column
+    scores = np.asarray(scores)
+    systems = np.asarray(systems)
+    num_systems = len(system_names)
+
+    codes, num_observed, num_categories = encode_categories(scores)
+    counts = np.bincount(
+        ((np.arange(scores.shape[0])[:, None] * num_systems + systems) * num_categories + codes).ravel(),
+        minlength=scores.shape[0] * num_systems * num_categories
+    ).reshape(scores.shape[0], num_systems, num_categories).astype(float)
+
+    params, information, cell_scores = fit_cumulative_logit(counts, num_observed)
+
+    annotators = np.asarray(annotators)
+    documents = np.asarray(documents)
+    clusterings = [(1., annotators)]
+    if not nested:
+        # Two-way clustering: annotator + document - (annotator, document)
+        cells = np.unique(np.stack((annotators, documents), axis=1), axis=0, return_inverse=True)[1].ravel()
+        clusterings += [(1., documents), (-1., cells)]
+    covariance = robust_covariance(information, cell_scores, codes, systems, clusterings)
+
+    num_thresholds = num_categories - 1
+    coefficients = np.concatenate((np.zeros((scores.shape[0], 1)), params[:, num_thresholds:]), axis=1)
+
+    # Pairs follow the sorted level order R would use for the contrasts
+    order = np.argsort(system_names)
+    pair_left, pair_right = get_pairs(num_systems)
+    left, right = order[pair_left], order[pair_right]
+
+    estimates = coefficients[:, left] - coefficients[:, right]
+    variances = _pair_variances(covariance, left, right, num_thresholds)
+    # Pairs whose robust variance vanishes next to the model-based one, such as pairs seen by a
+    # single annotator, are degenerate fits and not significant
+    positive = variances > VARIANCE_TOLERANCE * _pair_variances(np.linalg.inv(information), left, right, num_thresholds)
+    z_values = np.zeros_like(estimates)
+    z_values[positive] = estimates[positive] / np.sqrt(variances[positive])
+    p_values = adjust_p_values(z_values, num_systems, adjust)
+
+    return PairwiseResults(list(system_names), left, right, estimates, p_values)
+
+
+def pairwise_contrasts(scores, systems, annotators, documents, system_names, adjust="tukey", nested=False):
+    return results_to_sets(pairwise_contrast_arrays(scores, systems, annotators, documents, system_names, adjust, nested))
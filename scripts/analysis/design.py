@@ -0,0 +1,173 @@
+import itertools as it
+import math
+
+import numpy as np
+import scipy.sparse
+
+
+# Annotation designs as int32 (annotators, documents) arrays with one row per annotator and
+# document, optionally followed by a (rows, systems) mask of the summaries shown. Cells of systems
+# an annotator does not see are sampled as 0 by OrdinalModel.sample_many.
+
+MAX_COMPLETE_BLOCKS = 100000
+
+
+def split_design(design):
+    # annotators, documents and the shown mask (None when every system is shown)
+    annotators, documents, *shown = design
+    return annotators, documents, shown[0] if shown else None
+
+
+def blocked_design(block_count, block_size, block_annotator_count):
+    # Every block of block_size documents is annotated by its own block_annotator_count annotators
+    blocks, block_annotators, block_documents = np.indices((block_count, block_annotator_count, block_size), dtype=np.int32).reshape(3, -1)
+    return blocks * block_annotator_count + block_annotators, blocks * block_size + block_documents
+
+
+def _is_prime(number):
+    return number > 1 and all(number % divisor for divisor in range(2, math.isqrt(number) + 1))
+
+
+def _projective_plane(order):
+    # Lines of PG(2, order) over the prime field: points and lines are the normalized nonzero
+    # vectors of F_order^3, a point lies on a line when their dot product vanishes
+    vectors = np.array(list(it.product(range(order), repeat=3)))[1:]
+    leading = vectors[np.arange(len(vectors)), (vectors != 0).argmax(axis=1)]
+    points = vectors[leading == 1]
+    incidence = (points @ points.T) % order == 0
+    return np.nonzero(incidence)[1].reshape(len(points), order + 1)
+
+
+def _affine_plane(order):
+    # Lines of AG(2, order): y = m * x + c for every slope m and intercept c, and x = c
+    x = np.arange(order)
+    slopes, intercepts = np.indices((order, order)).reshape(2, -1)
+    lines = x * order + (slopes[:, None] * x + intercepts[:, None]) % order
+    vertical = x[:, None] * order + x[None, :]
+    return np.concatenate([lines, vertical])
+
+
+def bibd_blocks(num_documents, block_size):
+    # Blocks of a balanced incomplete block design, every pair of documents shares the same number
+    # of blocks. Projective and affine planes of prime order are used where they fit, all block_size
+    # subsets otherwise.
+    order = block_size - 1
+    if _is_prime(order) and num_documents == order ** 2 + order + 1:
+        blocks = _projective_plane(order)
+    elif _is_prime(block_size) and num_documents == block_size ** 2:
+        blocks = _affine_plane(block_size)
+    elif math.comb(num_documents, block_size) <= MAX_COMPLETE_BLOCKS:
+        blocks = np.array(list(it.combinations(range(num_documents), block_size)))
+    else:
+        raise ValueError(f"No balanced incomplete block design of {num_documents} documents in blocks of {block_size} available")
+    return np.sort(blocks, axis=1).astype(np.int32)
+
+
+def bibd_design(num_documents, block_size, replications=1, block_annotator_count=1):
+    # Every annotator sees one block of a BIBD, copies of the design use disjoint documents
+    blocks = bibd_blocks(num_documents, block_size)
+    blocks = (blocks[None] + num_documents * np.arange(replications, dtype=np.int32)[:, None, None]).reshape(-1, block_size)
+    documents = np.repeat(blocks, block_annotator_count, axis=0).ravel()
+    annotators = np.repeat(np.arange(len(blocks) * block_annotator_count, dtype=np.int32), block_size)
+    return annotators, documents
+
+
+def get_overlaps(annotators, documents):
+    # Sparse (annotators, annotators) matrix of the number of shared documents
+    incidence = scipy.sparse.csr_matrix((np.ones(len(annotators)), (annotators, documents)))
+    overlaps = (incidence @ incidence.T).tocsr()
+    overlaps.setdiag(0)
+    overlaps.eliminate_zeros()
+    return overlaps
+
+
+def _get_violations(slots, max_overlap):
+    # Annotators that got a document twice or share more than max_overlap documents with another
+    ordered = np.sort(slots, axis=1)
+    violations = (np.diff(ordered, axis=1) == 0).any(axis=1)
+    if max_overlap is not None:
+        annotators = np.repeat(np.arange(len(slots)), slots.shape[1])
+        overlaps = get_overlaps(annotators, slots.ravel())
+        violations |= overlaps.max(axis=1).toarray().ravel() > max_overlap
+    return violations
+
+
+def _check_random_design(num_documents, documents_per_annotator, annotators_per_document, max_overlap):
+    # Necessary conditions, designs failing them cannot be repaired
+    num_annotators = num_documents * annotators_per_document // documents_per_annotator
+    if documents_per_annotator > num_documents:
+        raise ValueError(f"{documents_per_annotator} documents per annotator but only {num_documents} documents")
+    if annotators_per_document > num_annotators:
+        raise ValueError(f"{annotators_per_document} annotators per document but only {num_annotators} annotators")
+    if max_overlap is None or annotators_per_document == 1:
+        return
+    if max_overlap < 1:
+        raise ValueError(f"max_overlap {max_overlap} leaves no document to share with the other annotators of a document")
+
+    # The documents of an annotator are seen documents_per_annotator * (annotators_per_document - 1)
+    # times by others, at most max_overlap times by each of them
+    num_partners = math.ceil(documents_per_annotator * (annotators_per_document - 1) / max_overlap)
+    if num_partners > num_annotators - 1:
+        raise ValueError(
+            f"max_overlap {max_overlap} needs at least {num_partners} other annotators per annotator, "
+            f"the design has {num_annotators - 1}"
+        )
+
+
+def random_design(num_documents, documents_per_annotator, annotators_per_document, max_overlap=None, random_state=None, max_attempts=1000):
+    # Documents are dealt out randomly, each to annotators_per_document different annotators who
+    # each see documents_per_annotator documents. Annotators breaking the constraints swap a random
+    # document with a random annotation of the whole design until none are left.
+    if random_state is None:
+        random_state = np.random
+    num_slots = num_documents * annotators_per_document
+    if num_slots % documents_per_annotator:
+        raise ValueError(f"{num_slots} annotations cannot be split into sets of {documents_per_annotator} documents")
+
+    _check_random_design(num_documents, documents_per_annotator, annotators_per_document, max_overlap)
+
+    slots = random_state.permutation(np.repeat(np.arange(num_documents, dtype=np.int32), annotators_per_document))
+    slots = slots.reshape(-1, documents_per_annotator)
+    for _ in range(max_attempts):
+        violations = np.flatnonzero(_get_violations(slots, max_overlap))
+        if len(violations) == 0:
+            break
+        sources = violations * documents_per_annotator + (random_state.random(len(violations)) * documents_per_annotator).astype(int)
+        targets = random_state.choice(num_slots, len(violations), replace=False)
+        # Every slot takes part in at most one swap
+        targets = targets[~np.isin(targets, sources)]
+        sources = sources[:len(targets)]
+        flat = slots.reshape(-1)
+        flat[sources], flat[targets] = flat[targets], flat[sources]
+    else:
+        duplicates = np.flatnonzero(_get_violations(slots, None))
+        constraint = f"{len(duplicates)} annotators see a document twice" if len(duplicates) else f"annotators share more than {max_overlap} documents"
+        raise ValueError(f"No random design found in {max_attempts} attempts, {constraint}")
+
+    annotators = np.repeat(np.arange(len(slots), dtype=np.int32), documents_per_annotator)
+    return annotators, np.sort(slots, axis=1).ravel()
+
+
+def system_subset_design(design, num_systems, systems_per_annotator, random_state=None, balanced=True):
+    # Every annotator sees only systems_per_annotator of the systems. Balanced designs cycle through
+    # all subsets, so every system and pair of systems is seen by about the same number of annotators.
+    if random_state is None:
+        random_state = np.random
+    annotators, documents, _ = split_design(design)
+    num_annotators = np.max(annotators) + 1
+
+    if balanced:
+        subsets = np.array(list(it.combinations(range(num_systems), systems_per_annotator)))
+        annotator_subsets = subsets[random_state.permutation(num_annotators) % len(subsets)]
+    else:
+        annotator_subsets = np.argsort(random_state.random((num_annotators, num_systems)), axis=1)[:, :systems_per_annotator]
+
+    shown = np.zeros((num_annotators, num_systems), dtype=bool)
+    shown[np.arange(num_annotators)[:, None], annotator_subsets] = True
+    return annotators, documents, shown[annotators]
+
+
+def get_num_annotations(design, num_systems):
+    # Number of (annotator, document, system) cells that are scored
+    annotators, _, shown = split_design(design)
+    return len(annotators) * num_systems if shown is None else int(shown.sum())
@@ -1,52 +1,171 @@
 import argparse
 
-import pandas as pd
 import numpy as np
+import pandas as pd
+import scipy.special
+import scipy.stats
 
+from . import contrasts
+from . import design as designs
 from . import ordinal
-from . import power
+from . import regression
+from . import execution
 
-from multiprocessing import Pool
-import itertools as it
 
-from concurrent.futures import ThreadPoolExecutor
+def test_design_power(model, design, nested=False, num_iters=100, backend=None, seed=None, num_workers=None, adjust="none"):
+    # Long frame of the p-values of every replicate and pair, indexed better-first where the
+    # difference is significant and in pair order otherwise
+    results = regression.fit_simulation_arrays(model, design, num_iters, backend, nested=nested, adjust=adjust, seed=seed, num_workers=num_workers)
+    systems = np.asarray(results.systems, dtype=object)
+    swap = (results.p_values < contrasts.ALPHA) & (results.estimates < 0)
 
-import os
+    df = pd.DataFrame.from_dict({"p_value": results.p_values.ravel()})
+    df.index = pd.MultiIndex.from_arrays([
+        np.where(swap, systems[results.right], systems[results.left]).ravel(),
+        np.where(swap, systems[results.left], systems[results.right]).ravel()
+    ])
 
+    return df
 
-def regress_on_sample(vals):
-    model, design, nested = vals
-    np.random.seed()
-    sample_df = model.sample(design)
-    diffs, p_values = power.run_regression(sample_df, nested=nested)
 
-    return diffs, p_values
+def get_correct_pairs(model):
+    coefficients = np.asarray(model.coefficients)
+    better, worse = np.nonzero(coefficients[:, None] > coefficients[None, :])
+    return [(model.systems[x], model.systems[y]) for x, y in zip(better, worse)]
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+    proportion = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (proportion + z ** 2 / (2 * trials)) / denominator
+    half_width = z / denominator * np.sqrt(proportion * (1 - proportion) / trials + z ** 2 / (4 * trials ** 2))
+    return center - half_width, center + half_width
+
+
+def estimate_power_adaptive(model, design, pairs=None, nested=False, ci_width=0.1, batch_size=100, max_iters=2000, backend="contrast", seed=None, num_workers=None, adjust="none"):
+    # Keeps simulating until the Wilson interval of every pair is narrower than ci_width
+    if pairs is None:
+        pairs = get_correct_pairs(model)
+    if len(pairs) == 0:
+        # Nothing to estimate, e.g. for a model without differences between the systems
+        return pd.DataFrame(
+            {"power": [], "lower": [], "upper": [], "iterations": []},
+            index=pd.MultiIndex.from_tuples([], names=["better", "worse"])
+        )
+    seed = execution.get_seed_sequence(seed)
+    better, worse = map(np.array, zip(*pairs))
+    better, worse = pd.Index(model.systems).get_indexer(better), pd.Index(model.systems).get_indexer(worse)
+
+    successes = np.zeros(len(pairs))
+    num_iters = 0
+    while num_iters < max_iters:
+        batch = min(batch_size, max_iters - num_iters)
+        results = regression.fit_simulation_arrays(model, design, batch, backend, nested=nested, adjust=adjust, seed=seed.spawn(1)[0], num_workers=num_workers)
+        # Significance matrices are in the system order of the results
+        order = pd.Index(results.systems).get_indexer(model.systems)
+        successes += contrasts.significance_matrix(results)[:, order[better], order[worse]].sum(axis=0)
+        num_iters += batch
+
+        lower, upper = wilson_interval(successes, num_iters)
+        if (upper - lower).max() <= ci_width:
+            break
+
+    df = pd.DataFrame.from_dict({"power": successes / num_iters, "lower": lower, "upper": upper, "iterations": num_iters})
+    df.index = pd.MultiIndex.from_tuples(pairs, names=["better", "worse"])
+    return df
 
 
-def test_design_power(model, design, nested=False, num_iters=100):
+DESIGNS = ("blocked", "bibd", "random")
+
+
+def make_design(kind, block_count, block_size, block_annotator_count, num_systems=None, systems_per_annotator=None, bibd_documents=None, max_overlap=None, random_state=None):
+    # block_count copies of block_size documents seen by block_annotator_count annotators each:
+    # separate blocks, copies of a BIBD over bibd_documents documents or a random assignment of
+    # block_count * block_size documents. Annotators optionally see only some of the systems.
+    if kind == "blocked":
+        design = designs.blocked_design(block_count, block_size, block_annotator_count)
+    elif kind == "bibd":
+        if bibd_documents is None:
+            raise ValueError("A bibd design needs the number of documents of the BIBD, bibd_documents")
+        design = designs.bibd_design(bibd_documents, block_size, block_count, block_annotator_count)
+    elif kind == "random":
+        design = designs.random_design(block_count * block_size, block_size, block_annotator_count, max_overlap, random_state)
+    else:
+        raise ValueError(f"Unknown design {kind}, expected one of {DESIGNS}")
+
+    if systems_per_annotator is not None and num_systems is None:
+        raise ValueError("systems_per_annotator needs the number of systems, num_systems")
+    if systems_per_annotator is not None and systems_per_annotator < num_systems:
+        design = designs.system_subset_design(design, num_systems, systems_per_annotator, random_state)
+    return design
+
+
+def find_minimum_blocks(model, target_power, block_size=5, block_annotator_count=3, pairs=None, max_blocks=64, method="bisect", seed=None, design_factory=None, **power_args):
+    # Smallest block count whose estimated power reaches target_power for all pairs, assuming
+    # power grows monotonically with the number of blocks. design_factory(block_count) replaces
+    # the separate blocks of create_design.
+    if pairs is None:
+        pairs = get_correct_pairs(model)
+    if len(pairs) == 0:
+        raise ValueError("No pairs to reach the target power for, the model has no differences between the systems")
+    nested = block_annotator_count == 1
+    entropy = execution.get_seed_sequence(seed).entropy
+    powers = {}
+
+    def get_power(block_count):
+        if block_count not in powers:
+            design_seed = np.random.SeedSequence(entropy, spawn_key=(block_count, block_size, block_annotator_count))
+            if design_factory is None:
+                design = ordinal.create_design(block_count, block_size, block_annotator_count)
+            else:
+                design = design_factory(block_count)
+            powers[block_count] = estimate_power_adaptive(model, design, pairs, nested=nested, seed=design_seed, **power_args)["power"]
+        return powers[block_count]
+
+    if method == "bisect":
+        if get_power(max_blocks).min() < target_power:
+            return None
+
+        low, high = 0, max_blocks
+        while high - low > 1:
+            mid = (low + high) // 2
+            if get_power(mid).min() >= target_power:
+                high = mid
+            else:
+                low = mid
+        return high
+
+    elif method == "curve":
+        # Fit power = expit(a + b * log(effort)) per pair on a log-spaced grid and invert it
+        block_counts = np.unique(np.geomspace(1, max_blocks, num=6).round().astype(int))
+        powers_grid = np.stack([get_power(block_count).to_numpy() for block_count in block_counts])
+        log_effort = np.log(block_counts)
+
+        required = []
+        for pair_powers in powers_grid.T:
+            logits = scipy.special.logit(np.clip(pair_powers, 0.01, 0.99))
+            slope, intercept = np.polyfit(log_effort, logits, 1)
+            if slope <= 0:
+                return None
+            required.append(np.exp((scipy.special.logit(target_power) - intercept) / slope))
+
+        block_count = int(np.ceil(max(required)))
+        return block_count if block_count <= max_blocks else None
+
+    else:
+        raise ValueError(f"Unknown search method {method}, expected bisect or curve")
+
+
+def find_cheapest_design(model, target_power, layouts=((5, 3), (5, 1)), pairs=None, max_blocks=64, method="bisect", **power_args):
+    # layouts are (documents per block, annotators per block); effort counts annotations per system
     results = []
-    index = []
-    idx = 0
-
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        for diffs, p_values in executor.map(regress_on_sample, [(model, design, nested)] * num_iters):
-    #with Pool() as pool:
-    #    for diffs, p_values in pool.imap_unordered(regress_on_sample, [(model, design, nested)] * num_iters):
-            idx += 1
-            print(f"{idx}/{num_iters}")
-            for (left_system, right_system), p_val in p_values.items():
-                results.append(p_val)
-                index.append((left_system, right_system))
-
-            if len(p_values) == 0:
-                for sys_1, sys_2 in it.combinations(model.systems, 2):
-                    results.append(1.0)
-                    index.append((sys_1, sys_2))
-
-    df = pd.DataFrame.from_dict({"p_value": results})
-    df.index = pd.MultiIndex.from_tuples(index)
+    for block_size, block_annotator_count in layouts:
+        block_count = find_minimum_blocks(model, target_power, block_size, block_annotator_count, pairs, max_blocks, method, **power_args)
+        effort = np.nan if block_count is None else block_count * block_size * block_annotator_count
+        results.append({"blocks": block_count, "documents": block_size, "annotators": block_annotator_count, "effort": effort})
 
-    return df
+    return pd.DataFrame.from_records(results).sort_values("effort")
 
 
 if __name__ == "__main__":
@@ -57,8 +176,16 @@ if __name__ == "__main__":
     parser.add_argument("-b", dest="num_blocks", default=20, type=int)
     parser.add_argument("-d", dest="num_docs", default=5, type=int)
     parser.add_argument("-a", dest="num_annotators", default=3, type=int)
+    parser.add_argument("--design", dest="design", default="blocked", choices=DESIGNS)
+    parser.add_argument("--bibd-documents", dest="bibd_documents", default=None, type=int)
+    parser.add_argument("--max-overlap", dest="max_overlap", default=None, type=int)
+    parser.add_argument("--systems-per-annotator", dest="systems_per_annotator", default=None, type=int)
     parser.add_argument("-z", dest="zero_coefficients", default=False, action="store_true")
     parser.add_argument("-n", dest="condition_nested", default=False, action="store_true")
+    parser.add_argument("--backend", dest="backend", default="rworker", choices=regression.BACKENDS)
+    parser.add_argument("--adjust", dest="adjust", default="none", choices=contrasts.ADJUSTMENTS)
+    parser.add_argument("-s", dest="seed", default=None, type=int)
+    parser.add_argument("-j", dest="num_workers", default=None, type=int)
 
     args = parser.parse_args()
 
@@ -67,7 +194,11 @@ if __name__ == "__main__":
     if args.zero_coefficients:
         model.zero_coefficients()
 
-    analysis_result = test_design_power(model, ordinal.create_design(args.num_blocks, args.num_docs, args.num_annotators), nested=args.num_annotators == 1)
+    design = make_design(
+        args.design, args.num_blocks, args.num_docs, args.num_annotators, len(model.systems), args.systems_per_annotator,
+        args.bibd_documents, args.max_overlap, np.random.default_rng(args.seed)
+    )
+    analysis_result = test_design_power(model, design, nested=args.num_annotators == 1, backend=args.backend, seed=args.seed, num_workers=args.num_workers, adjust=args.adjust)
     analysis_result.to_csv(args.out_file)
 
 
@@ -0,0 +1,46 @@
+import os
+import itertools as it
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Replicates simulated by one task. Tasks, and the random streams spawned for them, only depend on
+# the number of replicates, never on the number of workers, so a seed reproduces the same results
+# on any machine.
+REPLICATES_PER_TASK = 25
+
+
+def split_replicates(num_reps, task_size=REPLICATES_PER_TASK):
+    return [min(task_size, num_reps - start) for start in range(0, num_reps, task_size)]
+
+
+def get_seed_sequence(seed):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def _run_task(args):
+    func, seed_sequence, task = args
+    return func(task, np.random.default_rng(seed_sequence))
+
+
+def run_tasks(func, tasks, seed=None, num_workers=None, chunksize=None):
+    # func(task, random_state) has to be a module level function so that it can be pickled
+    tasks = list(tasks)
+    seed_sequences = get_seed_sequence(seed).spawn(len(tasks))
+    task_args = list(zip(it.repeat(func), seed_sequences, tasks))
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(tasks))
+
+    if num_workers <= 1:
+        return [_run_task(args) for args in task_args]
+
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (4 * num_workers))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(_run_task, task_args, chunksize=chunksize))
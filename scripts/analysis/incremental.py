@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .agreement import METRICS, alpha_from_coincidences, get_cluster_coincidences
+from .ingest import PROTOCOLS, SYSTEMS, BWSProtocol, get_batch_paths, parse_files, read_shuffle_table
+
+
+# Running aggregates of a crowdsourcing round that is still collecting batches. The state file
+# remembers the ingested batch files, so an update only parses the new ones, and keeps per
+# (document, system) sums, counts, best-worst tallies and value counts together with the
+# coincidence matrix of the agreement. Updates and queries touch only the new units.
+
+STATE_VERSION = 1
+ARRAYS = ("sums", "counts", "best", "worst", "unit_counts", "coincidences")
+DOCUMENT_ARRAYS = ("sums", "counts", "best", "worst", "unit_counts")
+
+
+class IngestState:
+    __slots__ = ("protocol_name", "systems", "batches", "num_annotators", "num_documents") + ARRAYS
+
+    def __init__(self, protocol_name, systems=SYSTEMS):
+        self.protocol_name = protocol_name
+        self.systems = list(systems)
+        # {file name: {"mtime_ns", "size", "first_annotator", "num_annotators"}}
+        self.batches = {}
+        self.num_annotators = 0
+
+        num_values = len(self.protocol.values)
+        # Indexed by document number, the first num_documents rows are in use and the capacity
+        # doubles when a batch needs more, so updates do not copy all documents
+        self.num_documents = 0
+        self.sums = np.zeros((0, len(self.systems)))
+        self.counts = np.zeros((0, len(self.systems)), dtype=np.int64)
+        self.best = np.zeros((0, len(self.systems)), dtype=np.int64)
+        self.worst = np.zeros((0, len(self.systems)), dtype=np.int64)
+        self.unit_counts = np.zeros((0, len(self.systems), num_values), dtype=np.int64)
+        self.coincidences = np.zeros((num_values, num_values))
+
+    @property
+    def protocol(self):
+        return PROTOCOLS[self.protocol_name]
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["version"] != STATE_VERSION:
+                raise ValueError(f"{path} has state version {meta['version']}, expected {STATE_VERSION}")
+            state = cls(meta["protocol"], meta["systems"])
+            state.batches = meta["batches"]
+            state.num_annotators = meta["num_annotators"]
+            for name in ARRAYS:
+                setattr(state, name, data[name])
+        state.num_documents = len(state.sums)
+        return state
+
+    def save(self, path):
+        # Replaced atomically, an interrupted save keeps the previous state
+        path = Path(path)
+        meta = {
+            "version": STATE_VERSION,
+            "protocol": self.protocol_name,
+            "systems": self.systems,
+            "batches": self.batches,
+            "num_annotators": self.num_annotators,
+        }
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, meta=json.dumps(meta), coincidences=self.coincidences, **{name: getattr(self, name)[:self.num_documents] for name in DOCUMENT_ARRAYS})
+        os.replace(temp_path, path)
+
+    def get_new_paths(self, directory):
+        paths = []
+        for path in get_batch_paths(directory):
+            stat = path.stat()
+            batch = self.batches.get(path.name)
+            if batch is None:
+                paths.append(path)
+            elif (batch["mtime_ns"], batch["size"]) != (stat.st_mtime_ns, stat.st_size):
+                raise ValueError(f"{path} changed since it was ingested, rebuild the state")
+        return paths
+
+    def _grow(self, num_documents):
+        if num_documents > len(self.sums):
+            capacity = max(num_documents, 2 * len(self.sums))
+            for name in DOCUMENT_ARRAYS:
+                array = getattr(self, name)
+                grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+                grown[:self.num_documents] = array[:self.num_documents]
+                setattr(self, name, grown)
+        self.num_documents = max(self.num_documents, num_documents)
+
+    def add_scores(self, documents, scores):
+        # scores (workers, documents, systems) of one batch, nan where missing
+        protocol = self.protocol
+        self._grow(documents.max() + 1)
+
+        observed = ~np.isnan(scores)
+        _, document_index, systems = np.nonzero(observed)
+        documents = documents[document_index]
+        values = scores[observed]
+        categories = np.searchsorted(protocol.values, values)
+        if (np.asarray(protocol.values)[np.minimum(categories, len(protocol.values) - 1)] != values).any():
+            raise ValueError(f"Scores outside of {protocol.values}")
+
+        np.add.at(self.sums, (documents, systems), values)
+        np.add.at(self.counts, (documents, systems), 1)
+        if isinstance(protocol, BWSProtocol):
+            np.add.at(self.best, (documents, systems), values == protocol.BEST)
+            np.add.at(self.worst, (documents, systems), values == protocol.WORST)
+
+        # Coincidences of the touched units are swapped for their updated ones
+        units = np.unique(documents.astype(np.int64) * len(self.systems) + systems)
+        unit_documents, unit_systems = np.divmod(units, len(self.systems))
+        single_cluster = np.zeros(len(units), dtype=int)
+        num_values = len(protocol.values)
+
+        self.coincidences -= get_cluster_coincidences(self.unit_counts[unit_documents, unit_systems], single_cluster).reshape(num_values, num_values)
+        np.add.at(self.unit_counts, (documents, systems, categories), 1)
+        self.coincidences += get_cluster_coincidences(self.unit_counts[unit_documents, unit_systems], single_cluster).reshape(num_values, num_values)
+
+    def update(self, directory, shuffle_table, workers_per_file=None, num_workers=None):
+        # Parses the batch files that are not in the state yet, returns their paths
+        paths = self.get_new_paths(directory)
+        if not paths:
+            return paths
+
+        lookup = read_shuffle_table(shuffle_table)
+        results = parse_files(paths, self.protocol, lookup, len(self.systems), workers_per_file, num_workers)
+        for path, (documents, scores, _, _) in zip(paths, results):
+            self.add_scores(documents, scores)
+            stat = path.stat()
+            self.batches[path.name] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "first_annotator": self.num_annotators + 1,
+                "num_annotators": len(scores),
+            }
+            self.num_annotators += len(scores)
+        return paths
+
+    def get_system_table(self):
+        # Rows beyond num_documents are zero
+        counts = self.counts.sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            table = pd.DataFrame({"mean": self.sums.sum(axis=0) / counts, "count": counts}, index=pd.Index(self.systems, name="system"))
+            if isinstance(self.protocol, BWSProtocol):
+                # Counting score, times best minus times worst over times shown
+                table["best"] = self.best.sum(axis=0)
+                table["worst"] = self.worst.sum(axis=0)
+                table["bws_score"] = (table["best"] - table["worst"]) / counts
+        return table
+
+    def get_document_means(self):
+        documents = np.flatnonzero(self.counts.sum(axis=1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = self.sums[documents] / self.counts[documents]
+        return pd.DataFrame(means, index=pd.Index(documents, name="document"), columns=pd.Index(self.systems, name="system"))
+
+    def get_alpha(self, metric="ordinal"):
+        return float(alpha_from_coincidences(self.coincidences, np.asarray(self.protocol.values, dtype=float), metric))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("protocol", choices=PROTOCOLS)
+    parser.add_argument("directory")
+    parser.add_argument("shuffle_table")
+    parser.add_argument("state_file")
+    parser.add_argument("--systems", nargs="+", default=list(SYSTEMS))
+    parser.add_argument("--workers-per-file", type=int, default=None)
+    parser.add_argument("--rebuild", action="store_true", default=False)
+    parser.add_argument("-m", dest="metric", default="ordinal", choices=METRICS)
+    parser.add_argument("-j", dest="num_workers", type=int, default=None)
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.state_file) and not args.rebuild:
+        state = IngestState.load(args.state_file)
+        if state.protocol_name != args.protocol:
+            raise ValueError(f"{args.state_file} holds {state.protocol_name} annotations")
+    else:
+        state = IngestState(args.protocol, args.systems)
+
+    new_paths = state.update(args.directory, args.shuffle_table, args.workers_per_file, args.num_workers)
+    if new_paths:
+        state.save(args.state_file)
+
+    print(f"{len(new_paths)} new batches, {len(state.batches)} batches, {state.num_annotators} annotators")
+    print(state.get_system_table())
+    print(f"alpha ({args.metric}) {state.get_alpha(args.metric):.4f}")
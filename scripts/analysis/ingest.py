@@ -0,0 +1,254 @@
+import abc
+import argparse
+import os
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Turns the exported crowdsourcing sheets into the long format of final_result. Every sheet holds
+# the answers for a range of documents ("Likert 1-5.csv", "BWS 11-15.csv"), one row per worker,
+# with the summaries of each document shown in the shuffled order of the question mapping table.
+# Only absolute imports, the read_csv_* scripts import this module from outside the package.
+
+SYSTEMS = ("pegasus", "prophetnet", "bart", "bertextabs")
+FILE_PATTERN = re.compile(r"(\d+)\s*-\s*(\d+)\s*\.csv$")
+WORKER_COLUMN = "Turker ID"
+TIME_COLUMN = "Timestamp"
+# Questions that are not part of the annotation
+IGNORED_QUESTIONS = ("understand the instructions", "comments")
+# UTC offsets of the named zones of the exports, North American abbreviations (AST is Atlantic
+# Standard Time)
+ZONE_OFFSETS = {
+    "UTC": "+0000", "GMT": "+0000", "AST": "-0400", "ADT": "-0300", "EST": "-0500", "EDT": "-0400",
+    "CST": "-0600", "CDT": "-0500", "MST": "-0700", "MDT": "-0600", "PST": "-0800", "PDT": "-0700",
+}
+
+
+def read_shuffle_table(path):
+    # lookup[document, position] is the index of the system shown at position (1-indexed) for
+    # document, -1 where the table has no entry
+    table = pd.read_csv(path, index_col=0, encoding="utf-8-sig", dtype=str)
+    table = table.loc[table.index.notna(), ~table.columns.str.startswith("Unnamed")]
+
+    documents = table.columns.astype(int).to_numpy()
+    positions = table.index.str.extract(r"(\d+)\s*$", expand=False).astype(int).to_numpy()
+    values = table.to_numpy()
+    present = pd.notna(values)
+
+    lookup = np.full((documents.max() + 1, positions.max() + 1), -1)
+    row_index, column_index = np.nonzero(present)
+    lookup[documents[column_index], positions[row_index]] = values[present].astype(int) - 1
+    return lookup
+
+
+def get_document_range(path):
+    match = FILE_PATTERN.search(Path(path).name)
+    if match is None:
+        raise ValueError(f"Cannot read the document range from {path}")
+    first, last = map(int, match.groups())
+    return np.arange(first, last + 1)
+
+
+def parse_timestamps(timestamps):
+    # "2021/04/26 6:27:11 PM GMT+8" or "2021/05/09 6:56:02 PM AST", timestamps in other formats
+    # are left empty with a warning
+    offsets = timestamps.str.replace(r"GMT([+-])(\d+)$", lambda match: f"{match[1]}{int(match[2]):02d}00", regex=True)
+    offsets = offsets.str.replace(r"\b([A-Z]{3})$", lambda match: ZONE_OFFSETS.get(match[1], match[1]), regex=True)
+    parsed = pd.to_datetime(offsets, format="%Y/%m/%d %I:%M:%S %p %z", errors="coerce", utc=True)
+
+    num_failed = int((parsed.isna() & timestamps.notna()).sum())
+    if num_failed:
+        warnings.warn(f"{num_failed} of {len(timestamps)} timestamps could not be parsed and are left empty")
+    return parsed
+
+
+class Protocol(abc.ABC):
+    score_name = "score"
+    # Answer columns per document
+    answers_per_document = 4
+    values = ()
+    # Submissions kept per sheet (the latest ones), None keeps all of them
+    workers_per_file = None
+
+    @abc.abstractmethod
+    def get_scores(self, answers, systems, num_systems):
+        # answers (workers, documents, answers_per_document) as strings, systems (documents, positions)
+        # with the system index of each shuffled position. Returns (workers, documents, num_systems)
+        # scores, nan where missing.
+        pass
+
+    def to_records(self, annotations):
+        # {document: {system: [(worker, score), ...]}} in annotator order
+        records = {}
+        for row in annotations.itertuples(index=False):
+            records.setdefault(int(row.document), {}).setdefault(row.system, []).append((row.worker, int(getattr(row, self.score_name))))
+        return records
+
+
+class LikertProtocol(Protocol):
+    def __init__(self, scale=5, workers_per_file=None):
+        self.scale = scale
+        self.values = tuple(range(1, scale + 1))
+        self.workers_per_file = workers_per_file
+
+    def get_scores(self, answers, systems, num_systems):
+        values = pd.to_numeric(pd.Series(answers.ravel()), errors="coerce").to_numpy().reshape(answers.shape)
+        if ((values < 1) | (values > self.scale)).any():
+            raise ValueError(f"Scores outside of 1-{self.scale}")
+
+        scores = np.full(answers.shape[:2] + (num_systems,), np.nan)
+        # Answer column j of a document is about the summary at position j + 1
+        scores[:, np.arange(answers.shape[1])[:, None], systems[:, 1:answers.shape[2] + 1]] = values
+        return scores
+
+
+class BWSProtocol(Protocol):
+    # Best summary gets 4, worst 1 and the others 2, as in the original export
+    score_name = "rank"
+    answers_per_document = 2
+    BEST, WORST, OTHER = 4, 1, 2
+    values = (WORST, OTHER, BEST)
+
+    # The BWS study has three annotators per document range, one range got an early extra
+    # submission that final_result leaves out. BWSProtocol(None) keeps every submission.
+    def __init__(self, workers_per_file=3):
+        self.workers_per_file = workers_per_file
+
+    def get_scores(self, answers, systems, num_systems):
+        # Answers are "Summary <position>", best first
+        positions = pd.Series(answers.ravel()).str.extract(r"(\d+)\s*$", expand=False).astype(float).to_numpy().reshape(answers.shape)
+        missing = np.isnan(positions).any(axis=2)
+        positions = np.nan_to_num(positions).astype(int)
+
+        documents = np.arange(answers.shape[1])[None, :]
+        workers = np.arange(answers.shape[0])[:, None]
+        scores = np.full(answers.shape[:2] + (num_systems,), float(self.OTHER))
+        # A summary picked as both best and worst counts as best
+        scores[workers, documents, systems[documents, positions[:, :, 1]]] = self.WORST
+        scores[workers, documents, systems[documents, positions[:, :, 0]]] = self.BEST
+        scores[missing] = np.nan
+        return scores
+
+    def to_records(self, annotations):
+        # {document: {"best": [(worker, system), ...], "worst": [...]}} in annotator order
+        records = {}
+        for row in annotations.itertuples(index=False):
+            document_records = records.setdefault(int(row.document), {"best": [], "worst": []})
+            if row.rank == self.BEST:
+                document_records["best"].append((row.worker, row.system))
+            elif row.rank == self.WORST:
+                document_records["worst"].append((row.worker, row.system))
+        return records
+
+
+PROTOCOLS = {
+    "likert": LikertProtocol(5),
+    "likert_10": LikertProtocol(10),
+    "bws": BWSProtocol(),
+}
+
+
+def get_answer_columns(columns):
+    return [column for column in columns if column not in (WORKER_COLUMN, TIME_COLUMN) and not any(question in column.lower() for question in IGNORED_QUESTIONS)]
+
+
+def parse_file(args):
+    path, protocol, lookup, num_systems, workers_per_file = args
+    documents = get_document_range(path)
+    sheet = pd.read_csv(path, dtype=str, skipinitialspace=True)
+    if workers_per_file is not None:
+        # Extra submissions for a range are early duplicates, keep the latest ones
+        sheet = sheet.iloc[-workers_per_file:]
+
+    answer_columns = get_answer_columns(sheet.columns)
+    if len(answer_columns) != len(documents) * protocol.answers_per_document:
+        raise ValueError(f"{path} has {len(answer_columns)} answer columns, expected {len(documents) * protocol.answers_per_document}")
+
+    if documents.max() >= len(lookup) or (lookup[documents, 1:] < 0).any():
+        raise ValueError(f"The shuffle table has no complete order for documents {documents[0]}-{documents[-1]}")
+
+    answers = sheet[answer_columns].to_numpy().reshape(len(sheet), len(documents), protocol.answers_per_document)
+    scores = protocol.get_scores(answers, lookup[documents], num_systems)
+
+    workers = sheet[WORKER_COLUMN].str.strip().to_numpy() if WORKER_COLUMN in sheet else np.full(len(sheet), None)
+    times = parse_timestamps(sheet[TIME_COLUMN]) if TIME_COLUMN in sheet else pd.Series(pd.NaT, index=sheet.index)
+    return documents, scores, workers, times.to_numpy()
+
+
+def get_batch_paths(directory):
+    return sorted(Path(directory).glob("*.csv"), key=lambda path: get_document_range(path)[0])
+
+
+def parse_files(paths, protocol, lookup, num_systems, workers_per_file=None, num_workers=None):
+    # workers_per_file defaults to the protocol's
+    if workers_per_file is None:
+        workers_per_file = protocol.workers_per_file
+    tasks = [(path, protocol, lookup, num_systems, workers_per_file) for path in paths]
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(tasks))
+    if num_workers <= 1:
+        return list(map(parse_file, tasks))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(parse_file, tasks))
+
+
+def ingest(protocol, directory, shuffle_table, corpus, systems=SYSTEMS, workers_per_file=None, worker_ids=False, timing=False, num_workers=None):
+    if isinstance(protocol, str):
+        protocol = PROTOCOLS[protocol]
+    lookup = read_shuffle_table(shuffle_table)
+    results = parse_files(get_batch_paths(directory), protocol, lookup, len(systems), workers_per_file, num_workers)
+
+    frames = []
+    num_annotators = 0
+    for documents, scores, workers, times in results:
+        # Annotators are numbered through the files in document order, one per row of a file
+        num_rows, num_documents, _ = scores.shape
+        annotators, document_index, system_index = np.indices(scores.shape).reshape(3, -1)
+        frame = pd.DataFrame({
+            "annotator": annotators + num_annotators + 1,
+            "document": documents[document_index],
+            "system": np.asarray(systems)[system_index],
+            "corpus": corpus,
+            protocol.score_name: scores.ravel(),
+        })
+        if worker_ids:
+            frame["worker"] = workers[annotators]
+        if timing:
+            frame["submitted"] = times[annotators]
+
+        frames.append(frame[~np.isnan(scores.ravel())])
+        num_annotators += num_rows
+
+    annotations = pd.concat(frames, ignore_index=True)
+    annotations[protocol.score_name] = annotations[protocol.score_name].astype(int)
+    return annotations
+
+
+def write_annotations(annotations, path):
+    annotations.to_csv(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("protocol", choices=PROTOCOLS)
+    parser.add_argument("directory")
+    parser.add_argument("shuffle_table")
+    parser.add_argument("out_file")
+    parser.add_argument("-c", dest="corpus", required=True)
+    parser.add_argument("--systems", nargs="+", default=list(SYSTEMS))
+    parser.add_argument("--workers-per-file", type=int, default=None)
+    parser.add_argument("--worker-ids", action="store_true", default=False)
+    parser.add_argument("--timing", action="store_true", default=False)
+    parser.add_argument("-j", dest="num_workers", type=int, default=None)
+
+    args = parser.parse_args()
+
+    annotations = ingest(args.protocol, args.directory, args.shuffle_table, args.corpus, args.systems, args.workers_per_file, args.worker_ids, args.timing, args.num_workers)
+    write_annotations(annotations, args.out_file)
@@ -1,58 +1,64 @@
+import numpy as np
 import pandas as pd
 import scipy.stats
 
 import summaryanalysis.ordinal as ordinal
-from summaryanalysis.art import paired_approximate_randomization_test
-from summaryanalysis.annotationutils import get_annotator_groups
+import summaryanalysis.execution as execution
+from summaryanalysis.art import max_t_pvalues, paired_approximate_randomization_tests
+from summaryanalysis.contrasts import fdr_adjust, get_pairs, holm_adjust
+from summaryanalysis.annotationutils import AnnotationSet, as_annotation_set, get_annotator_group_ids
 from pathlib import Path
-from tqdm.auto import tqdm
 import re
-import itertools as it
-from collections import defaultdict, Counter
+from collections import defaultdict
 
 
-def get_model_type1_error_rates(model, blocks):
-    model = model.copy()
-    model.zero_coefficients()
-
-    test_type_1_error_rates = defaultdict(list)
-
-    tests = {
-        "ttest": lambda x, y: scipy.stats.ttest_rel(x, y).pvalue,
-        "art": paired_approximate_randomization_test
-    }
+def _pairwise_scores(scores, num_systems):
+    # (replicates, pairs, ...) scores of the left and right system of every pair
+    left, right = get_pairs(num_systems)
+    return scores[:, left], scores[:, right]
 
-    for n_blocks, n_docs in tqdm(blocks):
-        success_counts = Counter()
-        n_comb = 0
 
-        for _ in tqdm(range(1000)):
-            results = model.sample(ordinal.create_design(n_blocks, n_docs, 3))
+def _group_means(scores, group_ids):
+    # Mean of every (replicate, system) row of scores within each group
+    num_groups = group_ids.max() + 1
+    num_rows = scores.shape[0] * scores.shape[1]
+    flat_ids = (np.arange(num_rows)[:, None] * num_groups + group_ids).ravel()
+    sums = np.bincount(flat_ids, weights=scores.reshape(-1), minlength=num_rows * num_groups)
+    counts = np.bincount(group_ids, minlength=num_groups)
+    return sums.reshape(scores.shape[0], scores.shape[1], num_groups) / counts
 
-            aggregated_results = results.groupby(["system", "document"]).mean()
 
-            pairs = list(it.combinations(results.index.unique("system"), 2))
+def _type1_error_task(task, random_state):
+    model, n_blocks, n_docs, num_iters = task
+    annotators, documents = design = ordinal.create_design(n_blocks, n_docs, 3)
+    scores = model.sample_many(design, num_iters, random_state).astype(float)
+    samples = {
+        "no_agg": _pairwise_scores(scores, len(model.systems)),
+        "agg": _pairwise_scores(_group_means(scores, documents), len(model.systems))
+    }
+    tests = {
+        "ttest": lambda x, y: scipy.stats.ttest_rel(x, y, axis=-1).pvalue,
+        "art": lambda x, y: paired_approximate_randomization_tests(x, y, random_state=random_state)
+    }
 
-            for sys_1, sys_2 in pairs:
-                sys_1_results_no_agg = results.xs(sys_1, level="system").to_numpy()
-                sys_1_results_agg = aggregated_results.xs(sys_1, level="system").to_numpy()
+    error_rates = {}
+    for name, test in tests.items():
+        for aggregation, (x, y) in samples.items():
+            error_rates[name + "_" + aggregation] = float((test(x, y) < 0.05).mean())
 
-                sys_2_results_no_agg = results.xs(sys_2, level="system").to_numpy()
-                sys_2_results_agg = aggregated_results.xs(sys_2, level="system").to_numpy()
+    return error_rates
 
-                for name, test in tests.items():
-                    p_value_no_agg = test(sys_1_results_no_agg, sys_2_results_no_agg)
-                    p_value_agg = test(sys_1_results_agg, sys_2_results_agg)
 
-                    if p_value_no_agg < 0.05:
-                        success_counts[name + "_no_agg"] += 1
-                    if p_value_agg < 0.05:
-                        success_counts[name + "_agg"] += 1
+def get_model_type1_error_rates(model, blocks, num_iters=1000, seed=None, num_workers=None):
+    model = model.copy()
+    model.zero_coefficients()
 
-                n_comb += 1
+    test_type_1_error_rates = defaultdict(list)
 
-        for key, n_succ in success_counts.items():
-            test_type_1_error_rates[key].append(n_succ / n_comb)
+    tasks = [(model, n_blocks, n_docs, num_iters) for n_blocks, n_docs in blocks]
+    for error_rates in execution.run_tasks(_type1_error_task, tasks, seed, num_workers):
+        for key, rate in error_rates.items():
+            test_type_1_error_rates[key].append(rate)
 
     return test_type_1_error_rates
 
@@ -79,50 +85,67 @@ def read_obspower_files(path, pattern, filter_func=lambda *args: True):
 
 
 def filter_wrong_rankings(model, df):
-    coefficients = dict(zip(model.systems, model.coefficients))
-    correct_rankings = set((x, y) for ((x, cx), (y, cy)) in it.product(coefficients.items(), coefficients.items()) if cx > cy)
-    mask = [t in correct_rankings for t in zip(df.index.to_frame()["better"], df.index.to_frame()["worse"])]
+    # Rows ranking the systems against the model coefficients (or systems unknown to the model)
+    # get a p-value of 1
+    coefficients = np.append(np.asarray(model.coefficients, dtype=float), np.nan)
+    systems = pd.Index(model.systems)
+    better = coefficients[systems.get_indexer(df.index.get_level_values("better"))]
+    worse = coefficients[systems.get_indexer(df.index.get_level_values("worse"))]
+    mask = better > worse
     new_df = df.copy()
     new_df["p_value"] = new_df["p_value"].where(mask, 1.0)
     return new_df
 
 
 def add_grouping_column(df):
-    group_df_entries = []
+    if isinstance(df, AnnotationSet):
+        group_ids = df.group_ids
+        df = df.to_frame()
+    else:
+        group_ids = as_annotation_set(df).group_ids
 
-    for idx, group in enumerate(get_annotator_groups(df)):
-        for member in group:
-            group_df_entries.append({"annotator": member, "group": idx})
+    return df.set_index(pd.Index(group_ids, name="group"), append=True)
 
-    grouping_df = pd.DataFrame.from_records(group_df_entries, index="annotator")
-    df = df.join(grouping_df)
-    df = df.set_index(['group'], append=True)
-    return df
+
+ADJUSTMENTS = ("none", "maxt", "holm", "fdr")
 
 
-def get_art_pvals(model, design):
-    result = []
-    for _ in range(100):
-        sample = model.sample(design)
-        sample = add_grouping_column(sample)
-        sample = sample.groupby(["system", "group"]).mean()
+def _art_pvals_task(task, random_state):
+    # adjust="maxt" tests all pairs on one shared set of permutations with Westfall-Young max-T
+    # adjusted p-values, the other adjustments run an independent test per pair. "holm" controls
+    # the familywise error and "fdr" the false discovery rate within every replicate.
+    model, design, num_iters, adjust = task
+    if adjust not in ADJUSTMENTS:
+        raise ValueError(f"Unknown adjustment {adjust}, expected one of {ADJUSTMENTS}")
+    annotators, documents = design
+    scores = model.sample_many(design, num_iters, random_state).astype(float)
+    group_means = _group_means(scores, get_annotator_group_ids(annotators, documents))
 
-        for sys_1, sys_2 in it.combinations(sample.index.unique("system"), 2):
-            sample_1 = sample.xs(sys_1, level="system").to_numpy()
-            sample_2 = sample.xs(sys_2, level="system").to_numpy()
-            p_val = paired_approximate_randomization_test(sample_1, sample_2)
+    sample_1, sample_2 = _pairwise_scores(group_means, len(model.systems))
+    if adjust == "maxt":
+        p_vals = max_t_pvalues(group_means, random_state=random_state)
+    else:
+        p_vals = paired_approximate_randomization_tests(sample_1, sample_2, random_state=random_state)
+        if adjust == "holm":
+            p_vals = holm_adjust(p_vals)
+        elif adjust == "fdr":
+            p_vals = fdr_adjust(p_vals)
+    first_better = sample_1.mean(axis=-1) >= sample_2.mean(axis=-1)
 
-            if sample_2.mean() > sample_1.mean():
-                sys_1, sys_2 = sys_2, sys_1
+    systems = np.array(model.systems)
+    left, right = get_pairs(len(systems))
+    better = np.where(first_better, systems[left], systems[right])
+    worse = np.where(first_better, systems[right], systems[left])
 
+    return pd.DataFrame.from_dict({"better": better.ravel(), "worse": worse.ravel(), "p_value": p_vals.ravel()}).set_index(["better", "worse"])
 
-            result.append({"better": sys_1, "worse": sys_2, "p_value": p_val})
 
-    return pd.DataFrame.from_records(result, index=["better", "worse"])
+def get_art_pvals(model, design, num_iters=100, seed=None, adjust="none"):
+    return _art_pvals_task((model, design, num_iters, adjust), np.random.default_rng(seed))
 
 
-def run_art_experiment(model, annotator_count, block_counts):
-    all_pvals = []
+def run_art_experiment(model, annotator_count, block_counts, seed=None, num_workers=None, adjust="none"):
+    designs = []
     all_keys = []
 
     for n_annotators in (1, annotator_count):
@@ -130,9 +153,11 @@ def run_art_experiment(model, annotator_count, block_counts):
             if n_annotators == 1:
                 n_blocks *= annotator_count
 
-            all_pvals.append(get_art_pvals(model, ordinal.create_design(n_blocks, 5, n_annotators)))
+            designs.append(ordinal.create_design(n_blocks, 5, n_annotators))
             all_keys.append((n_annotators, n_blocks, 5))
 
+    all_pvals = execution.run_tasks(_art_pvals_task, [(model, design, 100, adjust) for design in designs], seed, num_workers)
+
     df = pd.concat(all_pvals, keys=all_keys, names=["annotators", "blocks", "documents"])
     df = df.reset_index()
     df["effort"] = df["annotators"] * df["blocks"] * df["documents"]
@@ -140,14 +165,13 @@ def run_art_experiment(model, annotator_count, block_counts):
     return df.set_index(["annotators", "effort", "total_annotators", "better", "worse"], drop=True)
 
 
-def run_art_experiment_fixed_budget(model, budget, annotator_count, block_counts):
-    result = []
+def run_art_experiment_fixed_budget(model, budget, annotator_count, block_counts, seed=None, num_workers=None, adjust="none"):
+    designs = []
     all_keys = []
     for n_blocks in block_counts:
-        pvals = get_art_pvals(model, ordinal.create_design(n_blocks, budget // n_blocks, annotator_count))
-        result.append(pvals)
+        designs.append(ordinal.create_design(n_blocks, budget // n_blocks, annotator_count))
         all_keys.append((n_blocks, budget * annotator_count, n_blocks * annotator_count))
 
-    return pd.concat(result, keys=all_keys, names=["annotators", "effort", "total_annotators"])
-
+    result = execution.run_tasks(_art_pvals_task, [(model, design, 100, adjust) for design in designs], seed, num_workers)
 
+    return pd.concat(result, keys=all_keys, names=["annotators", "effort", "total_annotators"])
@@ -2,6 +2,8 @@ import numpy as np
 import pandas as pd
 import json
 
+from .design import blocked_design, split_design
+
 
 class OrdinalModel:
     def __init__(self, systems, coefficients, thresholds, annotator_covariance_matrix, document_covariance_matrix=None):
@@ -9,7 +11,10 @@ class OrdinalModel:
         self.coefficients = np.array(coefficients)
         self.thresholds = np.array(thresholds)
         self.annotator_covariance_matrix = np.array(annotator_covariance_matrix)
-        self.document_covariance_matrix = np.array(document_covariance_matrix)
+        self.document_covariance_matrix = None
+        if document_covariance_matrix is not None:
+            self.document_covariance_matrix = np.array(document_covariance_matrix)
+        self._effect_loadings = {}
 
     @classmethod
     def from_file(cls, path):
@@ -32,59 +37,112 @@ class OrdinalModel:
             annotator_matrix,
             document_matrix
         )
+
+    def to_file(self, path):
+        random_effects = {"annotator": self.annotator_covariance_matrix.ravel().tolist()}
+        if self.document_covariance_matrix is not None:
+            random_effects["document"] = self.document_covariance_matrix.ravel().tolist()
+
+        with open(path, "w") as f:
+            json.dump({
+                "random_effects": random_effects,
+                "coefficients": self.coefficients.tolist(),
+                "system_names": self.systems,
+                "thresholds": self.thresholds.tolist()
+            }, f)
+
     def copy(self):
         return OrdinalModel(self.systems, self.coefficients, self.thresholds, self.annotator_covariance_matrix, self.document_covariance_matrix)
 
     def zero_coefficients(self):
         self.coefficients[:] = 0.
 
-    def sample(self, design):
-        annotators, documents = design
-        annotator_errors = np.random.multivariate_normal(np.zeros(len(self.systems)), self.annotator_covariance_matrix, size=np.max(annotators) + 1)
+    def get_effect_loadings(self, name):
+        # Maps standard normal draws to per-system random effects: the first effect is an
+        # intercept shared by all systems, effect s is the slope of system s against the reference.
+        # Cached with a copy of the covariance they were computed from, so that covariances assigned
+        # or changed in place later are picked up.
+        covariance_matrix = getattr(self, f"{name}_covariance_matrix")
+        cached = self._effect_loadings.get(name)
+        if cached is None or not np.array_equal(cached[0], covariance_matrix):
+            loadings = compute_covariance_factor(covariance_matrix) @ slope_matrix(len(self.systems))
+            self._effect_loadings[name] = (np.array(covariance_matrix), loadings)
+        return self._effect_loadings[name][1]
+
+    def sample_many(self, design, n_reps, random_state=None):
+        if random_state is None:
+            random_state = np.random
+
+        annotators, documents, shown = split_design(design)
+        num_systems = len(self.systems)
+
+        annotator_effects = random_state.standard_normal((n_reps, np.max(annotators) + 1, num_systems)) @ self.get_effect_loadings("annotator")
+        linear_predictor = self.coefficients + annotator_effects[:, annotators]
         if self.document_covariance_matrix is not None:
-            document_errors = np.random.multivariate_normal(np.zeros(len(self.systems)), self.document_covariance_matrix, size=np.max(documents) + 1)
-
-        samples = []
-
-        for idx, system in enumerate(self.systems):
-            sampling_logits = self.thresholds - self.coefficients[idx]
-            sampling_logits = sampling_logits.reshape(1, -1) - annotator_errors[annotators,0].reshape(-1, 1)
-            if idx >= 1:
-                sampling_logits -= annotator_errors[annotators,idx].reshape(-1, 1)
-
-            if self.document_covariance_matrix is not None:
-                if idx >= 1:
-                    sampling_logits -= document_errors[documents,idx].reshape(-1, 1)
-                sampling_logits -= document_errors[documents,0].reshape(-1, 1)
-
-
-            sampling_odds = np.exp(sampling_logits)
-            sampling_probabilities = sampling_odds / (sampling_odds + 1)
-            rands = np.random.uniform(size=(len(annotators), 1))
-            samples.append((rands > sampling_probabilities).sum(axis=1) + 1)
-
-        samples_dfs = [pd.DataFrame.from_dict({"score": d}) for d in samples]
-        for df in samples_dfs:
-            df.index = pd.MultiIndex.from_arrays([annotators, documents], names=["annotator", "document"])
-        join_df = pd.concat(samples_dfs, keys=self.systems, names=["system"])
-        return join_df
+            document_effects = random_state.standard_normal((n_reps, np.max(documents) + 1, num_systems)) @ self.get_effect_loadings("document")
+            linear_predictor += document_effects[:, documents]
+        linear_predictor = linear_predictor.transpose(0, 2, 1)
+
+        # P(score <= k) = sigmoid(threshold_k - eta), so a uniform draw u exceeds category k
+        # exactly when logit(u) + eta > threshold_k
+        uniforms = random_state.random(linear_predictor.shape)
+        with np.errstate(divide="ignore"):
+            latent = np.log(uniforms) - np.log1p(-uniforms) + linear_predictor
+
+        scores = (np.searchsorted(self.thresholds, latent) + 1).astype(np.int8)
+        if shown is not None:
+            # Summaries the annotator did not see
+            scores[:, ~shown.T] = 0
+        return scores
+
+    def to_frame(self, scores, design):
+        return scores_to_frame(scores, design, self.systems)
+
+    def sample(self, design, random_state=None):
+        return self.to_frame(self.sample_many(design, 1, random_state)[0], design)
+
+
+def scores_to_frame(scores, design, systems):
+    # Cells coded 0 were not shown and are left out
+    annotators, documents, shown = split_design(design)
+    scores = np.asarray(scores)
+    num_systems = len(systems)
+
+    levels = [
+        np.repeat(systems, len(annotators)),
+        np.tile(annotators, num_systems),
+        np.tile(documents, num_systems)
+    ]
+    names = ["system", "annotator", "document"]
+    if scores.ndim == 3:
+        levels = [np.repeat(np.arange(scores.shape[0]), num_systems * len(annotators))] + [np.tile(l, scores.shape[0]) for l in levels]
+        names = ["replicate"] + names
+
+    index = pd.MultiIndex.from_arrays(levels, names=names)
+    frame = pd.DataFrame({"score": scores.reshape(-1).astype(np.int64)}, index=index)
+    if shown is not None:
+        frame = frame[frame["score"].to_numpy() > 0]
+    return frame
+
+
+def slope_matrix(num_systems):
+    slopes = np.eye(num_systems)
+    slopes[0, :] = 1.
+    return slopes
+
+
+def compute_covariance_factor(covariance_matrix):
+    # Upper triangular factor with factor.T @ factor == covariance_matrix
+    try:
+        return np.linalg.cholesky(covariance_matrix).T
+    except np.linalg.LinAlgError:
+        # Same fallback as np.random.multivariate_normal for matrices that are not positive definite
+        _, s, v = np.linalg.svd(covariance_matrix)
+        return np.sqrt(s)[:, None] * v
 
 
 def create_design(block_count, block_size, block_annotator_count):
-    annotators = []
-    documents = []
-
-    curr_annotator = 0
-    curr_document = 0
-    for block_idx in range(block_count):
-        block_doc_set = list(range(curr_document, curr_document + block_size))
-        for block_annotator_idx in range(block_annotator_count):
-            documents.extend(block_doc_set)
-            annotators.extend([curr_annotator + block_annotator_idx] * len(block_doc_set))
-        curr_annotator += block_annotator_count
-        curr_document += block_size
-
-    return np.array(annotators), np.array(documents)
+    return blocked_design(block_count, block_size, block_annotator_count)
 
 
 thresholds_mn_likertd = [-5.2598, -4.3442, -3.0329, -1.7464, -0.5523, 1.0697]
@@ -1,88 +1,49 @@
 from . import ordinal
-import tempfile
-import os
-import subprocess
+from . import regression
 import tqdm
 from collections import Counter
-from multiprocessing import Pool
 import argparse
 import csv
-import numpy as np
 
 
-
-def regress_on_sample(args):
-    num_blocks, distribution = args
-    np.random.seed()
-    sample = ordinal.MODELS[distribution].sample(ordinal.create_design(num_blocks, 5, 1))
-    differences, p_values = run_regression(sample, nested=True)
-    return differences, p_values
-
-
-def run_experiment(num_blocks, num_iters, log_filename=None, distribution="likertD:multi_news:modified"):
+def run_experiment(num_blocks, num_iters, log_filename=None, distribution="likertD:multi_news:modified", backend=None, seed=None, num_workers=None):
     diffs_of_interest = [
         ("__REFERENCE__", "BART"),
         ("abssentrw", "onmt_pg")
     ]
 
+    model = ordinal.MODELS[distribution]
+    design = ordinal.create_design(num_blocks, 5, 1)
+
     diffs_found = Counter()
     log_writer = None
     log_file = None
     if log_filename is not None:
         log_file = open(log_filename, "w")
         log_writer = csv.writer(log_file)
-    with Pool() as pool:
-        for differences, p_values in tqdm.tqdm(pool.imap_unordered(regress_on_sample, [(num_blocks, distribution)] * num_iters), total=num_iters):
-            diffs_found.update(differences.intersection(diffs_of_interest))
-            if log_writer:
-                vals = []
-                for diff in diffs_of_interest:
-                    vals.append(p_values[tuple(sorted(diff))])
-                log_writer.writerow(vals)
+    results = regression.fit_simulations(model, design, num_iters, backend, nested=True, seed=seed, num_workers=num_workers)
+    for differences, p_values in tqdm.tqdm(results, total=num_iters):
+        diffs_found.update(differences.intersection(diffs_of_interest))
+        if log_writer and p_values is None:
+            log_writer.writerow(["failed"] * len(diffs_of_interest))
+        elif log_writer:
+            vals = []
+            for diff in diffs_of_interest:
+                # Contrasts are keyed better-first when significant, in level order otherwise
+                vals.append(p_values.get(diff, p_values.get(diff[::-1])))
+            log_writer.writerow(vals)
 
     if log_file is not None:
         log_file.close()
 
     for key, val in diffs_found.items():
         print(key, val/num_iters)
+    print("failed fits:", regression.count_failures(results))
 
 
-def run_regression(group_df, nested=False):
-    mode = "crossed"
-    if nested:
-        mode = "nested"
-
-    mode += ":none"
-
-    handle, path = tempfile.mkstemp()
-    f_temp = os.fdopen(handle, 'w')
-    group_df.to_csv(path)
-    f_temp.close()
-    regression_result = subprocess.run(["Rscript", "scripts/r/analyse-ordinal.r", path, "score", mode], capture_output=True, encoding="utf8")
-    os.remove(path)
-
-    diffs = regression_result.stdout.split("\n")
-
-    differences = set()
-    p_values = {}
-
-    for diff in diffs:
-        if len(diff) == 0:
-            continue
-        pair, direction, p_value = diff.split("\t")
-        p_value = float(p_value)
-
-        sys_a, sys_b = pair.split(" - ")
-
-        if direction == "-":
-        	sys_a, sys_b = sys_b, sys_a
-
-        if direction != "o":
-            differences.add((sys_a, sys_b))
-
-        p_values[sys_a, sys_b] = p_value
-
-    return differences, p_values
+def run_regression(group_df, nested=False, backend=None):
+    with regression.use_backend(backend, default="rscript") as backend:
+        return backend.fit(group_df, "score", nested=nested, adjust="none")
 
 
 if __name__ == "__main__":
@@ -91,8 +52,11 @@ if __name__ == "__main__":
     parser.add_argument("-i", dest="num_iters", default=1000, type=int)
     parser.add_argument("-l", dest="log_filename", default=None)
     parser.add_argument("-d", dest="distribution", default="likertD:multi_news:modified")
+    parser.add_argument("--backend", dest="backend", default="rworker", choices=regression.BACKENDS)
+    parser.add_argument("-s", dest="seed", default=None, type=int)
+    parser.add_argument("-j", dest="num_workers", default=None, type=int)
 
     args = parser.parse_args()
 
-    run_experiment(args.num_blocks, args.num_iters, args.log_filename, args.distribution)
+    run_experiment(args.num_blocks, args.num_iters, args.log_filename, args.distribution, args.backend, args.seed, args.num_workers)
 
@@ -1,13 +1,11 @@
 import argparse
-import tempfile
-import subprocess
-import os
 import csv
 
-import pandas as pd
 import tqdm
 
-from .sample import generate_samples, get_annotator_groups
+from .annotationutils import get_annotator_groups, read_annotations
+from .sample import generate_samples
+from . import regression
 
 
 def take(iterable, n):
@@ -18,32 +16,9 @@ def take(iterable, n):
 			yield item
 
 
-def run_regression(group_df, nested=False):
-	mode = "crossed"
-	if nested:
-		mode = "nested"
-
-	handle, path = tempfile.mkstemp()
-	f_temp = os.fdopen(handle, 'w')
-	group_df.to_csv(path)
-	f_temp.close()
-	regression_result = subprocess.run(["Rscript", "analyse-ordinal.r", path, "coherence_score", mode], capture_output=True, encoding="utf8")
-	os.remove(path)
-
-	diffs = regression_result.stdout.split("\n")
-
-	differences = set()
-
-	for diff in diffs:
-		if len(diff) == 0:
-			continue
-		pair, direction = diff.split("\t")
-		sys_a, sys_b = pair.split(" - ")
-
-		if direction == "-":
-			sys_a, sys_b = sys_b, sys_a
-
-		differences.add((sys_a, sys_b))
+def run_regression(group_df, nested=False, backend=None):
+	with regression.use_backend(backend, default="rscript") as backend:
+		differences, _ = backend.fit(group_df, "coherence_score", nested=nested)
 
 	return differences
 
@@ -54,16 +29,23 @@ if __name__ == "__main__":
 	parser.add_argument("annotation_file")
 	parser.add_argument("out_file")
 	parser.add_argument("-n", dest="nested", action="store_true", default=False)
+	parser.add_argument("--backend", dest="backend", default="rworker", choices=regression.BACKENDS)
 
 	args = parser.parse_args()
 
-	annotations = pd.read_csv(args.annotation_file, index_col=[0, 1, 2])
+	# Frames are fitted one at a time, more than one R worker would sit idle
+	if args.backend == "rworker":
+		backend = regression.RWorkerPool(num_workers=1)
+	else:
+		backend = regression.BACKENDS[args.backend]()
+
+	annotations = read_annotations(args.annotation_file, cache=True)
 
 	results_log = open("regression.log", "w")
 	result_file = open(args.out_file, "w")
 	result_writer = csv.writer(result_file)
 
-	base_differences = run_regression(annotations)
+	base_differences = run_regression(annotations, backend=backend)
 
 	contradictory_differences = set((b, a) for a, b in base_differences)
 
@@ -73,7 +55,7 @@ if __name__ == "__main__":
 		num_new = 0
 		for idx, (group_df, num_annotators) in enumerate(take(generate_samples(annotations, group_size, nested=args.nested), 10)):
 
-			detected_differences = run_regression(group_df, nested=args.nested)
+			detected_differences = run_regression(group_df, nested=args.nested, backend=backend)
 			results_log.write(f"#{group_size} {num_annotators} {idx}\n")
 			for diff in sorted(detected_differences):
 				results_log.write("\t".join(diff))
@@ -94,3 +76,4 @@ if __name__ == "__main__":
 
 	result_file.close()
 	results_log.close()
+	backend.close()
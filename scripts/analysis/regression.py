@@ -0,0 +1,332 @@
+import os
+import abc
+import tempfile
+import subprocess
+import contextlib
+import itertools as it
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.stats
+
+from . import execution
+from .annotationutils import get_annotator_group_ids
+from .contrasts import PairwiseResults, concat_results, fdr_adjust, get_pairs, holm_adjust, pairwise_contrast_arrays, results_to_sets, sets_to_results
+from .design import split_design
+from .ordinal import scores_to_frame
+
+R_SCRIPT_DIR = Path(__file__).resolve().parents[1] / "r"
+ANALYSIS_SCRIPT = R_SCRIPT_DIR / "analyse-ordinal.r"
+WORKER_SCRIPT = R_SCRIPT_DIR / "ordinal-worker.r"
+
+ContrastRecord = namedtuple("ContrastRecord", ["replicate", "left", "right", "direction", "p_value"])
+# Direction of the single record of a replicate whose model could not be fitted
+FAILED = "failed"
+
+
+def parse_contrast(fields, replicate=0):
+    if fields[0] == FAILED:
+        return ContrastRecord(replicate, None, None, FAILED, np.nan)
+    pair, direction, p_value = fields
+    left, right = pair.split(" - ")
+    # R prints missing p-values as NA
+    return ContrastRecord(replicate, left, right, direction, np.nan if p_value == "NA" else float(p_value))
+
+
+def collect_results(records, num_replicates):
+    # Replicates whose fit failed get None instead of their p-values
+    results = [(set(), {}) for _ in range(num_replicates)]
+
+    for record in records:
+        if record.direction == FAILED:
+            results[record.replicate] = (set(), None)
+            continue
+        differences, p_values = results[record.replicate]
+        sys_a, sys_b = record.left, record.right
+
+        if record.direction == "-":
+            sys_a, sys_b = sys_b, sys_a
+
+        if record.direction != "o":
+            differences.add((sys_a, sys_b))
+
+        p_values[sys_a, sys_b] = record.p_value
+
+    return results
+
+
+def get_mode(nested, adjust):
+    mode = "nested" if nested else "crossed"
+    return f"{mode}:{adjust}"
+
+
+def to_batch_frame(frames):
+    batch = pd.concat(frames, keys=range(len(frames)), names=["replicate"])
+    return batch.reset_index()
+
+
+def count_failures(results):
+    return sum(p_values is None for _, p_values in results)
+
+
+class RegressionBackend(abc.ABC):
+    @abc.abstractmethod
+    def fit_many(self, frames, score_name="score", nested=False, adjust="tukey"):
+        pass
+
+    def fit_samples(self, scores, design, systems, score_name="score", nested=False, adjust="tukey"):
+        # scores as returned by OrdinalModel.sample_many
+        frames = [scores_to_frame(replicate_scores, design, systems).rename(columns={"score": score_name}) for replicate_scores in scores]
+        return self.fit_many(frames, score_name, nested, adjust)
+
+    def fit_sample_arrays(self, scores, design, systems, score_name="score", nested=False, adjust="tukey"):
+        # Results as PairwiseResults over all pairs of systems
+        return sets_to_results(self.fit_samples(scores, design, systems, score_name, nested, adjust), systems)
+
+    def fit(self, frame, score_name="score", nested=False, adjust="tukey"):
+        return self.fit_many([frame], score_name, nested, adjust)[0]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RscriptBackend(RegressionBackend):
+    # Starts a fresh Rscript process for every dataset
+    def __init__(self, script_path=ANALYSIS_SCRIPT):
+        self.script_path = str(script_path)
+
+    def _fit_single(self, replicate, frame, score_name, mode):
+        handle, path = tempfile.mkstemp()
+        f_temp = os.fdopen(handle, 'w')
+        frame.to_csv(path)
+        f_temp.close()
+        regression_result = subprocess.run(["Rscript", self.script_path, path, score_name, mode], capture_output=True, encoding="utf8")
+        os.remove(path)
+        if regression_result.returncode != 0:
+            return [ContrastRecord(replicate, None, None, FAILED, np.nan)]
+
+        return [parse_contrast(line.split("\t"), replicate) for line in regression_result.stdout.split("\n") if len(line) > 0]
+
+    def fit_many(self, frames, score_name="score", nested=False, adjust="tukey"):
+        mode = get_mode(nested, adjust)
+        records = []
+        for replicate, frame in enumerate(frames):
+            records.extend(self._fit_single(replicate, frame, score_name, mode))
+        return collect_results(records, len(frames))
+
+
+class RWorkerPool(RegressionBackend):
+    # Keeps Rscript workers with all libraries loaded alive and streams batches of datasets to them.
+    # A batch is announced by a "<score name> <mode> <number of rows>" line followed by a CSV with a
+    # replicate column; the worker answers with one "replicate\tcontrast\tdirection\tp" line per
+    # contrast and a final DONE line.
+    def __init__(self, num_workers=None, script_path=WORKER_SCRIPT):
+        if num_workers is None:
+            num_workers = os.cpu_count()
+
+        self.processes = [
+            subprocess.Popen(["Rscript", str(script_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf8")
+            for _ in range(num_workers)
+        ]
+
+    def _fit_batch(self, process, replicates, frames, score_name, mode):
+        batch = to_batch_frame(frames)
+        batch["replicate"] = np.asarray(replicates)[batch["replicate"].to_numpy()]
+
+        process.stdin.write(f"{score_name} {mode} {len(batch)}\n")
+        batch.to_csv(process.stdin, index=False)
+        process.stdin.flush()
+
+        records = []
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            if line == "DONE":
+                return records
+            replicate, *fields = line.split("\t")
+            records.append(parse_contrast(fields, int(replicate)))
+
+        raise RuntimeError(f"Regression worker exited with code {process.wait()}")
+
+    def fit_many(self, frames, score_name="score", nested=False, adjust="tukey"):
+        mode = get_mode(nested, adjust)
+        num_batches = min(len(self.processes), len(frames))
+        replicate_batches = np.array_split(np.arange(len(frames)), num_batches)
+
+        with ThreadPoolExecutor(max_workers=num_batches) as executor:
+            futures = [
+                executor.submit(self._fit_batch, process, replicates, [frames[idx] for idx in replicates], score_name, mode)
+                for process, replicates in zip(self.processes, replicate_batches)
+            ]
+            records = list(it.chain.from_iterable(future.result() for future in futures))
+
+        return collect_results(records, len(frames))
+
+    def close(self):
+        for process in self.processes:
+            process.stdin.close()
+            process.wait()
+        self.processes = []
+
+
+class TTestBackend(RegressionBackend):
+    # Stand-in without R: paired t-tests between the systems over annotator groups. The differences
+    # of an (annotator, document) cell are averaged per group of annotators who saw the same
+    # documents, so that groups and not the correlated cells of one annotator are the observations.
+    # There is no Tukey adjustment, the studentized range does not apply to per-pair t-tests.
+    ADJUSTMENTS = ("none", "holm", "bonferroni", "fdr")
+
+    def fit_many(self, frames, score_name="score", nested=False, adjust="tukey"):
+        results = []
+        for frame in frames:
+            scores = frame[score_name].unstack("system").sort_index(axis=1)
+            index = scores.index.to_frame(index=False)
+            groups = get_annotator_group_ids(index["annotator"], index["document"])
+            results.extend(results_to_sets(self._test_pairs(scores.to_numpy(dtype=float)[None], groups, list(scores.columns), adjust)))
+        return results
+
+    def fit_samples(self, scores, design, systems, score_name="score", nested=False, adjust="tukey"):
+        return results_to_sets(self.fit_sample_arrays(scores, design, systems, score_name, nested, adjust))
+
+    def fit_sample_arrays(self, scores, design, systems, score_name="score", nested=False, adjust="tukey"):
+        annotators, documents, _ = split_design(design)
+        # Cells coded 0 were not shown
+        values = np.asarray(scores, dtype=float).transpose(0, 2, 1)
+        values[values == 0] = np.nan
+        return self._test_pairs(values, get_annotator_group_ids(annotators, documents), list(systems), adjust)
+
+    def _test_pairs(self, values, groups, systems, adjust):
+        # values (replicates, cells, systems), cells where an annotator saw only one of two systems
+        # have a nan difference and are left out of the group means
+        if adjust not in self.ADJUSTMENTS:
+            raise ValueError(f"Unsupported p-value adjustment {adjust} for paired t-tests, expected one of {self.ADJUSTMENTS}")
+        left, right = get_pairs(len(systems))
+        differences = values[:, :, left] - values[:, :, right]
+
+        observed = ~np.isnan(differences)
+        group_codes, _ = pd.factorize(groups)
+        membership = scipy.sparse.csr_matrix((np.ones(len(group_codes)), (group_codes, np.arange(len(group_codes)))))
+        # (groups, cells) @ (cells, replicates * pairs)
+        cell_major = lambda array: array.transpose(1, 0, 2).reshape(len(group_codes), -1)
+        group_shape = (membership.shape[0], len(values), len(left))
+        sums = (membership @ cell_major(np.where(observed, differences, 0.))).reshape(group_shape)
+        counts = (membership @ cell_major(observed.astype(float))).reshape(group_shape)
+        with np.errstate(invalid="ignore"):
+            group_means = (sums / counts).transpose(1, 0, 2)
+
+        p_values = scipy.stats.ttest_1samp(group_means, 0., axis=1, nan_policy="omit").pvalue
+        p_values = np.nan_to_num(np.asarray(p_values, dtype=float), nan=1.)
+        if adjust == "holm":
+            p_values = holm_adjust(p_values)
+        elif adjust == "bonferroni":
+            p_values = np.minimum(p_values * p_values.shape[-1], 1.)
+        elif adjust == "fdr":
+            p_values = fdr_adjust(p_values)
+
+        return PairwiseResults(systems, left, right, np.nanmean(differences, axis=1), p_values)
+
+
+class ContrastBackend(RegressionBackend):
+    # Fixed-effects cumulative logit contrasts with cluster-robust standard errors, fitted in-process
+    def fit_many(self, frames, score_name="score", nested=False, adjust="tukey"):
+        results = []
+        for frame in frames:
+            index = frame.index.to_frame(index=False)
+            system_codes, system_names = pd.factorize(index["system"])
+            results.extend(results_to_sets(pairwise_contrast_arrays(
+                self._get_scores(frame[score_name].to_numpy()[None], score_name),
+                system_codes, index["annotator"].to_numpy(), index["document"].to_numpy(), list(system_names), adjust, nested
+            )))
+        return results
+
+    def fit_samples(self, scores, design, systems, score_name="score", nested=False, adjust="tukey"):
+        return results_to_sets(self.fit_sample_arrays(scores, design, systems, score_name, nested, adjust))
+
+    def fit_sample_arrays(self, scores, design, systems, score_name="score", nested=False, adjust="tukey"):
+        annotators, documents, shown = split_design(design)
+        num_systems = len(systems)
+        scores = self._get_scores(np.asarray(scores).reshape(len(scores), -1), score_name)
+        # Cells that were not shown are the same in every replicate
+        cells = slice(None) if shown is None else shown.T.ravel()
+
+        return pairwise_contrast_arrays(
+            scores[:, cells], np.repeat(np.arange(num_systems), len(annotators))[cells],
+            np.tile(annotators, num_systems)[cells], np.tile(documents, num_systems)[cells], list(systems), adjust, nested
+        )
+
+    def _get_scores(self, scores, score_name):
+        if score_name == "rank":
+            return -scores
+        return scores
+
+
+BACKENDS = {
+    "rscript": RscriptBackend,
+    "rworker": RWorkerPool,
+    "local": TTestBackend,
+    "contrast": ContrastBackend,
+}
+
+# Backends cheap enough to be created inside every simulation task
+IN_PROCESS_BACKENDS = ("local", "contrast")
+
+
+@contextlib.contextmanager
+def use_backend(backend=None, default="rworker"):
+    # Backends created here are closed on exit, backend instances passed in stay open for reuse
+    if backend is None:
+        backend = default
+    if not isinstance(backend, str):
+        yield backend
+        return
+
+    with BACKENDS[backend]() as created_backend:
+        yield created_backend
+
+
+def _sample_task(task, random_state):
+    model, design, num_reps = task
+    return model.sample_many(design, num_reps, random_state)
+
+
+def _fit_task(task, random_state):
+    model, design, num_reps, backend, nested, adjust, arrays = task
+    scores = model.sample_many(design, num_reps, random_state)
+    with use_backend(backend) as backend:
+        fit = backend.fit_sample_arrays if arrays else backend.fit_samples
+        return fit(scores, design, model.systems, nested=nested, adjust=adjust)
+
+
+def _fit_simulations(model, design, num_reps, backend, nested, adjust, seed, num_workers, arrays):
+    # Every task samples its replicates from its own stream spawned from seed, so results only
+    # depend on the seed and not on the number of workers
+    task_sizes = execution.split_replicates(num_reps)
+
+    if isinstance(backend, str) and backend in IN_PROCESS_BACKENDS:
+        tasks = [(model, design, size, backend, nested, adjust, arrays) for size in task_sizes]
+        return list(execution.run_tasks(_fit_task, tasks, seed, num_workers))
+
+    tasks = [(model, design, size) for size in task_sizes]
+    scores = np.concatenate(execution.run_tasks(_sample_task, tasks, seed, num_workers))
+    with use_backend(backend) as backend:
+        fit = backend.fit_sample_arrays if arrays else backend.fit_samples
+        return [fit(scores, design, model.systems, nested=nested, adjust=adjust)]
+
+
+def fit_simulations(model, design, num_reps, backend=None, nested=False, adjust="none", seed=None, num_workers=None):
+    return list(it.chain.from_iterable(_fit_simulations(model, design, num_reps, backend, nested, adjust, seed, num_workers, False)))
+
+
+def fit_simulation_arrays(model, design, num_reps, backend=None, nested=False, adjust="none", seed=None, num_workers=None):
+    # fit_simulations as PairwiseResults of all replicates, without per pair Python objects for
+    # the in-process backends
+    return concat_results(_fit_simulations(model, design, num_reps, backend, nested, adjust, seed, num_workers, True))
@@ -0,0 +1,184 @@
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+
+# Test-retest stability of crowd workers. Every round is a long frame of (task, item, worker,
+# value), item being the system for Likert scores and best/worst for best-worst scaling (the value
+# is then the chosen system). Rounds are joined on these keys into one column per round, workers
+# missing from a round are kept as nan and counted, never matched to another judgment.
+# Only absolute imports, interval_test/test.py imports this module from outside the package.
+
+KEY_NAMES = ["task", "item", "worker"]
+WEIGHTS = ("nominal", "linear", "quadratic")
+
+
+def records_to_frame(records):
+    # {task: {item: [(worker, value), ...]}} as written by ingest's to_records
+    rows = [(task, item, worker, value) for task, items in records.items() for item, pairs in items.items() for worker, value in pairs]
+    return pd.DataFrame(rows, columns=KEY_NAMES + ["value"])
+
+
+def read_records(path):
+    with open(path) as f:
+        return records_to_frame(json.load(f))
+
+
+def join_rounds(rounds):
+    # Values indexed by (task, item, worker) with one column per round, nan where the worker has
+    # no judgment in that round. Repeated judgments within a round keep the latest one.
+    columns = []
+    for idx, frame in enumerate(rounds):
+        frame = frame.astype({name: str for name in KEY_NAMES}).drop_duplicates(KEY_NAMES, keep="last")
+        columns.append(frame.set_index(KEY_NAMES)["value"].rename(idx))
+    return pd.concat(columns, axis=1, join="outer").sort_index()
+
+
+def get_match_table(joined):
+    # Judgments per worker and round, and how many of them were matched in every round
+    observed = joined.notna()
+    table = observed.groupby(level="worker").sum()
+    table.columns = [f"round_{column}" for column in table.columns]
+    table["matched"] = observed.all(axis=1).groupby(level="worker").sum()
+    return table
+
+
+def _encode(values):
+    # Category codes of all rounds in a shared, sorted set of categories
+    codes, categories = pd.factorize(values.to_numpy().ravel(), sort=True)
+    return codes.reshape(values.shape), categories
+
+
+def _get_pairs(joined, first, second):
+    pairs = joined[[first, second]].dropna()
+    workers, worker_names = pd.factorize(pairs.index.get_level_values("worker"), sort=True)
+    return pairs, workers, worker_names
+
+
+def _disagreement_weights(categories, weights):
+    if weights not in WEIGHTS:
+        raise ValueError(f"Unknown weights {weights}, expected one of {WEIGHTS}")
+    positions = np.arange(len(categories))
+    distances = np.abs(positions[:, None] - positions[None, :]) / max(len(categories) - 1, 1)
+    if weights == "nominal":
+        return (distances > 0).astype(float)
+    return distances if weights == "linear" else distances ** 2
+
+
+def weighted_kappa(codes, num_categories, groups=None, num_groups=1, weights="quadratic"):
+    # Cohen's weighted kappa of (judgments, 2) category codes within every group, nan for groups
+    # without expected disagreement
+    if groups is None:
+        groups = np.zeros(len(codes), dtype=int)
+    disagreement = _disagreement_weights(np.arange(num_categories), weights)
+
+    cells = (groups * num_categories + codes[:, 0]) * num_categories + codes[:, 1]
+    observed = np.bincount(cells, minlength=num_groups * num_categories ** 2).reshape(num_groups, num_categories, num_categories).astype(float)
+    totals = observed.sum(axis=(1, 2))
+    expected = observed.sum(axis=2)[:, :, None] * observed.sum(axis=1)[:, None, :] / np.maximum(totals, 1)[:, None, None]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 1. - (observed * disagreement).sum(axis=(1, 2)) / (expected * disagreement).sum(axis=(1, 2))
+
+
+def intraclass_correlation(values, groups=None, num_groups=1):
+    # ICC(A,1), two-way random effects absolute agreement of single rounds, of (judgments, rounds)
+    # values within every group
+    if groups is None:
+        groups = np.zeros(len(values), dtype=int)
+    num_rows, num_rounds = values.shape
+    sizes = np.bincount(groups, minlength=num_groups).astype(float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.bincount(groups, weights=values.sum(axis=1), minlength=num_groups) / (sizes * num_rounds)
+        round_means = np.stack([np.bincount(groups, weights=values[:, idx], minlength=num_groups) for idx in range(num_rounds)], axis=1) / sizes[:, None]
+        centered = values - means[groups, None]
+
+        total = np.bincount(groups, weights=(centered ** 2).sum(axis=1), minlength=num_groups)
+        rows = num_rounds * np.bincount(groups, weights=centered.mean(axis=1) ** 2, minlength=num_groups)
+        columns = sizes * ((round_means - means[:, None]) ** 2).sum(axis=1)
+
+        row_mean_square = rows / (sizes - 1)
+        column_mean_square = columns / (num_rounds - 1)
+        error_mean_square = (total - rows - columns) / ((sizes - 1) * (num_rounds - 1))
+        return (row_mean_square - error_mean_square) / (
+            row_mean_square + (num_rounds - 1) * error_mean_square + num_rounds * (column_mean_square - error_mean_square) / sizes
+        )
+
+
+def get_likert_stability(joined, first=0, second=1, weights="quadratic"):
+    # Per worker mean absolute deviation, weighted kappa between two rounds and ICC over all
+    # rounds, the "all" row holds the pooled values
+    pairs, workers, worker_names = _get_pairs(joined, first, second)
+    values = pairs.to_numpy(dtype=float)
+    codes, categories = _encode(pairs)
+    num_workers = len(worker_names)
+
+    counts = np.bincount(workers, minlength=num_workers)
+    complete = joined.dropna()
+    complete_workers = worker_names.get_indexer(complete.index.get_level_values("worker"))
+    known = complete_workers >= 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table = pd.DataFrame({
+            "matched": counts,
+            "mad": np.bincount(workers, weights=np.abs(values[:, 0] - values[:, 1]), minlength=num_workers) / counts,
+            "kappa": weighted_kappa(codes, len(categories), workers, num_workers, weights),
+            "icc": intraclass_correlation(complete.to_numpy(dtype=float)[known], complete_workers[known], num_workers),
+        }, index=pd.Index(worker_names, name="worker"))
+
+    table.loc["all"] = [
+        len(values),
+        np.abs(values[:, 0] - values[:, 1]).mean(),
+        weighted_kappa(codes, len(categories), weights=weights)[0],
+        intraclass_correlation(complete.to_numpy(dtype=float))[0],
+    ]
+    return table
+
+
+def get_bws_stability(joined, first=0, second=1):
+    # Per worker share of best and worst choices that changed, share of tasks where a system moved
+    # from best to worst or back (flips) and nominal kappa of the choices
+    pairs, workers, worker_names = _get_pairs(joined, first, second)
+    codes, categories = _encode(pairs)
+    num_workers = len(worker_names)
+    changed = codes[:, 0] != codes[:, 1]
+
+    # Both choices of a task side by side, tasks missing either one cannot flip. A system only
+    # flips when the choice changed, judgments with the same best and worst system are no flip
+    # when they are repeated.
+    choices = pairs.unstack("item").dropna()
+    first_best, first_worst, second_best, second_worst = (choices[(idx, item)] for idx in (first, second) for item in ("best", "worst"))
+    flips = (((first_best == second_worst) & (first_best != second_best)) | ((first_worst == second_best) & (first_worst != second_worst))).to_numpy()
+    flip_workers = worker_names.get_indexer(choices.index.get_level_values("worker"))
+
+    counts = np.bincount(workers, minlength=num_workers)
+    task_counts = np.bincount(flip_workers, minlength=num_workers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table = pd.DataFrame({
+            "matched": counts,
+            "change_rate": np.bincount(workers, weights=changed, minlength=num_workers) / counts,
+            "flip_rate": np.bincount(flip_workers, weights=flips, minlength=num_workers) / task_counts,
+            "kappa": weighted_kappa(codes, len(categories), workers, num_workers, "nominal"),
+        }, index=pd.Index(worker_names, name="worker"))
+
+    table.loc["all"] = [len(codes), changed.mean(), flips.mean(), weighted_kappa(codes, len(categories), weights="nominal")[0]]
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("protocol", choices=("likert", "bws"))
+    parser.add_argument("round_files", nargs="+")
+    parser.add_argument("-w", dest="weights", default="quadratic", choices=WEIGHTS)
+
+    args = parser.parse_args()
+
+    joined = join_rounds([read_records(path) for path in args.round_files])
+    print(get_match_table(joined))
+    if args.protocol == "likert":
+        print(get_likert_stability(joined, weights=args.weights))
+    else:
+        print(get_bws_stability(joined))
@@ -1,27 +1,33 @@
-import random
-import itertools as it
-from collections import defaultdict
+import numpy as np
 
+from .annotationutils import AnnotationSet, as_annotation_set, sample_group_members
+from .combinations import iter_combinations
 
-def get_annotator_groups(annotations):
-    all_groups = defaultdict(list)
-    for annotator, group in annotations.groupby("annotator").groups.items():
-        docs = tuple(sorted(set(group.to_frame()["document"])))
-        all_groups[docs].append(annotator)
-    
-    all_annotator_groups = list(map(tuple, all_groups.values()))
-    return all_annotator_groups
 
+def generate_sample_indices(annotations, size, nested=False, mode="exhaustive", limit=None, random_state=None):
+	# Row positions of the annotations of every sampled combination of annotator groups, only one
+	# random annotator of each group if nested. Combinations are drawn as in iter_combinations.
+	if random_state is None:
+		random_state = np.random
 
-def generate_samples(annotations, size, nested=False):
-	groups = get_annotator_groups(annotations)
+	annotations = as_annotation_set(annotations)
+	group_members = annotations.group_members
+	group_sizes = (group_members >= 0).sum(axis=1)
+	group_ids = annotations.group_ids
 
-	combinations = list(it.combinations(groups, size))
-
-	for group_combo in combinations:
+	for group_combos in iter_combinations(len(group_members), size, mode, limit, random_state):
 		if nested:
-			group_combo = [random.choice(g) for g in group_combo]
+			annotator_combos = sample_group_members(group_members, group_combos, random_state)
+			for annotator_combo in annotator_combos:
+				yield np.flatnonzero(np.isin(annotations.annotators, annotator_combo)), len(annotator_combo)
 		else:
-			group_combo = [m for g in group_combo for m in g]
+			for group_combo in group_combos:
+				yield np.flatnonzero(np.isin(group_ids, group_combo)), group_sizes[group_combo].sum()
+
 
-		yield annotations.loc[group_combo], len(group_combo)
\ No newline at end of file
+def generate_samples(annotations, size, nested=False, mode="exhaustive", limit=None, random_state=None):
+	for rows, num_annotators in generate_sample_indices(annotations, size, nested, mode, limit, random_state):
+		if isinstance(annotations, AnnotationSet):
+			yield annotations.take(rows), num_annotators
+		else:
+			yield annotations.iloc[rows], num_annotators
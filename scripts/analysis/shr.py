@@ -1,54 +1,71 @@
 from collections import defaultdict
-import itertools as it
-import random
-import scipy.stats
 import numpy as np
 
-def get_annotator_groups(annotations):
-    all_groups = defaultdict(list)
-    for annotator, group in annotations.groupby("annotator").groups.items():
-        docs = tuple(sorted(set(group.to_frame()["document"])))
-        all_groups[docs].append(annotator)
+from .annotationutils import as_annotation_set
 
-    all_annotator_groups = list(map(tuple, all_groups.values()))
-    return all_annotator_groups
 
-def compute_correlations_from_selection_mask(annotations, select_mask, score_name):
-    scores_1 = annotations.loc[~select_mask][score_name]
-    scores_2 = annotations.loc[select_mask][score_name]
+# Splits evaluated per matrix product, bounds the memory of the split assignment matrices
+SPLIT_CHUNK_SIZE = 10000
 
-    system_scores_1 = scores_1.groupby("system").mean().sort_index().to_numpy()
-    system_scores_2 = scores_2.groupby("system").mean().sort_index().to_numpy()
 
-    corr,_ = scipy.stats.pearsonr(system_scores_1, system_scores_2)
+def get_group_system_sums(annotations, score_name):
+    # Per annotator group and system sums and counts of the scores
+    annotations = as_annotation_set(annotations)
+    scores = annotations.get_scores(score_name)
+    valid = ~np.isnan(scores)
+    num_groups = annotations.num_groups
+    num_systems = len(annotations.system_names)
+    cells = (annotations.group_ids * num_systems + annotations.systems)[valid]
 
-    sq_err = np.absolute((system_scores_1 - system_scores_2)).mean()
-    return corr, sq_err
+    sums = np.bincount(cells, weights=scores[valid], minlength=num_groups * num_systems).reshape(num_groups, num_systems)
+    counts = np.bincount(cells, minlength=num_groups * num_systems).reshape(num_groups, num_systems)
+    return sums, counts
+
+
+def sample_half_splits(num_groups, num_splits, random_state=None):
+    # One row per split, 1 for the groups in the selected half (num_groups // 2 of them)
+    if random_state is None:
+        random_state = np.random
+    ranks = random_state.random((num_splits, num_groups)).argsort(axis=1).argsort(axis=1)
+    return (ranks < num_groups // 2).astype(float)
 
 
-def compute_annotator_shr_raw(annotations, limit=1000, score_names=("coherence_score", "pronoun_score", "noun_phrase_score", "repetition_score")):
-    all_annotator_groups = get_annotator_groups(annotations)
+def correlate_rows(x, y):
+    # Pearson correlation of every row of x with the matching row of y, nan for constant rows
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (x * y).sum(axis=-1) / np.sqrt((x ** 2).sum(axis=-1) * (y ** 2).sum(axis=-1))
 
-    #annotations = normalize_annotations(annotations)
 
-    annotators = annotations.index.levels[0]
+def compute_split_correlations(sums, counts, splits):
+    selected_means = (splits @ sums) / (splits @ counts)
+    remaining_means = ((1 - splits) @ sums) / ((1 - splits) @ counts)
+
+    corr = correlate_rows(remaining_means, selected_means)
+    sq_err = np.absolute(remaining_means - selected_means).mean(axis=1)
+    return corr, sq_err
+
 
-    corrs = defaultdict(lambda: defaultdict(list))
+def compute_annotator_shr_raw(annotations, limit=1000, score_names=("coherence_score", "pronoun_score", "noun_phrase_score", "repetition_score"), random_state=None):
+    corrs = defaultdict(dict)
 
-    def combs_generator(all_annotator_groups, limit):
-        for _ in range(limit):
-            random.shuffle(all_annotator_groups)
-            yield all_annotator_groups[:len(all_annotator_groups) // 2]
+    annotations = as_annotation_set(annotations)
+    system_sums = {score_name: get_group_system_sums(annotations, score_name) for score_name in score_names}
+    num_groups = next(iter(system_sums.values()))[0].shape[0]
 
-    combs = combs_generator(all_annotator_groups, limit)
+    all_corrs = defaultdict(lambda: defaultdict(list))
+    for start in range(0, limit, SPLIT_CHUNK_SIZE):
+        # All score names are evaluated on the same splits
+        splits = sample_half_splits(num_groups, min(SPLIT_CHUNK_SIZE, limit - start), random_state)
+        for score_name, (sums, counts) in system_sums.items():
+            p_corr, sq_err = compute_split_correlations(sums, counts, splits)
+            all_corrs["pearson"][score_name].append(p_corr)
+            all_corrs["sq_err"][score_name].append(sq_err)
 
-    for annotator_halfs in combs:
-        annotator_half = tuple(it.chain(*annotator_halfs))
-        select_mask = annotations.index.to_frame()["annotator"].isin(annotator_half)
-        for score_name in score_names:
-            p_corr, sq_err = compute_correlations_from_selection_mask(annotations, select_mask, score_name)
-            corrs["pearson"][score_name].append(p_corr)
-            corrs["sq_err"][score_name].append(sq_err)
+    for corr_name, score_corrs in all_corrs.items():
+        for score_name, values in score_corrs.items():
+            corrs[corr_name][score_name] = np.concatenate(values)
 
     return corrs
 
@@ -1,68 +1,100 @@
-import random
-import itertools as it
+from collections import namedtuple
 from tqdm.auto import tqdm
-import scipy.stats
-from summaryanalysis.annotationutils import get_annotator_groups
+from summaryanalysis.annotationutils import as_annotation_set, sample_group_members
+from summaryanalysis.combinations import sample_combinations
+from summaryanalysis.shr import correlate_rows
 import numpy as np
 
 
-def compute_grouped_subsample_variance(annotations, crossed=False, score_name="coherence_score", limit=10000):
-    groups = get_annotator_groups(annotations)
+# Per annotator and per annotator group system score sums and counts, enough to get the system
+# means of any subsample of annotators without touching the annotations again
+SubsampleStatistics = namedtuple("SubsampleStatistics", [
+    "annotators", "annotator_groups", "annotator_sums", "annotator_counts", "group_sums", "group_counts", "group_members"
+])
+
+
+def get_subsample_statistics(annotations, score_name):
+    annotations = as_annotation_set(annotations)
+    num_annotators = len(annotations.annotator_names)
+    num_systems = len(annotations.system_names)
+
+    scores = annotations.get_scores(score_name)
+    valid = ~np.isnan(scores)
+    cells = (annotations.annotators * num_systems + annotations.systems)[valid]
+    annotator_sums = np.bincount(cells, weights=scores[valid], minlength=num_annotators * num_systems).reshape(num_annotators, num_systems)
+    annotator_counts = np.bincount(cells, minlength=num_annotators * num_systems).reshape(num_annotators, num_systems)
+
+    annotator_groups = annotations.annotator_groups
+    present = annotator_groups >= 0
+    group_sums = np.zeros((annotations.num_groups, num_systems))
+    group_counts = np.zeros((annotations.num_groups, num_systems))
+    np.add.at(group_sums, annotator_groups[present], annotator_sums[present])
+    np.add.at(group_counts, annotator_groups[present], annotator_counts[present])
+
+    return SubsampleStatistics(
+        annotations.annotator_names, annotator_groups, annotator_sums, annotator_counts, group_sums, group_counts, annotations.group_members
+    )
+
+
+def get_original_scores(statistics):
+    return statistics.group_sums.sum(axis=0) / statistics.group_counts.sum(axis=0)
 
-    annotations = annotations.sort_index()
-    original_scores = annotations.groupby("system").mean().sort_index()[score_name].to_numpy()
-    qualities = []
-    annotation_costs = []
 
-    for sample_size in tqdm(range(len(groups)), leave=False):
-        sample_qualities = []
+def compute_subsample_scores(sums, counts, samples):
+    # System means of every subsample, samples holds one row of indices into sums per subsample
+    return sums[samples].sum(axis=1) / counts[samples].sum(axis=1)
 
-        for idx in range(limit):
-            sampled_groups = random.sample(groups, sample_size + 1)
-            if crossed:
-                sampled_annotators = list(it.chain(*sampled_groups))
-            else:
-                sampled_annotators = [random.choice(g) for g in sampled_groups]
 
-            sampled_annotations = annotations.loc[sampled_annotators]
+def compute_grouped_subsample_variance(annotations, crossed=False, score_name="coherence_score", limit=10000, random_state=None):
+    if random_state is None:
+        random_state = np.random
 
-            annotation_vec = sampled_annotations.groupby("system").mean().sort_index()[score_name].to_numpy()
-            correlation, _ = scipy.stats.pearsonr(
-                    annotation_vec,
-                    original_scores)
-            sample_qualities.append(correlation)
+    statistics = get_subsample_statistics(annotations, score_name)
+    original_scores = get_original_scores(statistics)
+    num_groups = len(statistics.group_sums)
+
+    qualities = []
+    annotation_costs = []
+
+    for sample_size in tqdm(range(num_groups), leave=False):
+        group_samples = sample_combinations(num_groups, sample_size + 1, "random", limit, random_state)
+        if crossed:
+            sample_scores = compute_subsample_scores(statistics.group_sums, statistics.group_counts, group_samples)
+        else:
+            annotator_samples = sample_group_members(statistics.group_members, group_samples, random_state)
+            sample_scores = compute_subsample_scores(statistics.annotator_sums, statistics.annotator_counts, annotator_samples)
+
+        sample_qualities = correlate_rows(sample_scores, original_scores[None])
 
         annotation_cost = (sample_size + 1)
         if crossed:
             annotation_cost *= 3
         annotation_costs.append(annotation_cost)
-        qualities.append(np.array(sample_qualities).mean())
+        qualities.append(sample_qualities.mean())
 
     return annotation_costs, qualities
 
 
-def compute_time_reliability_curve(annotations, times, score_key="coherence_score"):
-    groups = get_annotator_groups(annotations)
+def compute_time_reliability_curve(annotations, times, score_key="coherence_score", limit=500, random_state=None):
+    if random_state is None:
+        random_state = np.random
 
-    annotator_times = times.groupby("annotator").sum()
+    statistics = get_subsample_statistics(annotations, score_key)
+    original_scores = get_original_scores(statistics)
+    num_groups = len(statistics.group_sums)
 
-    original_scores = annotations.groupby("system").mean().sort_index()[score_key].to_numpy()
+    annotator_times = times.groupby("annotator").sum().reindex(statistics.annotators).fillna(0).to_numpy()
+    present = statistics.annotator_groups >= 0
+    group_times = np.zeros((num_groups,) + annotator_times.shape[1:])
+    np.add.at(group_times, statistics.annotator_groups[present], annotator_times[present])
 
     all_scores = []
     all_times = []
-    for sample_size in range(2, len(groups) - 1):
-        combs = it.combinations(groups, sample_size)
-        combs = list(combs)
-        random.shuffle(combs)
-        combs = combs[:500]
-
-        for comb in tqdm(combs, leave=False):
-            key = [a for b in comb for a in b]
-
-            sample_scores = annotations.loc[key].groupby("system").mean().sort_index()[score_key].to_numpy()
-            corr = scipy.stats.pearsonr(original_scores, sample_scores)[0]
+    for sample_size in range(2, num_groups - 1):
+        combs = sample_combinations(num_groups, sample_size, "capped", limit, random_state)
 
-            all_scores.append(corr)
-            all_times.append(annotator_times.loc[key].sum())
+        sample_scores = compute_subsample_scores(statistics.group_sums, statistics.group_counts, combs)
+        all_scores.extend(correlate_rows(original_scores[None], sample_scores))
+        all_times.extend(group_times[combs].sum(axis=1))
 
     return all_scores, all_times
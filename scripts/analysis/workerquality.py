@@ -0,0 +1,144 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .agreement import get_default_score_name
+from .annotationutils import as_annotation_set, load_annotations
+
+
+# Worker reliability from the annotations alone. Every (document, system) item has a latent
+# standard normal quality and worker w scores it as slope_w * quality + bias_w plus normal noise
+# of variance noise_w. EM alternates between the posterior of the item qualities and per worker
+# regressions on it, both of which are sums over the annotations of an item or a worker. Spammers
+# show up with a slope near 0 (answers unrelated to the items) or a large noise.
+
+WorkerModel = namedtuple("WorkerModel", [
+    "workers", "slopes", "biases", "noise", "item_means", "item_variances", "num_iterations", "converged"
+])
+
+
+def _get_worker_codes(annotations, worker_name):
+    # Worker ids from ingest's worker column if present, annotators otherwise
+    if worker_name in annotations.labels:
+        codes, names = annotations.labels[worker_name]
+        return np.asarray(codes), pd.Index(names, name="worker")
+    return annotations.annotators, annotations.annotator_names
+
+
+def fit_worker_model(annotations, score_name="score", worker_name="worker", max_iterations=1000, tolerance=1e-6, min_noise=1e-3, prior_strength=1.):
+    # prior_strength pseudo-annotations pull every worker towards the average worker, which keeps
+    # workers with few annotations from fitting their noise away
+    annotations = as_annotation_set(annotations)
+    scores = annotations.get_scores(score_name)
+    observed = ~np.isnan(scores)
+    scores = scores[observed]
+
+    worker_codes, worker_names = _get_worker_codes(annotations, worker_name)
+    workers, worker_index = np.unique(np.asarray(worker_codes)[observed], return_inverse=True)
+    worker_names = worker_names[workers]
+    items, item_index = np.unique(annotations.documents[observed].astype(np.int64) * len(annotations.system_names) + annotations.systems[observed], return_inverse=True)
+    num_workers, num_items = len(workers), len(items)
+
+    def worker_sums(weights):
+        return np.bincount(worker_index, weights=weights, minlength=num_workers)
+
+    def item_sums(weights):
+        return np.bincount(item_index, weights=weights, minlength=num_items)
+
+    counts = worker_sums(None)
+    score_sums = worker_sums(scores)
+    square_sums = worker_sums(scores ** 2)
+
+    # Start from standardized item means and the same worker for everyone
+    item_means = item_sums(scores) / item_sums(None)
+    slope, bias = item_means.std() or 1., item_means.mean()
+    item_means = (item_means - bias) / slope
+    item_variances = np.zeros(num_items)
+    slopes = np.full(num_workers, slope)
+    biases = np.full(num_workers, bias)
+    noise = np.full(num_workers, max(scores.var() - slope ** 2, min_noise))
+
+    converged = False
+    for iteration in range(1, max_iterations + 1):
+        # M step, per worker least squares of the scores on the expected item qualities, shrunk
+        # towards the average worker by prior_strength pseudo-annotations
+        means = item_means[item_index]
+        quality_sums = worker_sums(means)
+        quality_square_sums = worker_sums(means ** 2 + item_variances[item_index])
+        cross_sums = worker_sums(scores * means)
+
+        average_slope = (slopes * counts).sum() / counts.sum()
+        average_bias = (biases * counts).sum() / counts.sum()
+        a11 = quality_square_sums + prior_strength
+        a12 = quality_sums
+        a22 = counts + prior_strength
+        b1 = cross_sums + prior_strength * average_slope
+        b2 = score_sums + prior_strength * average_bias
+        determinant = a11 * a22 - a12 ** 2
+        new_slopes = (b1 * a22 - b2 * a12) / determinant
+        new_biases = (a11 * b2 - a12 * b1) / determinant
+
+        residuals = (
+            square_sums - 2 * new_slopes * cross_sums - 2 * new_biases * score_sums
+            + new_slopes ** 2 * quality_square_sums + 2 * new_slopes * new_biases * quality_sums + counts * new_biases ** 2
+        )
+        new_noise = np.maximum((residuals + prior_strength * noise.mean()) / (counts + prior_strength), min_noise)
+
+        change = max(np.abs(new_slopes - slopes).max(), np.abs(new_biases - biases).max(), np.abs(new_noise - noise).max())
+        slopes, biases, noise = new_slopes, new_biases, new_noise
+
+        # E step, normal posterior of every item quality
+        precisions = 1. + item_sums((slopes ** 2 / noise)[worker_index])
+        item_variances = 1. / precisions
+        item_means = item_sums(((slopes / noise)[worker_index]) * (scores - biases[worker_index])) * item_variances
+
+        if change < tolerance:
+            converged = True
+            break
+
+    return WorkerModel(worker_names, slopes, biases, noise, pd.Series(item_means, index=items), pd.Series(item_variances, index=items), iteration, converged)
+
+
+def get_worker_table(model):
+    # Reliability is the share of a worker's score variance explained by the item qualities
+    return pd.DataFrame({
+        "slope": model.slopes,
+        "bias": model.biases,
+        "noise": np.sqrt(model.noise),
+        "reliability": model.slopes ** 2 / (model.slopes ** 2 + model.noise),
+    }, index=model.workers)
+
+
+def get_item_table(annotations, model):
+    # Denoised scores of every (document, system) on the scale of the average worker
+    annotations = as_annotation_set(annotations)
+    documents, systems = np.divmod(model.item_means.index.to_numpy(), len(annotations.system_names))
+    slope, bias = model.slopes.mean(), model.biases.mean()
+    index = pd.MultiIndex.from_arrays([annotations.document_names[documents], annotations.system_names[systems]], names=["document", "system"])
+    return pd.DataFrame({
+        "score": slope * model.item_means.to_numpy() + bias,
+        "std_error": np.abs(slope) * np.sqrt(model.item_variances.to_numpy()),
+    }, index=index)
+
+
+def screen_workers(model, min_reliability=0.2):
+    # Workers whose answers are mostly unrelated to the items
+    table = get_worker_table(model)
+    return list(table.index[(table["reliability"] < min_reliability) | (table["slope"] <= 0)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation_file")
+    parser.add_argument("-w", dest="worker_name", default="worker")
+    parser.add_argument("-r", dest="min_reliability", type=float, default=0.2)
+
+    args = parser.parse_args()
+
+    annotations = load_annotations(args.annotation_file)
+    model = fit_worker_model(annotations, get_default_score_name(annotations), args.worker_name)
+    print(get_worker_table(model).sort_values("reliability"))
+    print(get_item_table(annotations, model).groupby(level="system")["score"].mean())
+    print("screened:", " ".join(map(str, screen_workers(model, args.min_reliability))))
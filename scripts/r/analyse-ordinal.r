@@ -88,7 +88,7 @@ marginal <- pairs(marginal, infer=c(TRUE, TRUE), adjust=adjust)
 
 for (idx in 1:nrow(marginal)) {
     sign <- "o"
-    if (marginal[idx, "p.value"] < 0.05) {
+    if (!is.na(marginal[idx, "p.value"]) && marginal[idx, "p.value"] < 0.05) {
         sign <- "+"
         if (marginal[idx, "estimate"] < 0.0) {
             sign <- "-"
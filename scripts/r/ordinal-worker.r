@@ -0,0 +1,83 @@
+suppressMessages({
+	library(ordinal)
+	library(emmeans)
+	library(stringr)
+})
+
+# Long-lived counterpart of analyse-ordinal.r. Reads batches from stdin, each announced by a
+# "<score name> <mode> <number of rows>" line followed by a CSV (header plus rows) with a
+# replicate column, and writes one "replicate\tcontrast\tdirection\tp" line per contrast
+# ("replicate\tfailed" for replicates whose model cannot be fitted), followed by DONE once the
+# whole batch is fitted.
+
+fit_contrasts <- function(data, score_name, is_crossed, adjust) {
+	data$annotator <- factor(data$annotator)
+	data$document <- factor(data$document)
+	data$system <- factor(data$system)
+
+	scores <- data[score_name]
+
+	if (score_name == "rank") {
+		scores <- -scores
+	}
+
+	data$score <- factor(unlist(scores))
+
+	if (is_crossed) {
+		model <- clmm(score ~ system + (system|annotator) + (system|document), data=data)
+	} else {
+		model <- clmm(score ~ system + (system|annotator), data=data)
+	}
+
+	marginal <- emmeans(model, "system")
+	marginal <- pairs(marginal, infer=c(TRUE, TRUE), adjust=adjust)
+	as.data.frame(marginal)
+}
+
+input <- file("stdin", "r")
+
+repeat {
+	header <- readLines(input, n=1)
+	if (length(header) == 0) {
+		break
+	}
+
+	header <- unlist(str_split(header, " "))
+	score_name <- header[1]
+	mode_info <- unlist(str_split(header[2], ":"))
+	num_rows <- as.integer(header[3])
+
+	is_crossed <- mode_info[1] == "crossed"
+	adjust <- "tukey"
+	if (length(mode_info) > 1) {
+		adjust <- mode_info[2]
+	}
+
+	batch <- read.csv(text=paste(readLines(input, n=num_rows + 1), collapse="\n"))
+
+	for (replicate in unique(batch$replicate)) {
+		data <- batch[batch$replicate == replicate,]
+		marginal <- tryCatch(fit_contrasts(data, score_name, is_crossed, adjust), error=function(e) NULL)
+		if (is.null(marginal)) {
+			cat(replicate, "failed", sep="\t")
+			cat("\n")
+			next
+		}
+
+		for (idx in 1:nrow(marginal)) {
+			# Degenerate fits can leave contrasts without a p-value, they are reported as no difference
+			sign <- "o"
+			if (!is.na(marginal[idx, "p.value"]) && marginal[idx, "p.value"] < 0.05) {
+				sign <- "+"
+				if (marginal[idx, "estimate"] < 0.0) {
+					sign <- "-"
+				}
+			}
+			cat(replicate, as.character(unlist(marginal[idx, "contrast"])[1]), sign, marginal[idx, "p.value"], sep="\t")
+			cat("\n")
+		}
+	}
+
+	cat("DONE\n")
+	flush(stdout())
+}
@@ -0,0 +1,12 @@
+import sys
+import types
+from pathlib import Path
+
+
+# scripts/analysis is imported as the summaryanalysis package, as in the notebook
+ANALYSIS_DIR = Path(__file__).resolve().parents[1] / "scripts" / "analysis"
+
+if "summaryanalysis" not in sys.modules:
+    package = types.ModuleType("summaryanalysis")
+    package.__path__ = [str(ANALYSIS_DIR)]
+    sys.modules["summaryanalysis"] = package
@@ -0,0 +1,27 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from summaryanalysis.agreement import bootstrap_alpha, krippendorff_alpha
+from summaryanalysis.annotationutils import read_annotations
+
+krippendorff = pytest.importorskip("krippendorff")
+
+FINAL_RESULT = Path(__file__).resolve().parents[1] / "final_result"
+
+
+@pytest.mark.parametrize("file_name, score_name", [("xsum.likert.csv", "score"), ("cnndm.likert_10.csv", "score"), ("xsum.bws.csv", "rank")])
+@pytest.mark.parametrize("metric", ["nominal", "ordinal", "interval"])
+def test_alpha_matches_krippendorff(file_name, score_name, metric):
+    annotations = read_annotations(FINAL_RESULT / file_name)
+    # Annotators rate the (document, system) units
+    reliability_data = annotations[score_name].unstack(["document", "system"]).to_numpy(dtype=float)
+    expected = krippendorff.alpha(reliability_data=reliability_data, level_of_measurement=metric)
+    assert krippendorff_alpha(annotations, score_name, metric) == pytest.approx(expected)
+
+
+def test_bootstrap_replicates_center_on_alpha():
+    annotations = read_annotations(FINAL_RESULT / "xsum.likert.csv")
+    replicates = bootstrap_alpha(annotations, num_replicates=200, random_state=np.random.default_rng(0))
+    assert abs(np.median(replicates) - krippendorff_alpha(annotations)) < 0.05
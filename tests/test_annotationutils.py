@@ -0,0 +1,28 @@
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+from summaryanalysis.annotationutils import get_cache_dir, load_annotations, read_annotations
+
+FINAL_RESULT = Path(__file__).resolve().parents[1] / "final_result"
+
+
+def test_cache_round_trip(tmp_path):
+    path = tmp_path / "xsum.likert.csv"
+    shutil.copy(FINAL_RESULT / "xsum.likert.csv", path)
+    expected = read_annotations(path)
+
+    written = load_annotations(path).to_frame()
+    assert get_cache_dir(path).is_dir()
+    cached = load_annotations(path).to_frame()
+    pd.testing.assert_frame_equal(cached, written)
+    # Labels come back as categoricals
+    pd.testing.assert_frame_equal(cached.reset_index().astype({"corpus": str}), expected.reset_index().astype({"corpus": str}), check_dtype=False)
+
+    # A touched file with the same content keeps its cache, a changed one replaces it
+    os.utime(path, ns=(0, 0))
+    pd.testing.assert_frame_equal(load_annotations(path).to_frame(), written)
+    path.write_text(path.read_text().replace("xsum", "other"))
+    assert (load_annotations(path).to_frame()["corpus"] == "other").all()
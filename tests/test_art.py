@@ -0,0 +1,16 @@
+import itertools as it
+
+import numpy as np
+
+from summaryanalysis.art import exact_randomization_pvalues
+
+
+def test_exact_pvalues_in_chunks():
+    differences = np.random.default_rng(0).integers(-3, 4, size=(7, 18)).astype(float)
+    # One test per chunk
+    p_values = exact_randomization_pvalues(differences, max_chunk_bytes=1)
+    assert np.array_equal(p_values, exact_randomization_pvalues(differences))
+
+    signs = np.array(list(it.product((1., -1.), repeat=6)))
+    for row, p_value in zip(differences[:, :6], exact_randomization_pvalues(differences[:, :6], max_chunk_bytes=1)):
+        assert p_value == np.mean(np.abs(signs @ row) >= abs(row.sum()))
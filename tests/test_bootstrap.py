@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import numpy as np
+
+from summaryanalysis.annotationutils import read_annotations
+from summaryanalysis.bootstrap import _nested_weights, bootstrap_system_means, get_cell_sums, is_nested
+
+FINAL_RESULT = Path(__file__).resolve().parents[1] / "final_result"
+
+
+def test_nested_weights_resample_documents_within_groups():
+    _, _, cell_groups, cell_documents = get_cell_sums(read_annotations(FINAL_RESULT / "xsum.likert.csv"), "score")
+    assert is_nested(cell_groups, cell_documents)
+
+    # One cell per document here
+    weights = _nested_weights(cell_groups, cell_documents, 500, np.random.default_rng(0))
+    num_documents = cell_documents.max() + 1
+    assert np.array_equal(weights.sum(axis=1), np.full(500, num_documents))
+
+    # Every group gets whole copies of its number of documents
+    group_sizes = np.bincount(cell_groups)
+    group_weights = np.stack([np.bincount(cell_groups, weights=replicate) for replicate in weights])
+    assert np.array_equal(group_weights % group_sizes, np.zeros_like(group_weights))
+
+
+def test_bootstrap_means_center_on_system_means():
+    annotations = read_annotations(FINAL_RESULT / "xsum.likert.csv")
+    systems, means, replicates = bootstrap_system_means(annotations, num_replicates=400, seed=0, num_workers=1)
+
+    observed = annotations.groupby("system")["score"].mean()
+    assert np.allclose(means, observed[systems])
+    assert np.all(np.abs(np.median(replicates, axis=0) - means) < 0.05)
+    assert np.array_equal(replicates, bootstrap_system_means(annotations, num_replicates=400, seed=0, num_workers=1)[2])
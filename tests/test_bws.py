@@ -0,0 +1,39 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from summaryanalysis.annotationutils import read_annotations
+from summaryanalysis.bws import _MaxDiffObjective, fit_maxdiff, get_tuples
+
+FINAL_RESULT = Path(__file__).resolve().parents[1] / "final_result"
+
+
+@pytest.fixture(scope="module")
+def annotations():
+    return read_annotations(FINAL_RESULT / "xsum.bws.csv")
+
+
+def test_gradient_matches_finite_differences(annotations):
+    num_systems = annotations.index.get_level_values("system").nunique()
+    num_workers = annotations.index.get_level_values("annotator").nunique()
+    objective = _MaxDiffObjective(get_tuples(annotations), num_systems, num_workers, worker_variance=0.5)
+    params = np.random.default_rng(0).normal(scale=0.3, size=num_systems - 1 + num_workers * num_systems)
+
+    # A few worker effects next to the system utilities
+    for function in (objective, lambda params: objective.log_likelihood(params), lambda params: objective.penalty(params)):
+        for idx in list(range(num_systems - 1)) + [num_systems, len(params) - 1]:
+            step = np.zeros_like(params)
+            step[idx] = 1e-6
+            numeric = (function(params + step)[0] - function(params - step)[0]) / 2e-6
+            assert function(params)[1][idx] == pytest.approx(numeric, rel=1e-4, abs=1e-6)
+
+
+def test_log_likelihood_leaves_out_the_penalty(annotations):
+    fit = fit_maxdiff(annotations, worker_effects=True)
+    assert fit.penalty > 0
+    assert fit.log_likelihood < 0
+    plain = fit_maxdiff(annotations)
+    assert plain.penalty == 0
+    # Worker effects fit the data better than the shared utilities alone
+    assert fit.log_likelihood > plain.log_likelihood
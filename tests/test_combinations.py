@@ -0,0 +1,13 @@
+import itertools as it
+
+import numpy as np
+
+from summaryanalysis.combinations import binomial_table, iter_combinations
+
+
+def test_exhaustive_batches_follow_itertools():
+    binomial_table.cache_clear()
+    batches = list(iter_combinations(10, 4, "exhaustive", batch_size=7))
+    assert np.array_equal(np.concatenate(batches), list(it.combinations(range(10), 4)))
+    # One table for all batches
+    assert binomial_table.cache_info().misses == 1
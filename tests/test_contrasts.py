@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+
+from summaryanalysis.contrasts import pairwise_contrast_arrays
+
+
+@pytest.mark.parametrize("nested", [True, False])
+def test_single_annotator_is_not_significant(nested):
+    # All scores of one annotator, there is no variation between annotators to test against
+    scores = np.array([[1, 2, 2, 1, 3, 2]])
+    results = pairwise_contrast_arrays(scores, [0, 1, 0, 1, 0, 1], np.zeros(6, dtype=int), [0, 0, 1, 1, 2, 2], ["a", "b"], "none", nested)
+    assert results.estimates[0, 0] != 0
+    assert results.p_values[0, 0] == 1
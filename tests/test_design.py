@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from summaryanalysis.design import get_overlaps, random_design
+from summaryanalysis.design_power import make_design
+
+
+def test_random_design_repairs_overlaps():
+    # final_result shape, 100 documents in sets of 5 with 3 annotators each
+    annotators, documents = random_design(100, 5, 3, max_overlap=1, random_state=np.random.default_rng(0))
+
+    assert np.array_equal(np.bincount(documents), np.full(100, 3))
+    assert np.array_equal(np.bincount(annotators), np.full(60, 5))
+    assert all(len(np.unique(documents[annotators == annotator])) == 5 for annotator in range(60))
+    assert get_overlaps(annotators, documents).max() <= 1
+
+
+def test_make_random_design_with_overlap():
+    annotators, documents = make_design("random", 20, 5, 3, max_overlap=1, random_state=np.random.default_rng(1))
+    assert get_overlaps(annotators, documents).max() <= 1
+
+
+def test_random_design_rejects_impossible_overlap():
+    # Every annotator would need 20 partners, there are only 5 other annotators
+    with pytest.raises(ValueError, match="other annotators"):
+        random_design(20, 10, 3, max_overlap=1)
+
+
+def test_make_design_requires_its_sizes():
+    with pytest.raises(ValueError, match="bibd_documents"):
+        make_design("bibd", 2, 3, 1)
+    with pytest.raises(ValueError, match="num_systems"):
+        make_design("blocked", 2, 3, 1, systems_per_annotator=2)
+
+    annotators, documents = make_design("bibd", 2, 3, 1, bibd_documents=7)
+    # Two copies of the Fano plane
+    assert len(np.unique(annotators)) == 14 and len(np.unique(documents)) == 14
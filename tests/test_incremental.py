@@ -0,0 +1,49 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from summaryanalysis.agreement import krippendorff_alpha
+from summaryanalysis.incremental import IngestState
+from summaryanalysis.ingest import get_batch_paths, ingest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.mark.parametrize("metric", ["ordinal", "interval"])
+def test_incremental_alpha_matches_batch(tmp_path, metric):
+    table = ROOT / "shuffle_order" / "question_mapping_bws_xsum.csv"
+    paths = get_batch_paths(ROOT / "crowdsourcing" / "bws_csv")
+    directory = tmp_path / "batches"
+    directory.mkdir()
+
+    # Batches arrive in three updates, the state is saved and reloaded in between
+    state_path = tmp_path / "state.npz"
+    state = IngestState("bws")
+    for update in np.array_split(np.arange(len(paths)), 3):
+        for idx in update:
+            shutil.copy(paths[idx], directory)
+        state.update(directory, table, num_workers=1)
+        state.save(state_path)
+        state = IngestState.load(state_path)
+
+    annotations = ingest("bws", ROOT / "crowdsourcing" / "bws_csv", table, "xsum", num_workers=1).set_index(["annotator", "document", "system"])
+    assert state.num_annotators == annotations.index.get_level_values("annotator").max()
+    assert state.get_alpha(metric) == pytest.approx(krippendorff_alpha(annotations, "rank", metric))
+
+    means = annotations.groupby(["document", "system"])["rank"].mean().unstack("system")
+    assert np.allclose(state.get_document_means()[means.columns].to_numpy(), means.to_numpy())
+
+
+def test_capacity_grows_geometrically(tmp_path):
+    state = IngestState("likert")
+    for document in range(100):
+        state.add_scores(np.array([document]), np.full((1, 1, len(state.systems)), 3.))
+    assert state.num_documents == 100 and len(state.sums) == 128
+    assert len(state.get_document_means()) == 100
+
+    state.save(tmp_path / "state.npz")
+    loaded = IngestState.load(tmp_path / "state.npz")
+    assert len(loaded.sums) == 100
+    assert loaded.get_system_table().equals(state.get_system_table())
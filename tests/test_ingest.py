@@ -0,0 +1,31 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from summaryanalysis.ingest import Protocol, ingest, parse_timestamps, write_annotations
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_bws_reproduces_final_result(tmp_path):
+    annotations = ingest("bws", ROOT / "crowdsourcing" / "bws_csv", ROOT / "shuffle_order" / "question_mapping_bws_xsum.csv", "xsum", num_workers=1)
+    write_annotations(annotations, tmp_path / "xsum.bws.csv")
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "xsum.bws.csv"), pd.read_csv(ROOT / "final_result" / "xsum.bws.csv"))
+
+
+def test_parse_timestamps():
+    timestamps = pd.Series(["2021/04/26 6:27:11 PM GMT+8", "2021/05/09 6:56:02 PM AST", "2021/05/09 6:56:02 PM EDT", None])
+    parsed = parse_timestamps(timestamps)
+    assert parsed[0] == pd.Timestamp("2021-04-26 10:27:11", tz="UTC")
+    assert parsed[1] == parsed[2] == pd.Timestamp("2021-05-09 22:56:02", tz="UTC")
+    assert pd.isna(parsed[3])
+
+    with pytest.warns(UserWarning, match="1 of 2 timestamps"):
+        parsed = parse_timestamps(pd.Series(["2021/04/26 6:27:11 PM GMT+8", "yesterday"]))
+    assert parsed.notna().tolist() == [True, False]
+
+
+def test_protocol_is_abstract():
+    with pytest.raises(TypeError):
+        Protocol()
@@ -0,0 +1,20 @@
+import numpy as np
+
+from summaryanalysis import ordinal
+from summaryanalysis.montecarlo import get_art_pvals
+
+
+def test_max_t_pvalues_follow_their_pairs():
+    # Only system c differs, so only its pairs can be significant. The number of replicates
+    # differs from the number of pairs, a transposed p-value array would mix up the labels.
+    model = ordinal.OrdinalModel(["a", "b", "c"], np.array([0., 0., 3.]), np.array([-1., 0., 1.]), np.eye(3) * 0.1)
+    design = ordinal.create_design(20, 5, 3)
+    p_values = get_art_pvals(model, design, num_iters=5, seed=0, adjust="maxt")
+
+    assert len(p_values) == 5 * 3
+    better = p_values.index.get_level_values("better")
+    worse = p_values.index.get_level_values("worse")
+    with_c = (better == "c") | (worse == "c")
+    assert (better[with_c] == "c").all()
+    assert (p_values["p_value"][with_c] < 0.01).all()
+    assert (p_values["p_value"][~with_c] > 0.01).all()
@@ -0,0 +1,16 @@
+import numpy as np
+
+from summaryanalysis import ordinal
+from summaryanalysis.design import blocked_design
+
+
+def test_effect_loadings_follow_covariance_changes():
+    model = ordinal.MODELS["likertD:multi_news"].copy()
+    design = blocked_design(4, 5, 3)
+    model.sample_many(design, 2, np.random.default_rng(0))
+
+    model.annotator_covariance_matrix *= 0.
+    assert np.allclose(model.get_effect_loadings("annotator"), 0.)
+
+    model.annotator_covariance_matrix = np.eye(len(model.systems))
+    assert np.allclose(model.get_effect_loadings("annotator"), ordinal.slope_matrix(len(model.systems)))
@@ -0,0 +1,57 @@
+import copy
+
+import numpy as np
+import pytest
+
+from summaryanalysis import ordinal
+from summaryanalysis.contrasts import results_to_sets
+from summaryanalysis.design import blocked_design, random_design
+from summaryanalysis.regression import ContrastBackend, TTestBackend, collect_results, parse_contrast
+
+
+def test_ttest_sample_arrays_match_frames():
+    model = ordinal.MODELS["likertD:multi_news"]
+    design = random_design(100, 5, 3, random_state=np.random.default_rng(0))
+    scores = model.sample_many(design, 4, np.random.default_rng(1))
+    systems = sorted(model.systems)
+    order = [model.systems.index(system) for system in systems]
+
+    backend = TTestBackend()
+    results = backend.fit_sample_arrays(scores[:, order], design, systems, adjust="fdr")
+    frames = [model.to_frame(replicate_scores, design) for replicate_scores in scores]
+    assert results_to_sets(results) == backend.fit_many(frames, adjust="fdr")
+
+    # Mean differences of the pairs, not signs
+    frame = frames[0]["score"].unstack("system")[systems]
+    left, right = results.left, results.right
+    assert np.allclose(results.estimates[0], [np.nanmean(frame.iloc[:, i] - frame.iloc[:, j]) for i, j in zip(left, right)])
+
+
+@pytest.mark.parametrize("backend", [TTestBackend, ContrastBackend])
+def test_null_rejection_rate(backend):
+    # Equal coefficients, and with this model equal mean scores too
+    model = copy.deepcopy(ordinal.MODELS["likertD:cnn_dailymail"])
+    model.zero_coefficients()
+    design = blocked_design(20, 5, 3)
+    scores = model.sample_many(design, 400, np.random.default_rng(0))
+
+    results = backend().fit_sample_arrays(scores, design, model.systems, adjust="none")
+    assert 0.03 < np.mean(results.p_values < 0.05) < 0.08
+
+
+def test_ttest_rejects_tukey():
+    model = ordinal.MODELS["likertD:multi_news"]
+    design = blocked_design(2, 5, 3)
+    with pytest.raises(ValueError, match="tukey"):
+        TTestBackend().fit_sample_arrays(model.sample_many(design, 1), design, model.systems, adjust="tukey")
+
+
+def test_collect_missing_and_failed_contrasts():
+    records = [
+        parse_contrast(["a - b", "o", "NA"], 0), parse_contrast(["a - c", "-", "0.01"], 0),
+        parse_contrast(["failed"], 1),
+    ]
+    (differences, p_values), failed = collect_results(records, 2)
+    assert differences == {("c", "a")}
+    assert np.isnan(p_values["a", "b"]) and p_values["c", "a"] == 0.01
+    assert failed == (set(), None)
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from summaryanalysis.retest import get_bws_stability, get_likert_stability, join_rounds, read_records
+
+INTERVAL_TEST = Path(__file__).resolve().parents[1] / "interval_test"
+
+
+def reference_kappa(first, second, categories):
+    # Cohen's quadratic weighted kappa of two rating vectors
+    index = {category: idx for idx, category in enumerate(categories)}
+    observed = np.zeros((len(categories), len(categories)))
+    for a, b in zip(first, second):
+        observed[index[a], index[b]] += 1
+    observed /= observed.sum()
+    expected = np.outer(observed.sum(axis=1), observed.sum(axis=0))
+    positions = np.arange(len(categories))
+    weights = (positions[:, None] - positions[None, :]) ** 2
+    return 1 - (observed * weights).sum() / (expected * weights).sum()
+
+
+def reference_icc(values):
+    # ICC(A,1) of McGraw & Wong (1996) from the two-way ANOVA mean squares
+    num_rows, num_rounds = values.shape
+    grand = values.mean()
+    row_means, round_means = values.mean(axis=1), values.mean(axis=0)
+    row_mean_square = num_rounds * ((row_means - grand) ** 2).sum() / (num_rows - 1)
+    round_mean_square = num_rows * ((round_means - grand) ** 2).sum() / (num_rounds - 1)
+    residuals = values - row_means[:, None] - round_means[None, :] + grand
+    error_mean_square = (residuals ** 2).sum() / ((num_rows - 1) * (num_rounds - 1))
+    return (row_mean_square - error_mean_square) / (
+        row_mean_square + (num_rounds - 1) * error_mean_square + num_rounds * (round_mean_square - error_mean_square) / num_rows
+    )
+
+
+def test_likert_stability_matches_references():
+    joined = join_rounds([read_records(INTERVAL_TEST / "likert_output.json"), read_records(INTERVAL_TEST / "likert_output_redo.json")])
+    table = get_likert_stability(joined)
+
+    pairs = joined.dropna().to_numpy(dtype=float)
+    assert table.loc["all", "matched"] == len(pairs)
+    assert table.loc["all", "kappa"] == pytest.approx(reference_kappa(pairs[:, 0], pairs[:, 1], np.unique(pairs)))
+    assert table.loc["all", "icc"] == pytest.approx(reference_icc(pairs))
+
+    worker = table.drop("all")["matched"].idxmax()
+    worker_pairs = joined.xs(worker, level="worker").dropna().to_numpy(dtype=float)
+    assert table.loc[worker, "icc"] == pytest.approx(reference_icc(worker_pairs))
+
+
+def test_join_keeps_unmatched_judgments():
+    first = pd.DataFrame({"task": [1, 1, 2], "item": ["a", "a", "a"], "worker": ["w1", "w1", "w2"], "value": [1, 2, 3]})
+    second = pd.DataFrame({"task": [1, 2], "item": ["a", "a"], "worker": ["w1", "w3"], "value": [2, 3]})
+    joined = join_rounds([first, second])
+
+    # The latest repeated judgment is kept, w2 and w3 never match each other
+    assert joined.loc[("1", "a", "w1")].tolist() == [2, 2]
+    assert joined[0].notna().sum() == 2 and joined[1].notna().sum() == 2
+    assert len(joined.dropna()) == 1
+
+
+def test_bws_stability_of_identical_rounds():
+    records = read_records(INTERVAL_TEST / "bws_output.json")
+    table = get_bws_stability(join_rounds([records, records]))
+    assert table.loc["all", "change_rate"] == 0 and table.loc["all", "flip_rate"] == 0
+    assert table.loc["all", "kappa"] == pytest.approx(1.)
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from summaryanalysis.workerquality import fit_worker_model, get_item_table, screen_workers
+
+
+def simulate_annotations(num_documents=60, num_systems=4, num_workers=12, num_spammers=3, workers_per_document=4, seed=0):
+    # Workers score items on a 1-5 scale from their quality, spammers answer at random
+    random_state = np.random.default_rng(seed)
+    quality = random_state.standard_normal((num_documents, num_systems))
+    rows = []
+    for document in range(num_documents):
+        for worker in random_state.choice(num_workers, workers_per_document, replace=False):
+            if worker < num_spammers:
+                scores = random_state.integers(1, 6, num_systems)
+            else:
+                scores = np.clip(np.round(3 + 1.2 * quality[document] + 0.5 * random_state.standard_normal(num_systems)), 1, 5)
+            rows.extend((f"w{worker}", document, system, score) for system, score in enumerate(scores))
+    frame = pd.DataFrame(rows, columns=["annotator", "document", "system", "score"]).set_index(["annotator", "document", "system"])
+    return frame, quality
+
+
+def test_fit_finds_spammers_and_item_qualities():
+    annotations, quality = simulate_annotations()
+    model = fit_worker_model(annotations)
+    assert model.converged
+
+    assert sorted(screen_workers(model)) == ["w0", "w1", "w2"]
+    items = get_item_table(annotations, model)["score"].unstack("system").sort_index()
+    assert np.corrcoef(items.to_numpy().ravel(), quality.ravel())[0, 1] > 0.9